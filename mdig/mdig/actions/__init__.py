@@ -1,4 +1,4 @@
-from .run import RunAction
+from .run import RunAction, WorkerAction
 from .analysis import AnalysisAction, StatsAction, ReduceAction, ROCAction
 from .net import WebAction, ClientAction
 from .export import ExportAction
@@ -6,6 +6,7 @@ from .admin import AdminAction, ListAction, AddAction, ResetAction, RemoveAction
 
 mdig_actions = {
     "run": RunAction,
+    "worker": WorkerAction,
     "analysis": AnalysisAction,
     "stats": StatsAction,
     "add": AddAction,
@@ -233,9 +233,19 @@ class StatsAction(InstanceAction):
                 dest="mask",
                 default=None,
                 type="string")
+        self.parser.add_option("-J","--jobs",
+                help="Number of maps to calculate statistics for at once " +
+                "(default is the number of CPUs)",
+                action="store",
+                dest="jobs",
+                default=None,
+                type="int")
 
     def act_on_options(self, options):
         super(StatsAction, self).act_on_options(options)
+        if self.options.jobs is None:
+            import multiprocessing
+            self.options.jobs = multiprocessing.cpu_count()
         c = config.get_config()
         c.analysis_add_to_xml = self.options.analysis_add_to_xml
         c.analysis_filename_base = self.options.analysis_filename_base
@@ -263,7 +273,7 @@ class StatsAction(InstanceAction):
                         maps = i.get_occupancy_envelopes()[l]
                         i.change_mapset()
                         g.make_mask(self.options.mask)
-                        stats=g.get_univariate_stats(maps)
+                        stats=g.get_univariate_stats(maps, self.options.jobs)
                         fn = os.path.split(i.get_occ_envelope_img_filenames(ls=l,
                                 extension=False,gif=True)[:-5])
                         g.make_mask(None)
@@ -279,11 +289,19 @@ class StatsAction(InstanceAction):
                     for i in instances:
                         i.change_mapset()
                         g.make_mask(self.options.mask)
-                        for r in i.replicates:
-                            self.log.info("Calculating stats for instance %d, rep %d" % \
-                                    (i.get_index(), r.r_index))
-                            maps = r.get_saved_maps(l)
-                            stats = g.get_univariate_stats(maps)
+                        self.log.info("Calculating stats for instance %d, %d reps" % \
+                                (i.get_index(), len(i.replicates)))
+                        # Process the maps of all replicates together, so that
+                        # they can be done in parallel
+                        maps = {}
+                        for r_i, r in enumerate(i.replicates):
+                            for t, m in r.get_saved_maps(l).items():
+                                maps[(r_i, t)] = m
+                        rep_stats = [{} for r in i.replicates]
+                        all_stats = g.get_univariate_stats(maps, self.options.jobs)
+                        for (r_i, t), v in all_stats.items():
+                            rep_stats[r_i][t] = v
+                        for r, stats in zip(i.replicates, rep_stats):
                             fn = os.path.split(r.get_base_filenames(l, single_file=True))
                             fn = os.path.join(fn[0], self.options.analysis_filename_base + fn[1])
                             self.write_stats_to_file(stats, fn)
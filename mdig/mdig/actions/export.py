@@ -278,10 +278,7 @@ class ExportAction(Action):
                 os.remove(m)
 
     def export_map(self, map, out_fn, envelope=False):
-        old_region = "ExportActionBackupRegion"
         g = grass.get_g()
-        g.run_command('g.region --o save=%s' % old_region)
-        g.set_region(raster=map) 
         cmd = 'r.out.gdal input=%s output=%s.tif format=GTiff type=%s createopt="COMPRESS=PACKBITS,INTERLEAVE=PIXEL"'
         if envelope:
             if self.float64:
@@ -291,19 +288,18 @@ class ExportAction(Action):
         else:
             cmd = cmd % (map, out_fn, 'UInt16')
 
-        try:
-            g.run_command(cmd)
-            out_fn += ".tif"
-        except grass.GRASSCommandException, e:
-            # This swaps to 64 bit floats if GRASS complains about
-            # losing precision on export.
-            if "Precision loss" in e.stderr:
-                self.float64 = True
-                out_fn = self.export_map(map,out_fn,envelope)
-            else:
-                raise e
-        finally:
-            g.set_region(old_region) 
+        with g.region_context(raster=map):
+            try:
+                g.run_command(cmd)
+                out_fn += ".tif"
+            except grass.GRASSCommandException, e:
+                # This swaps to 64 bit floats if GRASS complains about
+                # losing precision on export.
+                if "Precision loss" in e.stderr:
+                    self.float64 = True
+                    out_fn = self.export_map(map,out_fn,envelope)
+                else:
+                    raise e
         return out_fn
 
     def zip_maps(self, maps, zip_fn):
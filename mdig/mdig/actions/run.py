@@ -7,9 +7,11 @@ from optparse import OptionParser
 import mdig
 import mdig.utils as utils
 from mdig import config
-from mdig.actions.base import InstanceAction
+from mdig.actions.base import Action, InstanceAction
 
 from mdig import displayer
+from mdig.commandprofile import profiler
+from mdig import parallel
 
 
 class RunAction(InstanceAction):
@@ -53,7 +55,7 @@ class RunAction(InstanceAction):
         # as a single matrix. Latter is faster but results in fractional
         # population
         self.parser.add_option("-i","--by-individual",
-                help="Do lifestage transitions by individual (Warning: very slow)",
+                help="Do lifestage transitions by individual, so populations stay whole",
                 action="store_true",
                 dest="ls_trans_individual")
         self.parser.add_option("-z","--ignore-div-by-zero",
@@ -70,6 +72,47 @@ class RunAction(InstanceAction):
                 action="store",
                 dest="reps",
                 type="int")
+        self.parser.add_option("-J","--jobs",
+                help="Number of replicates to run at once in separate processes" +
+                " (default: 1)",
+                action="store",
+                dest="jobs",
+                default=1,
+                type="int")
+        self.parser.add_option("-c","--checkpoint",
+                help="Save a checkpoint of each replicate every N timesteps, so that" +
+                " an interrupted replicate resumes from its last checkpoint",
+                action="store",
+                dest="checkpoint_interval",
+                type="int")
+        self.parser.add_option("--full-region",
+                help="Always run events over the whole region, instead of just" +
+                " the area around the populations that the events can reach",
+                action="store_false",
+                dest="active_area")
+        self.parser.add_option("--queue",
+                help="Put replicates in a job queue for 'mdig.py worker' processes" +
+                " on hosts sharing the repository to run",
+                action="store_true",
+                dest="queue")
+        self.parser.add_option("--job-timeout",
+                help="Seconds without a heartbeat before a queued job is given" +
+                " to another worker (default: 600)",
+                action="store",
+                dest="job_timeout",
+                default=600,
+                type="int")
+        self.parser.add_option("--profile",
+                help="Record the time taken by each GRASS command, print a summary at" +
+                " exit and save details as CSV and JSON",
+                action="store_true",
+                dest="profile")
+        self.parser.add_option("--profile-file",
+                help="Base filename for the profile CSV and JSON (default: mdig_profile)",
+                action="store",
+                dest="profile_file",
+                default="mdig_profile",
+                type="string")
 
     def act_on_options(self, options):
         super(RunAction, self).act_on_options(options)
@@ -84,6 +127,18 @@ class RunAction(InstanceAction):
                 c.output_dir = options.output_dir
         c.overwrite_flag = self.options.overwrite_flag
         c.remove_null = self.options.remove_null
+        if options.checkpoint_interval is not None:
+            c.checkpoint_interval = options.checkpoint_interval
+        if options.active_area is not None:
+            c.active_area = options.active_area
+        if options.profile:
+            profiler.enabled = True
+        if options.jobs < 1:
+            self.log.error("Number of jobs must be at least 1")
+            sys.exit(mdig.mdig_exit_codes['cmdline_error'])
+        if (options.jobs > 1 or options.queue) and options.show_monitor:
+            self.log.error("Can't display a monitor when running more than one job")
+            sys.exit(mdig.mdig_exit_codes['cmdline_error'])
 
     def prerun_setup(self, mdig_model):
         if self.options.time is not None:
@@ -97,7 +152,7 @@ class RunAction(InstanceAction):
             mdig_model.add_listener(displayer.Displayer())
 
         if self.options.ls_trans_individual:
-            self.log.debug("Calculating lifestage transitions by individual. This is slow.")
+            self.log.debug("Calculating lifestage transitions by individual.")
             for i in mdig_model.get_lifestage_transitions():
                 i.by_individual = True
 
@@ -114,14 +169,26 @@ class RunAction(InstanceAction):
             sys.exit(mdig.mdig_exit_codes['up_to_date'])
 
     def do_me(self, mdig_model):
-        self.prerun_setup(mdig_model)
-        super(RunAction, self).do_me(mdig_model)
+        try:
+            self.prerun_setup(mdig_model)
+            super(RunAction, self).do_me(mdig_model)
+        finally:
+            if profiler.enabled:
+                self.report_profile()
+
+    def report_profile(self):
+        print profiler.format_table()
+        base_fn = self.options.profile_file
+        profiler.write_csv(base_fn + ".csv")
+        profiler.write_json(base_fn + ".json")
+        self.log.info("Command profile saved to %s.csv and %s.json",
+                base_fn, base_fn)
 
     def do_model(self, mdig_model):
         if self.options.rerun_instances:
             self.log.debug("Resetting model so all instances and replicates will be rerun")
             mdig_model.reset_instances()
-        mdig_model.run()
+        mdig_model.run(jobs=self.options.jobs, queue=self.get_queue(mdig_model))
         if mdig_model.total_time_taken:
             mdig_model.log_instance_times()
             print "Total time taken: %s" % mdig_model.total_time_taken
@@ -132,5 +199,54 @@ class RunAction(InstanceAction):
         if self.options.rerun_instances:
             self.log.debug("Resetting instance so all replicates will be rerun")
             instance.reset()
-        instance.run()
+        instance.run(jobs=self.options.jobs, queue=self.get_queue(mdig_model))
+
+    def get_queue(self, mdig_model):
+        if self.options.queue:
+            return parallel.get_job_queue(mdig_model, self.options.job_timeout)
+        return None
+
+
+class WorkerAction(Action):
+    description = "Run replicates queued by 'mdig.py run --queue'"
+
+    def __init__(self):
+        super(WorkerAction, self).__init__()
+        self.parser = OptionParser(version=mdig.version_string,
+                description = self.description,
+                usage = "%prog worker [options] model_name" )
+        self.add_options()
+
+    def add_options(self):
+        super(WorkerAction, self).add_options()
+        self.parser.add_option("-w","--wait",
+                help="Keep waiting for jobs when the queue is empty",
+                action="store_true",
+                dest="wait")
+        self.parser.add_option("--heartbeat",
+                help="Seconds between heartbeats while running a job (default: 60)",
+                action="store",
+                dest="heartbeat",
+                default=60,
+                type="int")
+        self.parser.add_option("--poll",
+                help="Seconds between checks for new jobs (default: 5)",
+                action="store",
+                dest="poll",
+                default=5,
+                type="int")
+
+    def act_on_options(self, options):
+        super(WorkerAction, self).act_on_options(options)
+        # Profile stats are sent back with each result, in case the
+        # coordinator is profiling
+        profiler.enabled = True
+
+    def do_me(self, mdig_model):
+        queue = parallel.get_job_queue(mdig_model)
+        worker = parallel.QueueWorker(mdig_model, queue,
+                heartbeat_interval=self.options.heartbeat,
+                poll_interval=self.options.poll, wait=self.options.wait)
+        self.log.info("Waiting for jobs in %s" % queue.queue_dir)
+        worker.run()
 
@@ -81,6 +81,25 @@ class Analysis:
                 params[node.attrib["name"]]=(v.tag,a)
         return params
 
+    def get_history_depth(self):
+        """ Get how many of the lifestage's previous maps the analysis uses
+
+        @return: the largest previousMap offset, or 0 if it doesn't use any.
+        """
+        depth = 0
+        for v in self.xml_node.xpath("param/previousMap"):
+            depth = max(depth, int(v.attrib.get("offset", 1)))
+        return depth
+
+    def get_append_file(self,rep):
+        """ Get the file the analysis appends its output to for replicate rep
+
+        @return: the filename, or None if the analysis doesn't append.
+        """
+        if self.is_redirected_stdout() and self.is_append():
+            return self._make_filename(rep)
+        return None
+
     def pre_run(self,rep):
         """ Set up environment so analysis can run without trouble
 
@@ -110,9 +129,8 @@ class Analysis:
             if value == "currentMap":
                 p[p_name]=map_name
             elif value == "previousMap":
-                # TODO currently get_previous_maps is broken
                 if a is not None:
-                    p[p_name]=rep.get_previous_map(ls_id,a)
+                    p[p_name]=rep.get_previous_map(ls_id,int(a))
                 else:
                     p[p_name]=rep.get_previous_map(ls_id)
                 # None is returned when a previous map of offset a
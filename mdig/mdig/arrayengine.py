@@ -0,0 +1,530 @@
+"""
+In-memory simulation engine for replicates.
+
+The default engine moves the population through GRASS rasters on disk, running
+one GRASS module per event. For models that only use the common r.mdig.*
+events, the ArrayEngine instead keeps each lifestage's population in a numpy
+array for the whole replicate. Events are applied as vectorised functions that
+reproduce what the GRASS modules do, and rasters are only written when a
+RasterOutput asks for them.
+
+Models choose the engine with the engine attribute of the <model> element.
+When a model (or instance) uses anything that the ArrayEngine doesn't
+support, the replicate is run with the GRASS engine instead.
+
+Populations are float arrays that use NaN for null cells.
+"""
+import logging
+import math
+
+import numpy
+
+import grass
+from mdig.commandprofile import profiler
+
+
+class UnsupportedModelException(Exception): pass
+
+
+def is_int_literal(s):
+    """ Whether r.mapcalc would treat the string s as an integer """
+    try:
+        int(s)
+        return True
+    except ValueError:
+        return False
+
+
+def _int_div(a, b):
+    """ Divide the way r.mapcalc does for two integer operands, truncating
+    towards zero. Division by zero gives null. """
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        result = numpy.trunc(numpy.true_divide(a, b))
+    return numpy.where(numpy.asarray(b) == 0, numpy.nan, result)
+
+
+def _div(a, b, integer):
+    if integer:
+        return _int_div(a, b)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        result = numpy.true_divide(a, b)
+    return numpy.where(numpy.asarray(b) == 0, numpy.nan, result)
+
+
+########## Dispersal kernels (r.mdig.kernel) ##########
+
+def inv_cauchy_cdf(p, a, b):
+    return b * numpy.tan((p - 0.5) * math.pi)
+
+
+def inv_exponential_cdf(p, a, b):
+    return numpy.log(1.0 - p) * -b
+
+
+def inv_exponential_cdf2(p, a, b):
+    return (math.log(1 - a) - numpy.log(p)) / b
+
+_clark_tables = {}
+CLARK_STEPS = 131072
+
+
+def clark(p, d, s):
+    """ Inverse of the general kernel from Clark 1998, using the same
+    numerical integration as r.mdig.kernel """
+    if (d, s) not in _clark_tables:
+        step_width = d * 0.005
+        normal = s / (d * math.gamma(1.0 / s))
+        i = numpy.arange(1, 8 * CLARK_STEPS)
+        kernel = normal * numpy.exp(-(((i - 0.5) * step_width / d) ** s))
+        acum = numpy.concatenate(([0.0], numpy.cumsum(kernel * step_width)))
+        _clark_tables[(d, s)] = (step_width, acum)
+    step_width, acum = _clark_tables[(d, s)]
+    return step_width * numpy.interp(p, acum, numpy.arange(len(acum)))
+
+kernel_functions = {
+    'cauchy': inv_cauchy_cdf,
+    # r.mdig.kernel uses cauchy in place of the log distribution
+    'log': inv_cauchy_cdf,
+    'exponential': inv_exponential_cdf,
+    'exponential2': inv_exponential_cdf2,
+    'general': clark,
+}
+
+
+def kernel_spread(pop, rng, res, kernel='cauchy', d_a=0.0, d_b=1.0,
+        frequency=0.05, limit=0.0, min_dist=0.0, agem=0, boolean=False,
+        popdep=False):
+    """ Long distance dispersal, as done by r.mdig.kernel without the -c
+    flag.
+
+    Each present cell generates a Poisson number of jump events with mean
+    frequency (multiplied by the population with popdep). Each event travels
+    a distance drawn from the kernel in a uniformly random direction, and
+    gives its destination a population of 1, or adds 1 if the destination is
+    already occupied and the map is a population (not boolean or age based).
+
+    min_dist can be a value or an array of per cell minimum distances.
+    """
+    nsres, ewres = res
+    nrows, ncols = pop.shape
+    present = ~numpy.isnan(pop)
+    if not numpy.any(~present):
+        # r.mdig.kernel treats zero as absent when the map has no nulls
+        present &= (pop != 0)
+    with numpy.errstate(invalid='ignore'):
+        mature = present & (pop >= agem)
+    out = numpy.where(mature, pop, numpy.nan)
+    sources = numpy.nonzero(mature)
+    if popdep:
+        events = rng.poisson(frequency * pop[sources])
+    else:
+        events = rng.poisson(frequency, len(sources[0]))
+    rows = numpy.repeat(sources[0], events)
+    cols = numpy.repeat(sources[1], events)
+    if len(rows) == 0:
+        return out
+
+    dist = numpy.abs(kernel_functions[kernel](rng.uniform(size=len(rows)),
+        d_a, d_b))
+    if numpy.ndim(min_dist) > 0:
+        min_dist = numpy.nan_to_num(min_dist[rows, cols])
+    ok = dist >= min_dist
+    if limit > 0.0:
+        ok &= dist <= limit
+    angle = rng.uniform(size=len(rows)) * (2.0 * math.pi)
+    d_col = numpy.rint(numpy.sin(angle) * dist / ewres)
+    d_row = numpy.rint(numpy.cos(angle) * dist / nsres)
+    # events too short to leave their cell do nothing
+    ok &= (d_col != 0) | (d_row != 0)
+    dest_row = rows[ok] + d_row[ok].astype(int)
+    dest_col = cols[ok] + d_col[ok].astype(int)
+    in_bounds = (dest_row >= 0) & (dest_row < nrows) & \
+            (dest_col >= 0) & (dest_col < ncols)
+    dest = dest_row[in_bounds] * ncols + dest_col[in_bounds]
+
+    jumps = numpy.bincount(dest, minlength=nrows * ncols).reshape(pop.shape)
+    landed = jumps > 0
+    empty = numpy.isnan(out)
+    if boolean or agem != 0:
+        out[landed & empty] = 1.0
+    else:
+        out[landed & empty] = 0.0
+        out[landed] += jumps[landed]
+    return out
+
+
+########## Local spread (r.mdig.localspread) ##########
+
+def spread_area(radius, res):
+    """ The number of cells r.mdig.localspread divides individuals between.
+
+    This is one less than the number of neighbouring cells within radius,
+    which is what the module calculates, and radius is truncated to an
+    integer first.
+    """
+    nsres, ewres = res
+    radius = int(radius)
+    n_i = int(radius / ewres) + 1
+    n_j = int(radius / nsres) + 1
+    i, j = numpy.mgrid[-n_i:n_i + 1, -n_j:n_j + 1]
+    within = numpy.sqrt((i * ewres) ** 2 + (j * nsres) ** 2) <= radius
+    return int(numpy.sum(within)) - 2
+
+
+def spread_offsets(spread, res):
+    """ Row and column offsets of the cells that a cell spreads to """
+    nsres, ewres = res
+    n_i = int(spread / nsres)
+    n_j = int(spread / ewres)
+    i, j = numpy.mgrid[-n_i:n_i + 1, -n_j:n_j + 1]
+    within = numpy.sqrt((i * nsres) ** 2 + (j * ewres) ** 2) <= spread
+    within &= (i != 0) | (j != 0)
+    return zip(i[within], j[within])
+
+
+def _shift_add(dest, src, di, dj):
+    """ Add src to dest offset by di rows and dj columns, dropping what
+    falls outside """
+    nrows, ncols = src.shape
+    if abs(di) >= nrows or abs(dj) >= ncols:
+        return
+    d_rows = slice(max(di, 0), nrows + min(di, 0))
+    s_rows = slice(max(-di, 0), nrows + min(-di, 0))
+    d_cols = slice(max(dj, 0), ncols + min(dj, 0))
+    s_cols = slice(max(-dj, 0), ncols + min(-dj, 0))
+    dest[d_rows, d_cols] += src[s_rows, s_cols]
+
+
+def local_spread(pop, res, spread, proportion=1.0, boolean=False):
+    """ Spread to neighbouring cells within the spread distance, as done by
+    r.mdig.localspread when it isn't age based.
+
+    With boolean, every non-null cell makes all cells within spread present.
+    Otherwise each non-null cell keeps its population minus
+    int(population * proportion) individuals, and every cell within spread
+    receives that number integer divided by spread_area(), with the
+    remainder kept at the source. spread can be a value or an array of per
+    cell distances.
+    """
+    present = ~numpy.isnan(pop)
+    if numpy.ndim(spread) == 0:
+        spread = numpy.where(present, float(spread), 0.0)
+    else:
+        spread = numpy.nan_to_num(spread)
+
+    total = numpy.zeros(pop.shape)
+    touched = present.copy()
+    if boolean:
+        for s in numpy.unique(spread[present]):
+            movers = (present & (spread == s)).astype(float)
+            for di, dj in spread_offsets(s, res):
+                _shift_add(total, movers, di, dj)
+        touched |= total > 0
+        return numpy.where(touched, 1.0, numpy.nan)
+
+    values = numpy.where(present, pop, 0.0)
+    individuals = numpy.floor(values * proportion)
+    kept = values - individuals
+    for s in numpy.unique(spread[present]):
+        group = present & (spread == s)
+        n_cells = spread_area(s, res)
+        if n_cells <= 0:
+            # The module's unsigned arithmetic means nothing spreads
+            total[group] += values[group]
+            continue
+        mean = numpy.where(group, numpy.floor(individuals / n_cells), 0.0)
+        extra = individuals - mean * n_cells
+        spreading = group & (mean > 0)
+        total[spreading] += kept[spreading] + extra[spreading]
+        total[group & ~spreading] += values[group & ~spreading]
+        for di, dj in spread_offsets(s, res):
+            _shift_add(total, mean, di, dj)
+            _shift_add(touched, spreading, di, dj)
+    return numpy.where(touched, total, numpy.nan)
+
+
+########## Simple events ##########
+
+def survival(pop, rng, survival_pc):
+    """ Remove populations at random, as r.mdig.survival does without cats
+    or max. Cells survive if an integer drawn from [0, 100) is less than
+    survival_pc, which may be a value or array. """
+    chance = rng.randint(0, 100, pop.shape)
+    with numpy.errstate(invalid='ignore'):
+        survived = chance < survival_pc
+    return numpy.where(survived, pop, numpy.nan)
+
+
+def age_pop(pop):
+    """ Age all populations by 1, as r.mdig.agepop does """
+    with numpy.errstate(invalid='ignore'):
+        return numpy.where(pop > 0, pop + 1, pop)
+
+
+def recruit(pop, mortality):
+    """ The recruited population, as r.mdig.recruit writes to a map that
+    doesn't exist yet """
+    return pop * mortality
+
+
+growth_functions = ['skellam', 'beverton', 'ricker', 'wang']
+
+
+def growth(pop, function='skellam', growth_rate=1.0, capacity=None,
+        integer=False, growth_is_int=False, capacity_is_int=True):
+    """ Grow populations the way r.mdig.growth does, including r.mapcalc's
+    integer arithmetic when the map and parameters are integers. """
+    g, k = growth_rate, capacity
+    with numpy.errstate(invalid='ignore', over='ignore'):
+        if function == 'beverton':
+            gm1 = _div(g - 1, k, growth_is_int and capacity_is_int)
+            out = _div(pop * g, 1 + (gm1 * pop),
+                    integer and growth_is_int and capacity_is_int)
+        elif function == 'ricker':
+            out = pop * numpy.exp(g * (1 - _div(pop, k,
+                integer and capacity_is_int)))
+        elif function == 'wang':
+            t1 = _div(pop, k, integer and capacity_is_int)
+            all_int = integer and capacity_is_int and growth_is_int
+            out = _div(k * (g * (t1 ** 2)), 1 + ((g - 1) * t1 ** 2), all_int)
+        elif k is not None:
+            t1 = 1 - _div(pop, k, integer and capacity_is_int)
+            out = pop + (pop * g * t1)
+        else:
+            out = pop + (pop * g)
+    if integer:
+        out = numpy.trunc(out)
+    return out
+
+
+def active_window(pop, reach, res):
+    """ Slices of pop covering its non-null cells grown by reach map units,
+    or None if that's all of pop. With reach None there's no window. """
+    if reach is None:
+        return None
+    rows = numpy.nonzero(~numpy.all(numpy.isnan(pop), axis=1))[0]
+    cols = numpy.nonzero(~numpy.all(numpy.isnan(pop), axis=0))[0]
+    if len(rows) == 0:
+        return None
+    nsres, ewres = res
+    # Grow by an extra cell, since distances are rounded to cells
+    d_row = int(math.ceil(reach / nsres)) + 1
+    d_col = int(math.ceil(reach / ewres)) + 1
+    window = (slice(max(rows[0] - d_row, 0), rows[-1] + d_row + 1),
+            slice(max(cols[0] - d_col, 0), cols[-1] + d_col + 1))
+    if pop[window].shape == pop.shape:
+        return None
+    return window
+
+
+########## Engine ##########
+
+class ArrayEngine(object):
+    """ Runs the time loop of a replicate on arrays in memory """
+
+    def __init__(self, replicate):
+        self.rep = replicate
+        self.instance = replicate.instance
+        self.model = replicate.instance.experiment
+        self.grass_i = grass.get_g()
+        self.log = logging.getLogger("mdig.arrayengine")
+        self.maps = {}
+        self.rng = None
+        self.res = None
+        # The part of the region that events are being run on
+        self.window = (slice(None), slice(None))
+
+    def check(self):
+        """ Raise UnsupportedModelException if the replicate can't be run
+        with this engine """
+        # imported here since outputformats imports the model classes
+        import outputformats
+        model = self.model
+        if model.get_lifestage_transitions():
+            raise UnsupportedModelException("lifestage transitions")
+        if model.get_management_strategy(self.instance.strategy) is not None:
+            raise UnsupportedModelException("management strategies")
+        for l in self.instance.listeners:
+            if isinstance(l, outputformats.RasterOutput):
+                continue
+            method = getattr(l.__class__, 'replicate_update', None)
+            if method is not None and not (isinstance(l, outputformats.BaseOutput)
+                    and method.im_func is outputformats.BaseOutput.replicate_update.im_func):
+                raise UnsupportedModelException("output %s" % l.__class__.__name__)
+        for ls_id in model.get_lifestage_ids():
+            ls = model.get_lifestage(ls_id)
+            if ls.analyses():
+                raise UnsupportedModelException("analyses")
+            intervals = ls.get_phenology_intervals(self.instance.r_id)
+            if intervals is not None and len(intervals) > 1:
+                raise UnsupportedModelException("phenology masks")
+            for e in ls.events:
+                self._check_event(e, ls.populationBased)
+
+    def _check_event(self, e, is_pop):
+        command = e.get_command()
+        if command not in self.event_handlers:
+            raise UnsupportedModelException("event %s" % command)
+        params = e.get_params(is_pop)
+        if e.fixed_input is not None:
+            raise UnsupportedModelException("event %s with fixed input" % command)
+        for p_name, (p_type, p_value) in params.items():
+            if p_type == "REPORT_FILE":
+                raise UnsupportedModelException("event %s report file" % command)
+        in_name, out_name = e.get_input_name(), e.get_output_name()
+        flags = [k for k, v in params.items() if v[0] == "FLAG"]
+        if command == 'r.mdig.kernel':
+            if 'c' in flags:
+                raise UnsupportedModelException("r.mdig.kernel with -c")
+        elif command == 'r.mdig.localspread':
+            for p in ('agem', 'agemax'):
+                if p in params and params[p][1] != "-1":
+                    raise UnsupportedModelException("age based r.mdig.localspread")
+        elif command == 'r.mdig.survival':
+            for p in ('cats', 'max', 'statfile'):
+                if p in params:
+                    raise UnsupportedModelException("r.mdig.survival with %s" % p)
+        elif command == 'r.mdig.growth':
+            function = 'skellam'
+            if 'function' in params: function = params['function'][1]
+            if function not in growth_functions or 'b' in flags or \
+                    'capacity_map' in params or 'growth_map' in params or \
+                    (function != 'skellam' and 'capacity' not in params):
+                raise UnsupportedModelException("r.mdig.growth options")
+            in_name = in_name.lower()
+        elif command == 'r.mdig.recruit':
+            if (in_name, out_name) != ('from', 'to'):
+                raise UnsupportedModelException("r.mdig.recruit between maps")
+            return
+        if (in_name, out_name) != ('input', 'output'):
+            raise UnsupportedModelException("event %s input/output" % command)
+
+    def get_map(self, name):
+        """ Read a parameter map, keeping it for the rest of the replicate """
+        if name not in self.maps:
+            self.maps[name] = self.grass_i.read_raster(name, null=None).filled(numpy.nan)
+        return self.maps[name][self.window]
+
+    def value_or_map(self, value):
+        try:
+            return float(value)
+        except ValueError:
+            return self.get_map(value)
+
+    def resolve_params(self, e, is_pop):
+        """ Get the parameters of an event as strings, with True for flags """
+        params = {}
+        for p_name, (p_type, p_value) in e.get_params(is_pop).items():
+            if p_type == "VAR":
+                p_value = self.instance.get_var(p_value)
+                if p_value is None: continue
+            elif p_type == "SEED":
+                # Use up the same random numbers as when running modules
+                p_value = self.rep.random.randint(-2.14748e+09, 2.14748e+09)
+            elif p_type == "FLAG":
+                p_value = True
+            params[p_name] = p_value
+        return params
+
+    def run_kernel(self, pop, p, integer):
+        return kernel_spread(pop, self.rng, self.res,
+                kernel=p.get('kernel', 'cauchy').lower(),
+                d_a=float(p.get('d_a', 0.0)), d_b=float(p.get('d_b', 1.0)),
+                frequency=float(p.get('frequency', 0.05)),
+                limit=float(p.get('limit', 0.0)),
+                min_dist=self.value_or_map(p.get('min', '0.0')),
+                agem=int(p.get('agem', 0)), boolean=bool(p.get('b')),
+                popdep=bool(p.get('p'))), integer
+
+    def run_localspread(self, pop, p, integer):
+        return local_spread(pop, self.res, self.value_or_map(p['spread']),
+                proportion=float(p.get('proportion', 1.0)),
+                boolean=bool(p.get('b'))), integer
+
+    def run_survival(self, pop, p, integer):
+        return survival(pop, self.rng, self.value_or_map(p['survival'])), integer
+
+    def run_growth(self, pop, p, integer):
+        g = p.get('growth', '1.0')
+        k = p.get('capacity')
+        return growth(pop, p.get('function', 'skellam'), float(g),
+                None if k is None else float(k), integer,
+                growth_is_int=is_int_literal(g),
+                capacity_is_int=k is None or is_int_literal(k)), integer
+
+    def run_recruit(self, pop, p, integer):
+        mortality = p.get('mortality', p.get('mortalitymap', '0.0'))
+        out = recruit(pop, self.value_or_map(mortality))
+        return out, integer and is_int_literal(mortality)
+
+    def run_agepop(self, pop, p, integer):
+        return age_pop(pop), integer
+
+    event_handlers = {
+        'r.mdig.kernel': run_kernel,
+        'r.mdig.localspread': run_localspread,
+        'r.mdig.survival': run_survival,
+        'r.mdig.growth': run_growth,
+        'r.mdig.recruit': run_recruit,
+        'r.mdig.agepop': run_agepop,
+    }
+
+    def write_outputs(self, pops, t):
+        import outputformats
+        for l in self.instance.listeners:
+            if not isinstance(l, outputformats.RasterOutput):
+                continue
+            if self.model.interval_modulus(l.interval, t) != 0:
+                continue
+            if l.lifestage in pops:
+                fn = l.create_filename(self.rep)
+                fn += "_ls_" + l.lifestage + "_" + repr(t)
+                self.log.debug("Writing raster %s" % fn)
+                pop = pops[l.lifestage]
+                self.grass_i.write_raster(pop, fn)
+                self.rep.add_completed_raster_map(t, l.lifestage, fn, l.interval)
+        self.rep.update_time_stamp()
+
+    def run(self):
+        rep = self.rep
+        exp = self.model
+        region = self.grass_i.get_region_info()
+        self.res = (region['nsres'], region['ewres'])
+        self.rng = numpy.random.RandomState(rep.get_seed() % (2 ** 32))
+
+        pops = {}
+        integer = {}
+        for ls_id in exp.get_lifestage_ids():
+            name = rep.initial_maps[ls_id].get_map_filename()
+            pops[ls_id] = self.grass_i.read_raster(name, null=None).filled(numpy.nan)
+            integer[ls_id] = self.grass_i.map_index.find(name, ['fcell']) is None
+
+        period = exp.get_period()
+        schedule = exp.get_phenology_schedule(self.instance.r_id)
+        for t in range(period[0], period[1] + 1):
+            rep.current_t = t
+            profiler.set_context(timestep=t)
+            self.log.log(logging.INFO, "t=%d", t)
+            for current_interval, p_lifestages in schedule:
+                for lifestage in p_lifestages:
+                    ls_key = lifestage.name
+                    # Only process the area the events can reach
+                    window = active_window(pops[ls_key],
+                            lifestage.get_reach(rep), self.res)
+                    pop = pops[ls_key]
+                    if window is not None:
+                        self.window = window
+                        pop = pop[window]
+                    for e in lifestage.events:
+                        params = self.resolve_params(e, lifestage.populationBased)
+                        handler = self.event_handlers[e.get_command()]
+                        pop, integer[ls_key] = handler(self, pop, params,
+                                integer[ls_key])
+                    if window is not None:
+                        self.window = (slice(None), slice(None))
+                        pops[ls_key] = numpy.empty(pops[ls_key].shape)
+                        pops[ls_key].fill(numpy.nan)
+                        pops[ls_key][window] = pop
+                    else:
+                        pops[ls_key] = pop
+            self.write_outputs(pops, t)
@@ -0,0 +1,121 @@
+"""
+Profiling of the external commands MDiG runs.
+
+When enabled, every command run through the GRASS interface is recorded with
+the module name, the wall time it took, the bytes sent to and read from it,
+and what the simulation was doing at the time (instance, replicate, timestep,
+lifestage and event).
+"""
+import contextlib
+import csv
+
+
+class CommandProfiler(object):
+    """ Aggregates command timings by module and simulation context """
+
+    context_keys = ('instance', 'replicate', 'timestep', 'lifestage', 'event')
+    stat_keys = ('calls', 'seconds', 'bytes_in', 'bytes_out')
+
+    def __init__(self):
+        self.enabled = False
+        self.context = dict.fromkeys(self.context_keys)
+        # (module, instance, replicate, ...) -> [calls, seconds, in, out]
+        self.stats = {}
+
+    def reset(self):
+        self.context = dict.fromkeys(self.context_keys)
+        self.stats = {}
+
+    def set_context(self, **kwargs):
+        """ Set part of the current context, e.g. set_context(timestep=1) """
+        for k in kwargs:
+            if k not in self.context_keys:
+                raise KeyError("Unknown profile context '%s'" % k)
+        self.context.update(kwargs)
+
+    @contextlib.contextmanager
+    def scope(self, **kwargs):
+        """ Set part of the context for the duration of a with block """
+        old_context = dict(self.context)
+        self.set_context(**kwargs)
+        try:
+            yield
+        finally:
+            self.context = old_context
+
+    def record(self, module, elapsed, bytes_in=0, bytes_out=0):
+        if not self.enabled:
+            return
+        key = (module,) + tuple([self.context[k] for k in self.context_keys])
+        s = self.stats.get(key)
+        if s is None:
+            s = self.stats[key] = [0, 0.0, 0, 0]
+        s[0] += 1
+        s[1] += elapsed
+        s[2] += bytes_in
+        s[3] += bytes_out
+
+    def merge(self, stats):
+        """ Add the stats of another profiler, e.g. one in a worker process """
+        for key, s in stats.iteritems():
+            t = self.stats.setdefault(key, [0, 0.0, 0, 0])
+            for i in range(len(s)):
+                t[i] += s[i]
+
+    def module_totals(self):
+        """ Return a list of (module, calls, seconds, bytes_in, bytes_out)
+        ordered by the total time spent in each module, longest first """
+        totals = {}
+        for key, s in self.stats.iteritems():
+            t = totals.setdefault(key[0], [0, 0.0, 0, 0])
+            for i in range(len(s)):
+                t[i] += s[i]
+        result = [(module,) + tuple(t) for module, t in totals.iteritems()]
+        result.sort(key=lambda x: -x[2])
+        return result
+
+    def format_table(self, limit=None):
+        totals = self.module_totals()
+        total_time = sum([x[2] for x in totals])
+        lines = ["%-20s %8s %10s %10s %6s %12s %12s" % ("module", "calls",
+            "total(s)", "mean(s)", "%", "bytes in", "bytes out")]
+        for module, calls, seconds, b_in, b_out in totals[:limit]:
+            pc = 0.0
+            if total_time > 0:
+                pc = 100.0 * seconds / total_time
+            lines.append("%-20s %8d %10.2f %10.4f %6.1f %12d %12d" % (module,
+                calls, seconds, seconds / calls, pc, b_in, b_out))
+        lines.append("Total command time: %.2fs" % total_time)
+        return '\n'.join(lines)
+
+    def _rows(self):
+        rows = []
+        for key in sorted(self.stats.keys()):
+            rows.append(list(key) + self.stats[key])
+        return rows
+
+    def write_csv(self, filename):
+        """ Write a row for every module and context combination """
+        f = open(filename, 'wb')
+        try:
+            writer = csv.writer(f)
+            writer.writerow(('module',) + self.context_keys + self.stat_keys)
+            for row in self._rows():
+                writer.writerow(['' if x is None else x for x in row])
+        finally:
+            f.close()
+
+    def write_json(self, filename):
+        import simplejson as json
+        keys = ('module',) + self.context_keys + self.stat_keys
+        modules = [dict(zip(('module',) + self.stat_keys, x))
+                for x in self.module_totals()]
+        calls = [dict(zip(keys, x)) for x in self._rows()]
+        f = open(filename, 'w')
+        try:
+            json.dump({'modules': modules, 'calls': calls}, f, indent=1)
+        finally:
+            f.close()
+
+
+profiler = CommandProfiler()
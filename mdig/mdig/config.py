@@ -146,6 +146,11 @@ class MDiGConfig(ConfigObj):
             'background_map': 'nz_DEM',
             'output_width': 480,
             'output_height': 640
+        },
+        'PERFORMANCE': {
+            # Send GRASS commands through one long running shell instead of
+            # starting a new shell for each
+            'persistent_session': "true"
         }
     }
 
@@ -175,6 +180,11 @@ class MDiGConfig(ConfigObj):
     analysis_add_to_xml = True
     
     time = None
+    # Timesteps between replicate checkpoints, 0 to never checkpoint
+    checkpoint_interval = 0
+    # Shrink the region to around the populations when running events
+    # that can only move them a limited distance
+    active_area = True
     
     model_file = None
     action_keyword = None
@@ -21,6 +21,41 @@ import string
 import grass
 from mdig.tempresource import trm
 
+def format_params(params):
+    """ Format a dictionary of parameter values as command line arguments,
+    where a value of "FLAG" is a flag """
+    args = ""
+    for p_name, value in params.items():
+        if value == "FLAG":
+            args += (" -" + p_name)
+        else:
+            args += (" " + p_name + "=" + str(value))
+    return args
+
+
+class CommandTemplate(object):
+    """
+    An event's command for a particular instance, with every parameter that
+    is the same each time the event runs already filled in.
+
+    slots is a list of (name, type, value) for the parameters that are filled
+    in when the event runs: the IN and OUT maps, SEED and REPORT_FILE, and
+    VARs that a treatment of the instance's strategy can alter, where value
+    is the variable id and instance value. strategy is the instance's
+    management strategy, or None.
+    """
+
+    def __init__(self, command, slots, strategy):
+        self.command = command
+        self.slots = tuple(slots)
+        self.strategy = strategy
+
+    def fill(self, params):
+        """ Return the command string with the dynamic parameters in params
+        added """
+        return self.command + format_params(params) + " "
+
+
 class Event(object):
     """
     The Event class represents the use of a singular module or command within
@@ -33,6 +68,8 @@ class Event(object):
         self.log = logging.getLogger("mdig.event")
         self.xml_node = node
         self.fixed_input = None
+        # (instance, is_pop) -> CommandTemplate
+        self.templates = {}
 
     def get_command(self):
         """ Get the module/command name """
@@ -106,53 +143,132 @@ class Event(object):
                     self.fixed_input = node.text.strip()
         return params
 
+    # Modules that only change populations within each cell
+    local_commands = ['r.mdig.survival', 'r.mdig.growth', 'r.mdig.recruit',
+            'r.mdig.agepop']
+    # Modules that move populations no further than a parameter's value
+    reach_params = {
+        'r.mdig.localspread': 'spread',
+        'r.mdig.kernel': 'limit',
+    }
+
+    def get_reach(self, rep, is_pop):
+        """ How far, in map units, the event can move populations in the
+        replicate rep, or None if there's no limit or it isn't known. """
+        command = self.get_command()
+        params = self.get_params(is_pop)
+        if self.fixed_input is not None:
+            return None
+        if command in self.local_commands:
+            return 0.0
+        if self.reach_params.get(command) not in params:
+            return None
+        p_type, value = params[self.reach_params[command]]
+        if p_type == "VAR":
+            s = rep.instance.experiment.get_management_strategy(rep.instance.strategy)
+            if s is not None:
+                s.set_instance(rep.instance)
+                if s.get_treatments_for_param(value, rep.current_t):
+                    return None
+            value = rep.instance.get_var(value)
+        elif p_type != "VALUE":
+            return None
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            # Could be a map of values
+            return None
+        if value <= 0.0:
+            # For r.mdig.kernel this means no limit
+            return None
+        return value
+
+    def get_template(self, instance, is_pop):
+        """ Get the CommandTemplate of the event for instance, compiling it
+        the first time it's needed """
+        key = (instance, is_pop)
+        if key not in self.templates:
+            self.templates[key] = self.compile(instance, is_pop)
+        return self.templates[key]
+
+    def compile(self, instance, is_pop):
+        """ Compile the event's parameters for instance into a
+        CommandTemplate """
+        template_p = self.get_params(is_pop,None)
+        # Parameter names for input and output maps
+        in_param = self.get_input_name()
+        if in_param is not None:
+            template_p[in_param] = ("IN", None)
+        out_param = self.get_output_name()
+        if out_param is not None:
+            template_p[out_param] = ("OUT", None)
+
+        s = instance.experiment.get_management_strategy(instance.strategy)
+        treated_vars = set()
+        if s is not None:
+            for t in s.get_treatments():
+                treated_vars.update([p_value for p_type, p_value in
+                    template_p.values() if p_type == "VAR" and
+                    t.affects_var(p_value)])
+
+        p = {}
+        slots = []
+        for p_name, value in template_p.items():
+            p_type, p_value = value
+            if p_type == "VAR":
+                instance_value = instance.get_var(p_value)
+                if p_value in treated_vars:
+                    slots.append((p_name, p_type, (p_value, instance_value)))
+                elif instance_value:
+                    p[p_name]=instance_value
+                    self.log.debug("Variable %s has value %s for this instance" %
+                            (p_name, instance_value))
+                else:
+                    self.log.debug("Variable %s has None value for this instance" %
+                            p_name)
+            elif p_type in ["IN", "OUT", "SEED", "REPORT_FILE"]:
+                slots.append((p_name, p_type, p_value))
+            elif p_type in ["VALUE", "MAP"]:
+                p[p_name] = p_value
+            elif p_type == "FLAG":
+                p[p_name] = "FLAG"
+            else: 
+                raise Exception("Unknown parameter type %s" % p_type)
+        return CommandTemplate(self.get_command() + format_params(p), slots, s)
+
     def run(self, in_name, out_name, rep, is_pop):
         """
         Run the event using in_name as the input map and out_name as the output map. 
         """
-        template_p = self.get_params(is_pop,None)
+        template = self.get_template(rep.instance, is_pop)
         p = {}
         
         # If this event has a fixed input specified
         if self.fixed_input is not None:
             in_name = self.fixed_input
 
-        # Parameter names for input and output maps
-        in_param = self.get_input_name()
-        if in_param is not None:
-            template_p[in_param] = ("IN", in_name)
-        out_param = self.get_output_name()
-        if out_param is not None:
-            template_p[out_param] = ("OUT", out_name)
-
         # Some commands report some interesting information to aggregate,
         # like r.mdig.survival's AREA_EVALUATED
         report_file = None
 
-        s_name = rep.instance.strategy
-        s = rep.instance.experiment.get_management_strategy(s_name)
+        s = template.strategy
         # TODO strategies should be pre initialised with instances
         if s is not None:
             s.set_instance(rep.instance)
-        for p_name, value in template_p.items():
-            p_type, p_value = value
-            # print 'name is', p_name,
-            # print 'value is', value
+        for p_name, p_type, p_value in template.slots:
             if p_type == "VAR":
-                instance_value = rep.instance.get_var(p_value)
+                var_key, instance_value = p_value
                 instance_map = None
-                treatments = []
-                if s:
-                    treatments = s.get_treatments_for_param(p_value,rep.current_t)
-                    if treatments:
-                        self.log.debug("treatments for variable %s are: %s" % (p_value, repr(treatments)))
-                        # TODO support blending of multiple treatments on param
-                        # (move below operations from treatment to strategy)
-                        assert len(treatments) == 1, "MDiG does not currently support multiple treatments to a parameter"
-                        instance_map = treatments[0].get_variable_map(p_value, instance_value, rep)
-                        if instance_map is None:
-                            instance_value = treatments[0].get_altered_variable_value(p_value,instance_value)
-                            assert instance_value is not None
+                treatments = s.get_treatments_for_param(var_key,rep.current_t)
+                if treatments:
+                    self.log.debug("treatments for variable %s are: %s" % (var_key, repr(treatments)))
+                    # TODO support blending of multiple treatments on param
+                    # (move below operations from treatment to strategy)
+                    assert len(treatments) == 1, "MDiG does not currently support multiple treatments to a parameter"
+                    instance_map = treatments[0].get_variable_map(var_key, instance_value, rep)
+                    if instance_map is None:
+                        instance_value = treatments[0].get_altered_variable_value(var_key,instance_value)
+                        assert instance_value is not None
                 if instance_value:
                     p[p_name]=instance_value
                     self.log.debug("Variable %s has value %s for this instance" %
@@ -164,19 +280,17 @@ class Event(object):
                 else:
                     self.log.debug("Variable %s has None value for this instance" %
                             p_name)
+            elif p_type == "IN":
+                p[p_name] = in_name
+            elif p_type == "OUT":
+                p[p_name] = out_name
             elif p_type == "SEED":
                 p[p_name] = rep.random.randint(-2.14748e+09,2.14748e+09)
             elif p_type == "REPORT_FILE":
                 report_file = trm.temp_filename(prefix='mdig_event_report')
                 p[p_name] = report_file
-            elif p_type in ["VALUE", "MAP", "IN", "OUT"]:
-                p[p_name] = p_value
-            elif p_type == "FLAG":
-                p[p_name] = "FLAG"
-            else: 
-                raise Exception("Unknown parameter type %s" % p_type)
         
-        cmd=self.create_cmd_string(p)
+        cmd=template.fill(p)
         
         grass.get_g().remove_map(out_name)
         grass.get_g().run_command(cmd)
@@ -212,10 +326,4 @@ class Event(object):
         """
         Create an actual command line string to run in GRASS
         """
-        cmd = self.get_command()
-        for p_name, value in params.items():
-            if value == "FLAG":
-                cmd += (" -" + p_name)
-            else:
-                cmd += (" " + p_name + "=" + str(value))
-        return cmd + " "
+        return self.get_command() + format_params(params) + " "
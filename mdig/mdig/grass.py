@@ -21,15 +21,24 @@
 import sys
 import os
 import shutil
+import contextlib
 import logging
-import random
 import re
+import pipes
 import subprocess
 from subprocess import Popen
 import StringIO
 import tempfile
+import hashlib
+import math
+import threading
+import time
+
+import numpy
 
 from mdig.tempresource import trm
+from mdig import sparse
+from mdig.commandprofile import profiler
 
 class MapNotFoundException (Exception):
     def __init__(self, _map_name=""):
@@ -71,6 +80,368 @@ def get_g(create=True):
             logging.getLogger("mdig.grass").debug("No GRASSInterface and not creating new one")
     return grass_i
 
+
+class GRASSSession:
+    """ A long running shell that GRASS commands are fed through.
+
+    Forking a new shell for every GRASS call dominates the run time of a
+    replicate, so instead commands are written to a single /bin/sh process.
+    Each command has its stdin, stdout and stderr redirected to files in a
+    private working directory, and the shell echoes a marker line with the
+    exit status once the command completes. Environment variables that have
+    changed in this process since the previous command are exported to the
+    shell before the command is run.
+    """
+    marker = "__mdig_session_done__"
+    valid_env_name = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+    def __init__(self, shell="/bin/sh"):
+        self.shell = shell
+        self.log = logging.getLogger("mdig.grass")
+        self.process = None
+        self.work_dir = None
+        self.shell_err = None
+        self.env = {}
+        self.lock = threading.Lock()
+
+    def start(self):
+        self.work_dir = tempfile.mkdtemp(prefix="mdig-session-")
+        self.in_fn = os.path.join(self.work_dir, "stdin")
+        self.out_fn = os.path.join(self.work_dir, "stdout")
+        self.err_fn = os.path.join(self.work_dir, "stderr")
+        self.shell_err_fn = os.path.join(self.work_dir, "shell_stderr")
+        self.shell_err = open(self.shell_err_fn, 'w')
+        self.process = Popen([self.shell], stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE, stderr=self.shell_err, close_fds=True)
+        self.env = dict(os.environ)
+        self.log.debug("Started GRASS command session (pid %d) in %s" %
+                (self.process.pid, self.work_dir))
+
+    def is_alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def close(self):
+        if self.process is not None:
+            if self.process.poll() is None:
+                try:
+                    self.process.stdin.write("exit\n")
+                    self.process.stdin.close()
+                except IOError:
+                    pass
+                self.process.wait()
+            self.process = None
+        if self.shell_err is not None:
+            self.shell_err.close()
+            self.shell_err = None
+        if self.work_dir is not None and os.path.isdir(self.work_dir):
+            shutil.rmtree(self.work_dir)
+        self.work_dir = None
+
+    def _env_updates(self):
+        """ Shell statements to bring the session environment in line with
+        os.environ """
+        lines = []
+        for k, v in os.environ.items():
+            if self.env.get(k) != v and self.valid_env_name.match(k):
+                lines.append("%s=%s; export %s" % (k, pipes.quote(v), k))
+        for k in self.env:
+            if k not in os.environ and self.valid_env_name.match(k):
+                lines.append("unset %s" % k)
+        self.env = dict(os.environ)
+        return lines
+
+    def _read(self, fn):
+        try:
+            f = open(fn)
+            try:
+                return f.read()
+            finally:
+                f.close()
+        except IOError:
+            return ''
+
+    def run(self, cmd, to_input=''):
+        """ Run cmd, either a shell command string or an argument list, in
+        the session. Returns a tuple of (exit code, stdout, stderr). """
+        if isinstance(cmd, (list, tuple)):
+            cmd = ' '.join([pipes.quote(str(x)) for x in cmd])
+        self.lock.acquire()
+        try:
+            if not self.is_alive():
+                self.close()
+                self.start()
+            f = open(self.in_fn, 'w')
+            f.write(to_input or '')
+            f.close()
+            for fn in (self.out_fn, self.err_fn):
+                if os.path.exists(fn):
+                    os.remove(fn)
+            script = self._env_updates()
+            script.append("{ %s\n} < %s > %s 2> %s" % (cmd,
+                pipes.quote(self.in_fn), pipes.quote(self.out_fn),
+                pipes.quote(self.err_fn)))
+            script.append('echo "%s $?"' % self.marker)
+            ret = None
+            try:
+                self.process.stdin.write('\n'.join(script) + '\n')
+                self.process.stdin.flush()
+                while True:
+                    line = self.process.stdout.readline()
+                    if not line:
+                        break
+                    if line.startswith(self.marker):
+                        ret = int(line.split()[1])
+                        break
+            except IOError:
+                pass
+            stdout = self._read(self.out_fn)
+            stderr = self._read(self.err_fn)
+            if ret is None:
+                # The shell died, either because the command called exit or
+                # because of a syntax error. Report it and start a new shell
+                # next time.
+                ret = self.process.wait() or 127
+                stderr += self._read(self.shell_err_fn)
+                self.log.debug("GRASS command session exited while running: %s" % cmd)
+                self.close()
+            return ret, stdout, stderr
+        finally:
+            self.lock.release()
+
+
+class MapIndex:
+    """ In-process index of the maps in the mapsets of the current location.
+
+    This replaces running g.findfile for each element type whenever we
+    check whether a map exists. The element directories of a mapset (cell,
+    fcell, vector, windows) are listed once and the names cached. A listing
+    is reused while the directory's mtime is unchanged, so maps created or
+    removed outside of MDiG are still noticed. Since mtimes can have a
+    resolution of a second, a listing taken within a second of the directory
+    changing isn't trusted and is refreshed on the next lookup.
+    """
+    element_types = {
+            "cell": "raster",
+            "fcell": "raster",
+            "vector": "vector",
+            "windows": "windows"
+            }
+    map_elements = [ "cell", "fcell", "vector" ]
+
+    def __init__(self, grass_i):
+        self.grass_i = grass_i
+        # element dir -> (mtime, time of listing, set of names)
+        self.listings = {}
+
+    def _element_dir(self, mapset, element):
+        return os.path.join(self.grass_i.get_mapset_full_path(mapset), element)
+
+    def get_names(self, mapset, element):
+        """ Get the set of map names for element in mapset """
+        e_dir = self._element_dir(mapset, element)
+        try:
+            mtime = os.stat(e_dir).st_mtime
+        except OSError:
+            self.listings.pop(e_dir, None)
+            return set()
+        listing = self.listings.get(e_dir)
+        if listing is not None and listing[0] == mtime and \
+                listing[1] - mtime >= 1.0:
+            return listing[2]
+        scan_time = time.time()
+        names = set([n for n in os.listdir(e_dir) if not n.startswith('.')])
+        self.listings[e_dir] = (mtime, scan_time, names)
+        return names
+
+    def get_search_path(self):
+        """ The mapsets searched when a map name has no mapset, which is the
+        mapset's SEARCH_PATH or the current mapset and PERMANENT if it
+        doesn't exist. """
+        current = self.grass_i.get_mapset()
+        sp_fn = os.path.join(self.grass_i.get_mapset_full_path(current), "SEARCH_PATH")
+        mapsets = []
+        if os.path.isfile(sp_fn):
+            f = open(sp_fn)
+            mapsets = [x.strip() for x in f.readlines() if len(x.strip()) > 0]
+            f.close()
+        if not mapsets:
+            mapsets = [current, "PERMANENT"]
+        return mapsets
+
+    def find(self, name, elements=None, mapset=None):
+        """ Find the first element and mapset that a map called name is in.
+
+        name can include an @mapset component. Returns a tuple of (element,
+        mapset) or None if the map can't be found.
+        """
+        if elements is None:
+            elements = self.map_elements
+        if "@" in name:
+            name, mapset = name.split("@", 1)
+        if mapset:
+            mapsets = [mapset]
+        else:
+            mapsets = self.get_search_path()
+        for e in elements:
+            for m in mapsets:
+                if name in self.get_names(m, e):
+                    return e, m
+        return None
+
+    def add(self, name, element="cell", mapset=None):
+        """ Record that a map has been created """
+        mapset = mapset or self.grass_i.get_mapset()
+        listing = self.listings.get(self._element_dir(mapset, element))
+        if listing is not None:
+            listing[2].add(name)
+
+    def remove(self, name, mapset=None):
+        """ Record that a map has been removed """
+        mapset = mapset or self.grass_i.get_mapset()
+        for e in self.element_types:
+            listing = self.listings.get(self._element_dir(mapset, e))
+            if listing is not None:
+                listing[2].discard(name)
+
+    def clear(self):
+        self.listings = {}
+
+
+class MapcalcBatch:
+    """ Collects r.mapcalc assignments and runs them in one r.mapcalc call,
+    so that each input map is read once per batch instead of once per
+    statement.
+
+    r.mapcalc evaluates all the statements of a call together, row by row,
+    so one statement can't read a map that an earlier statement in the same
+    batch writes. Instead, references to such maps are replaced by the
+    expression that computes them. Statements added with write=False are
+    only used like this and don't produce a map, which lets callers skip
+    writing intermediate maps entirely.
+    """
+
+    def __init__(self, grass_i):
+        self.grass_i = grass_i
+        # list of (map name, expression, write)
+        self.statements = []
+
+    def _inline(self, expression):
+        for name, expr, write in self.statements:
+            pattern = r'(?<![\w.@])"?%s"?(?![\w.@])' % re.escape(name)
+            expression = re.sub(pattern, lambda m: "(" + expr + ")", expression)
+        return expression
+
+    def add(self, map_name, expression, write=True):
+        expression = self._inline(expression)
+        # a later assignment to the same map replaces the earlier one
+        self.statements = [x for x in self.statements if x[0] != map_name]
+        self.statements.append((map_name, expression, write))
+
+    def get_statements(self):
+        return ['"%s" = %s' % (name, expr)
+                for name, expr, write in self.statements if write]
+
+    def run(self):
+        statements = self.get_statements()
+        if statements:
+            self.grass_i.run_command("r.mapcalc",
+                    to_input='\n'.join(statements) + "\nend\n")
+            for name, expr, write in self.statements:
+                if write: self.grass_i.map_index.add(name)
+        self.statements = []
+
+
+def univariate_stats(data):
+    """ Calculate the statistics that r.univar -g reports for a masked
+    array, where masked cells are null. See sparse.univariate_stats. """
+    data = numpy.ma.masked_invalid(data)
+    return sparse.univariate_stats(data.compressed(), data.size)
+
+
+# Value null cells are given when writing rasters, since r.in.bin doesn't
+# recognise NaN as null
+NULL_VALUE = -1.0e38
+
+# Element files of a raster map that hold its data. GRASS writes a map's data
+# to a temporary file and renames it into place, so hard links to these are
+# never changed when either map is written. The other element files are small
+# and can be rewritten in place (e.g. colr by r.colors), so they are copied.
+raster_data_files = [os.path.join("cell", "%s"), os.path.join("fcell", "%s"),
+        os.path.join("cell_misc", "%s", "null")]
+# Mapset elements that hold the files of a raster map
+raster_elements = ["cell", "fcell", "cellhd", "cats", "colr", "hist",
+        "cell_misc"]
+
+def _raster_files(mapset_dir, name):
+    """ The element files of raster name in mapset_dir, relative to the
+    mapset dir with the name replaced by %s, or None if the map is a reclass
+    or has no header. """
+    cellhd = os.path.join(mapset_dir, "cellhd", name)
+    try:
+        f = open(cellhd)
+        try:
+            if f.readline().startswith("reclass"):
+                return None
+        finally:
+            f.close()
+    except IOError:
+        return None
+    files = []
+    for e in raster_elements:
+        path = os.path.join(mapset_dir, e, name)
+        if os.path.isdir(path):
+            files.extend([os.path.join(e, "%s", f) for f in os.listdir(path)])
+        elif os.path.exists(path):
+            files.append(os.path.join(e, "%s"))
+    return files
+
+def link_raster_files(src_dir, src, dest_dir, dest):
+    """ Duplicate the element files of raster src in mapset dir src_dir as
+    raster dest in dest_dir, hard linking the data files and copying the rest.
+
+    Returns False, having left nothing behind, if the map is a reclass, dest
+    already has files, or the files can't be linked (e.g. they are on another
+    file system). """
+    files = _raster_files(src_dir, src)
+    if files is None:
+        return False
+    created = []
+    try:
+        for f in files:
+            dest_path = os.path.join(dest_dir, f % dest)
+            if os.path.exists(dest_path):
+                raise OSError("%s already exists" % dest_path)
+            if not os.path.isdir(os.path.dirname(dest_path)):
+                os.makedirs(os.path.dirname(dest_path))
+            if f in raster_data_files:
+                os.link(os.path.join(src_dir, f % src), dest_path)
+            else:
+                shutil.copyfile(os.path.join(src_dir, f % src), dest_path)
+            created.append(dest_path)
+    except (OSError, IOError):
+        for path in created:
+            os.remove(path)
+        return False
+    return True
+
+def rename_raster_files(mapset_dir, src, dest):
+    """ Rename the element files of raster src in mapset_dir to dest.
+
+    Returns False, having changed nothing, if the map is a reclass or dest
+    already has files. """
+    files = _raster_files(mapset_dir, src)
+    if files is None:
+        return False
+    for e in raster_elements:
+        if os.path.exists(os.path.join(mapset_dir, e, dest)):
+            return False
+    for e in raster_elements:
+        path = os.path.join(mapset_dir, e, src)
+        if os.path.exists(path):
+            os.rename(path, os.path.join(mapset_dir, e, dest))
+    return True
+
+
 class GRASSInterface:
 
     grass_var_names = [
@@ -91,6 +462,8 @@ class GRASSInterface:
     # subset of grass vars that indicate we are in GRASS
     grass_indicators = [ "GISRC", "GISBASE", "GRASS_GNUPLOT", "GRASS_HTML_BROWSER" ]
     old_region="mdig_temp_region"
+    # Maximum number of maps to pass to one g.remove
+    remove_chunk_size = 100
     
     def __init__(self):
         self.config = config.get_config()
@@ -112,6 +485,18 @@ class GRASSInterface:
         self.blank_map = None
         # Whether or not MDiG was started in pre-existing GRASS session
         self.in_grass_shell = False
+
+        # Long running shell that commands are sent to, if enabled
+        self.session = None
+        self.use_session = self.config['PERFORMANCE'].as_bool('persistent_session')
+        # GRASS module name -> [number of calls, total seconds]
+        self.command_times = {}
+        # Cache of which maps exist, used instead of g.findfile
+        self.map_index = MapIndex(self)
+        # Temporary maps left at exit are removed through us
+        trm.map_remover = self.remove_temp_maps
+        # Mapset WIND file -> what we know about the region it holds
+        self.region_cache = {}
         
         if not self.check_environment():
             self.log.debug("GRASS environment not detected, attempting setup of GRASS from config file")
@@ -214,7 +599,7 @@ class GRASSInterface:
         self.old_location = self.grass_vars['LOCATION_NAME']
         self.old_gisdbase = self.grass_vars['GISDBASE']
 
-    def init_pid_specific_files(self):
+    def init_pid_specific_files(self, parent_dir=None):
         pid = str(os.getpid())
         os.environ["GIS_LOCK"] = pid
 
@@ -222,7 +607,8 @@ class GRASSInterface:
         #export GRASS_VERSION="7.0.svn"
         os.environ["GIS_VERSION"] = self.get_version_from_dir()
 
-        self.pid_dir = tempfile.mkdtemp(prefix="grass6-mdig-" + str(pid) + "-")
+        self.pid_dir = tempfile.mkdtemp(prefix="grass6-mdig-" + str(pid) + "-",
+                dir=parent_dir)
         if self.pid_dir is None:
             raise EnvironmentException("Failed to create temporary directory")
 
@@ -231,6 +617,21 @@ class GRASSInterface:
         self._create_gis_rc_file(gisrc_fn)
         os.environ["GISRC"] = gisrc_fn
 
+    def init_worker(self):
+        """ Prepare the copy of this interface in a forked worker process.
+
+        The command session, GISRC file and GIS_LOCK belong to the parent
+        process, so the worker gets its own of each. The worker's files are
+        kept in the parent's pid_dir so that the parent removes them.
+        """
+        # Don't close the parent's session, just stop using it
+        self.session = None
+        self.displays = {}
+        self.region_cache = {}
+        self.map_index.clear()
+        self.init_pid_specific_files(self.pid_dir)
+        self.set_gis_env()
+
     def get_version_from_dir(self):
         if sys.platform == 'win32':
             # TODO - place this in config and make NSIS script write it
@@ -281,12 +682,11 @@ class GRASSInterface:
         """ Use g.gisenv to update gisrc file from environment variables """
         var_list = [ "GISDBASE", "LOCATION_NAME", "MAPSET" ]
         for v in var_list:
-            subprocess.Popen("g.gisenv set=%s=\"%s\"" % (v,self.grass_vars[v]),
-                    shell=True, stdout=subprocess.PIPE).communicate()[0]
+            self.pipe_command("g.gisenv set=%s=\"%s\"" % (v,self.grass_vars[v]))
 
     def get_gis_env(self):
         # sends command to GRASS session and returns result via stdout (piped)
-        output = subprocess.Popen("g.gisenv -n", shell=True, stdout=subprocess.PIPE).communicate()[0]
+        output = self.pipe_command("g.gisenv -n")
         pre_range_data = StringIO.StringIO(output).readlines()
         ret = {}
         for line in pre_range_data:
@@ -329,12 +729,15 @@ class GRASSInterface:
             }
             if layer in colors:
                 cmd_string = 'r.colors map=%s rules=-' % map_name
+                start_time = time.time()
                 pcolor= subprocess.Popen(cmd_string,
                         shell=True, stdout=subprocess.PIPE, stdin=subprocess.PIPE)
                 rule_string = "0%% %d:%d:%d\n" % colors[layer][1]
                 rule_string += "100%% %d:%d:%d\n" % colors[layer][0]
                 rule_string += 'end'
-                stderr = pcolor.communicate(rule_string)[1]
+                stdout, stderr = pcolor.communicate(rule_string)
+                self.record_command_time(cmd_string, time.time() - start_time,
+                        len(rule_string), len(stdout or '') + len(stderr or ''))
                 if pcolor.returncode != 0:
                     raise GRASSCommandException(cmd_string, stderr,
                             pcolor.returncode)
@@ -344,28 +747,42 @@ class GRASSInterface:
         self.run_command('d.rast map=%s -x -o bg=white' % map_name, logging.DEBUG)
         os.environ['GRASS_PNG_READ']="TRUE"
 
-    def get_univariate_stats(self, maps):
-        results={}
+    def get_univariate_stats(self, maps, jobs=1):
+        """ Calculate the same statistics as r.univar for each map in the
+        dict maps, returning a dict with the same keys.
+
+        Each map is read into an array with a single r.out.bin of the
+        region and the statistics are calculated in-process, rather than
+        starting r.univar for every map. With jobs greater than 1, that many
+        maps are read and processed at once.
+        """
         res = self.get_current_resolution()
-        for t,m in maps.items():
-            cmd = "r.univar -g map=%s" % m
-            p=Popen(cmd, shell=True, stdout=subprocess.PIPE)
-            output,stderr=p.communicate()
-            if p.returncode != 0:
-                raise GRASSCommandException(cmd, stderr, p.returncode)
-            parsed=re.findall("(\w+)=([\d.]+(e-?[\d]+)?)\n",output)
-            results[t] = dict([(x[0],float(x[1])) for x in parsed])
+        items = maps.items()
+
+        def map_stats(item):
+            stats = univariate_stats(self.read_raster(item[1], null=None,
+                    direct=True))
             # We add in area for convenience
-            if 'n' in results[t]:
-                results[t]['area'] = results[t]['n'] * res * res
-        return results
+            stats['area'] = stats['n'] * res * res
+            return item[0], stats
+
+        if jobs > 1 and len(items) > 1:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(min(jobs, len(items)))
+            try:
+                results = pool.map(map_stats, items)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [map_stats(x) for x in items]
+        return dict(results)
 
     def get_raster_range(self, m):
         cmd = "r.info -r map=%s" % m
-        p=Popen(cmd, shell=True, stdout=subprocess.PIPE)
-        output,stderr=p.communicate()
-        if p.returncode != 0:
-            raise GRASSCommandException(cmd, stderr, p.returncode)
+        ret, output, stderr = self._exec(cmd)
+        if ret != 0:
+            raise GRASSCommandException(cmd, stderr, ret)
         parsed=re.findall("(\w+)=(.+)\n",output)
         results = dict([(x[0],x[1]) for x in parsed])
         return results
@@ -374,9 +791,7 @@ class GRASSInterface:
         min_val = None
         max_val = None
         for m in maps:
-            cmd = "r.info -r map=%s" % m
-            p=Popen(cmd, shell=True, stdout=subprocess.PIPE)
-            output=p.communicate()[0]
+            output = self.pipe_command("r.info -r map=%s" % m)
             res=re.findall("(\w+)=([\d.]+(e-?[\d]+)?)\n",output)
             if len(res) == 0 or res[0][0] != 'min' or res[1][0] != 'max':
                 self.log.error("Failed to get raster range for %s. Output was:\n%s" % (m,output))
@@ -388,17 +803,14 @@ class GRASSInterface:
         one_third = (min_val - max_val) / 3.0 + min_val
         two_third = 2 * (min_val - max_val) / 3.0 + min_val
         # create full-scale color table for first map
-        pcolor = subprocess.Popen('r.colors map=%s rules=-' % maps[0], \
-                shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=subprocess.PIPE)
         rule_string = "%f blue\n" % (min_val)
         rule_string += "%f cyan\n" % (one_third)
         rule_string += "%f yellow\n" % (two_third)
         rule_string += "%f red\n" % (max_val)
-        output = pcolor.communicate(rule_string)[0]
+        output = self.pipe_command('r.colors map=%s rules=-' % maps[0], rule_string)
         # apply first map's color table to all other maps
         for i in range(1,len(maps)):
-            pcolor= subprocess.Popen('r.colors map=%s rast=%s' % (maps[i], maps[0]), \
-                    shell=True, stderr=subprocess.PIPE, stdout=subprocess.PIPE)
+            self.pipe_command('r.colors map=%s rast=%s' % (maps[i], maps[0]))
         return (min_val, max_val)
         
     def paint_grid(self, res):
@@ -569,50 +981,62 @@ class GRASSInterface:
         
         vector_prefix = "v____"
         cmd = 'v.in.ascii output=' + vector_prefix + name + ' cat=3'
-        if self.log.getEffectiveLevel() >= logging.DEBUG:
-            # Hide the v.in.ascii output unless FINE debuggins is on
-            p = Popen(cmd, shell=True, stdin=subprocess.PIPE, \
-                    stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        else:
-            p = Popen(cmd, shell=True, stdin=subprocess.PIPE)
-            
         sites_string=""
         for s in value:
             sites_string += ('%f|%f|%d\n' % s)
-        p.communicate(sites_string)
-        if p.returncode:
+        # v.in.ascii output is captured, and only shown if it fails
+        ret, stdout, stderr = self._exec(cmd, sites_string)
+        if ret:
             # @todo throw exception
-            pass
+            self.log.debug("v.in.ascii failed: " + stderr)
 
         self.run_command('v.to.rast input=%s%s output=%s use=cat --o' % \
                 (vector_prefix, name, name))
         self.remove_map('v____' + name)
         
     def copy_map(self, src, dest, overwrite=False):
+        """ Copy map src to dest in the current mapset.
+
+        Rasters are duplicated by hard linking their data files when they're
+        on the same file system, so the copy costs a few system calls instead
+        of rewriting the raster. Otherwise g.copy is used.
+        """
         if overwrite:
             self.remove_map(dest)
-        self.run_command('g.copy rast=%s,%s' % (src, dest), logging.DEBUG)
+        found = self.map_index.find(src, ["cell", "fcell"])
+        if found is None or not link_raster_files(
+                self.get_mapset_full_path(found[1]), src.split("@")[0],
+                self.get_mapset_full_path(), dest):
+            self.run_command('g.copy rast=%s,%s' % (src, dest), logging.DEBUG)
+        self.map_index.add(dest)
     
     def rename_map(self, src, dest, overwrite=False):
+        """ Rename map src to dest in the current mapset, by renaming the
+        element files of rasters directly, or with g.rename otherwise. """
         if overwrite: self.remove_map(dest)
-        self.run_command('g.rename rast=%s,%s' % (src, dest), logging.DEBUG)
+        found = self.map_index.find(src, ["cell", "fcell"],
+                mapset=self.get_mapset())
+        if found is None or not rename_raster_files(
+                self.get_mapset_full_path(), src, dest):
+            self.run_command('g.rename rast=%s,%s' % (src, dest), logging.DEBUG)
+        self.map_index.remove(src)
+        self.map_index.add(dest)
     
     def get_current_resolution(self):
-        output=Popen("g.region -p", shell=True, stdout=subprocess.PIPE).communicate()[0]
-        res=re.search("nsres:\s+(\d+)\newres:\s+(\d+)",output)
-        if res is None:
+        info = self.get_region_info()
+        if not isinstance(info.get('nsres'), float) or \
+                not isinstance(info.get('ewres'), float):
             # @todo replace with exception
-            self.log.error("Failed to get resolution, perhaps this is a latlong location? Output was:\n%s" % output)
+            self.log.error("Failed to get resolution, perhaps this is a latlong location? Region was:\n%s" % str(info))
             sys.exit(1)
         
         # @todo return tuple of (nsres, ewres)
-        return (float(res.groups()[0]) + float(res.groups()[1])) / 2
+        return (info['nsres'] + info['ewres']) / 2
 
     def raster_value_freq(self,mapname):
         cmd = "r.stats --q -c input=%s" % mapname
         self.log.debug("Getting raster stats with command: %s" % cmd)
-        p=Popen(cmd, shell=True, stdout=subprocess.PIPE)
-        output=p.communicate()[0]
+        output = self.pipe_command(cmd)
         res=re.findall("(\d+) (\d+)\n",output)
         if len(res) == 0:
             self.log.error("Failed to get raster stats. Output was:\n%s" % output)
@@ -620,7 +1044,53 @@ class GRASSInterface:
             
         return res
         
+    def _get_region_cache(self):
+        """ Get the cached region details for the current mapset.
+
+        The entry is emptied if the mapset's WIND file has changed since we
+        last looked at it, e.g. because something outside of MDiG set the
+        region.
+        """
+        wind_fn = os.path.join(self.get_mapset_full_path(), "WIND")
+        entry = self.region_cache.get(wind_fn)
+        stamp = self._get_wind_stamp(wind_fn)
+        if entry is None or entry['stamp'] != stamp or stamp is None:
+            entry = { 'stamp': stamp }
+            self.region_cache[wind_fn] = entry
+        return entry
+
+    def _get_wind_stamp(self, wind_fn):
+        """ Identify the state of a WIND file. The mtime may not change when
+        the file is rewritten within its resolution, and a new region is
+        often the same size, so the contents are hashed too. WIND is only a
+        few hundred bytes. """
+        try:
+            st = os.stat(wind_fn)
+            f = open(wind_fn, 'rb')
+            try:
+                digest = hashlib.md5(f.read()).hexdigest()
+            finally:
+                f.close()
+            return (st.st_mtime, st.st_size, digest)
+        except (OSError, IOError):
+            return None
+
+    def _run_region_command(self, cmd, spec=None, info=None):
+        """ Run a g.region command that changes the region, and record what
+        the region now is. """
+        self.run_command(cmd)
+        wind_fn = os.path.join(self.get_mapset_full_path(), "WIND")
+        entry = { 'stamp': self._get_wind_stamp(wind_fn), 'spec': spec }
+        if info is not None:
+            entry['info'] = info
+        self.region_cache[wind_fn] = entry
+
     def set_region(self, a_region=None, raster=None):
+        """ Set the region to a named region, a Region, or to match a raster.
+
+        Nothing is run if we know the current region was already set the
+        same way and hasn't been changed since.
+        """
         name = None
         mapset = None
 
@@ -632,15 +1102,18 @@ class GRASSInterface:
             else:
                 name = a_region
 
-        # Now set region
+        # Work out the command to set the region
         if name:
-            self.log.debug("Setting region to %s", name)
             cmd = 'g.region region=%s' % name
             if mapset: cmd += "@" + mapset
-            ret = self.run_command(cmd)
+            spec = ('region', name, mapset)
+            self.log.debug("Setting region to %s", name)
         elif raster:
+            # rasters can be remade, so only skip if the raster hasn't
+            # changed either
+            cmd = 'g.region rast=%s' % raster
+            spec = ('raster', raster, self._get_raster_stamp(raster))
             self.log.debug("Setting region to match raster %s", raster)
-            ret = self.run_command('g.region rast=%s' % raster)
         else:
             extents = a_region.get_extents()
             command_string = 'g.region '
@@ -666,32 +1139,151 @@ class GRASSInterface:
             else:
                 self.log.warning("Region %s didn't define resolution" % a_region.id)
             
+            cmd = command_string + extent_string + res_str
+            spec = ('extents', extent_string, res_str)
             self.log.debug("Setting region using extents %s and res %s",
                     repr(extent_string), repr(res))
-            try:
-                ret = self.run_command(command_string + extent_string + res_str)
-            except GRASSCommandException, e:
+
+        if self._get_region_cache().get('spec') == spec and \
+                not (spec[0] == 'raster' and spec[2] is None):
+            self.log.debug("Region already set, skipping g.region")
+            return True
+        try:
+            self._run_region_command(cmd, spec)
+        except GRASSCommandException, e:
+            if not name and not raster:
                 self.log.error("Error setting region %s" % a_region.id)
                 self.log.error("stderr was %s" % str(e))
-                raise e
+            raise e
         return True
-                    
+
+    def _get_raster_stamp(self, raster):
+        """ mtime of a raster's header, or None if it can't be found """
+        found = self.map_index.find(raster, ["cell", "fcell"])
+        if found is None: return None
+        name = raster.split("@")[0]
+        hdr_fn = os.path.join(self.get_mapset_full_path(found[1]), "cellhd", name)
+        try:
+            return os.stat(hdr_fn).st_mtime
+        except OSError:
+            return None
+
+    @contextlib.contextmanager
+    def region_context(self, a_region=None, raster=None):
+        """ Context manager that sets the region for the duration of a with
+        block and then puts back the region that was there before.
+
+        This replaces saving the region to a named region and restoring it,
+        and if the region doesn't actually change nothing is run at all.
+        """
+        old_info = self.get_region_info()
+        old_spec = self._get_region_cache().get('spec')
+        self.set_region(a_region, raster)
+        try:
+            yield
+        finally:
+            if self._get_region_cache().get('info') != old_info:
+                keys = ['n', 's', 'e', 'w', 'rows', 'cols']
+                cmd = ['g.region'] + ['%s=%r' % (k, old_info[k]) for k in keys]
+                self._run_region_command(cmd, old_spec, old_info)
+
+    def get_occupied_extent(self, map_name):
+        """ Get the extent of the non-null cells of a raster, aligned to the
+        current region, as a dict with the keys n, s, e and w. Returns None
+        if the raster has no non-null cells. The region isn't changed. """
+        output = self.pipe_command("g.region -ug zoom=%s" % map_name)
+        extent = {}
+        for line in output.splitlines():
+            if '=' not in line: continue
+            k, v = line.strip().split('=', 1)
+            if k in ('n', 's', 'e', 'w'):
+                extent[k] = float(v)
+        if len(extent) != 4 or extent['n'] <= extent['s'] or \
+                extent['e'] <= extent['w']:
+            return None
+        return extent
+
+    @contextlib.contextmanager
+    def active_area_context(self, map_name, reach):
+        """ Context manager that shrinks the region to the non-null cells of
+        map_name, grown by reach map units, for the duration of a with block.
+
+        This is for running events that can't move populations further than
+        reach, where everything outside of the shrunken region stays null.
+        Maps made in the block only cover the shrunken region, but they're
+        read as null outside of it once the region is put back. If reach is
+        None, or the raster is empty, the region is left alone.
+        """
+        extent = None
+        if reach is not None:
+            extent = self.get_occupied_extent(map_name)
+        if extent is None:
+            yield
+            return
+        info = self.get_window(extent, reach)
+        old_info = self.get_region_info()
+        if (info['rows'], info['cols']) == (old_info['rows'], old_info['cols']):
+            yield
+            return
+        self.log.debug("Active area is %dx%d of %dx%d cells" % (info['rows'],
+            info['cols'], old_info['rows'], old_info['cols']))
+        with self._window_context(info, ('active', map_name, reach)):
+            yield
+
+    def get_window(self, extent, grow=0.0):
+        """ Get the region info for the part of the current region within
+        extent, grown by grow map units, with the row and column of its top
+        left cell in the current region as row_offset and col_offset. """
+        old_info = self.get_region_info()
+        info = dict(old_info)
+        ns = ew = 0.0
+        if grow:
+            # Grow by an extra cell, since distances are rounded to cells
+            ns = (math.ceil(grow / old_info['nsres']) + 1) * old_info['nsres']
+            ew = (math.ceil(grow / old_info['ewres']) + 1) * old_info['ewres']
+        info['n'] = min(old_info['n'], extent['n'] + ns)
+        info['s'] = max(old_info['s'], extent['s'] - ns)
+        info['e'] = min(old_info['e'], extent['e'] + ew)
+        info['w'] = max(old_info['w'], extent['w'] - ew)
+        info['rows'] = int(round((info['n'] - info['s']) / old_info['nsres']))
+        info['cols'] = int(round((info['e'] - info['w']) / old_info['ewres']))
+        info['row_offset'] = int(round((old_info['n'] - info['n']) / old_info['nsres']))
+        info['col_offset'] = int(round((info['w'] - old_info['w']) / old_info['ewres']))
+        return info
+
+    @contextlib.contextmanager
+    def _window_context(self, info, spec):
+        """ Context manager that sets the region to the window info, from
+        get_window, for the duration of a with block """
+        old_info = self.get_region_info()
+        old_spec = self._get_region_cache().get('spec')
+        keys = ['n', 's', 'e', 'w', 'rows', 'cols']
+        cmd = ['g.region'] + ['%s=%r' % (k, info[k]) for k in keys]
+        window = dict((k, v) for k, v in info.items() if not k.endswith('_offset'))
+        self._run_region_command(cmd, spec, window)
+        try:
+            yield
+        finally:
+            cmd = ['g.region'] + ['%s=%r' % (k, old_info[k]) for k in keys]
+            self._run_region_command(cmd, old_spec, old_info)
+
     def get_map_info(self,map_name):
         # Have to check all possible types of maps
-        map_types=[ "cell", "fcell", "dcell", "vector", "windows" ]
+        map_types=[ "cell", "fcell", "vector", "windows" ]
         
-        for t in map_types:
-            p=os.popen("g.findfile element=%s file=%s" % (t,map_name), 'r')
-            info = dict([tuple(x.split('=')) for x in p.readlines()])
-            for i in info.keys():
-                info[i]=info[i].strip("'\n")
-            
-            if len(info["name"]) > 0:
-                if t in ["cell","fcell","dcell"]:
-                    # Return raster sub types simply as "raster"
-                    t = "raster"
-                info["type"] = t
-                return info
+        found = self.map_index.find(map_name, map_types)
+        if found is not None:
+            t, mapset = found
+            name = map_name.split("@")[0]
+            info = {
+                "name": name,
+                "mapset": mapset,
+                "fullname": name + "@" + mapset,
+                "file": os.path.join(self.get_mapset_full_path(mapset), t, name),
+                # Return raster sub types simply as "raster"
+                "type": self.map_index.element_types[t]
+                }
+            return info
 
         self.log.error("Can't find map/region called %s" % map_name)
         raise MapNotFoundException()
@@ -720,15 +1312,101 @@ class GRASSInterface:
             self.run_command('g.remove rast=%s' % map_name, logging.DEBUG)
         elif map_type == 'vector':
             self.run_command('g.remove vect=%s' % map_name, logging.DEBUG)
+        if map_type:
+            self.map_index.remove(map_name)
+        trm.discard(map_name + "@" + self.get_mapset(), trm.MAP)
 
         # change back to original mapset
         if old_mapset:
             self.change_mapset(old_mapset)
             
+    def remove_maps(self, map_names, mapset=None):
+        """ Remove a number of maps using as few g.remove calls as possible.
+
+        Map names can have an @mapset component, otherwise they are removed
+        from mapset, or the current mapset if that isn't given. Maps are
+        grouped by mapset and type, so we only change mapset once for each
+        and remove up to remove_chunk_size maps per g.remove. Maps that
+        don't exist are ignored.
+        """
+        current_mapset = self.get_mapset()
+        by_mapset = {}
+        for m in map_names:
+            if "@" in m:
+                name, ms = m.split("@", 1)
+            else:
+                name, ms = m, mapset or current_mapset
+            by_mapset.setdefault(ms, []).append(name)
+
+        changed_mapset = False
+        for ms, names in by_mapset.items():
+            to_remove = { "rast": [], "vect": [] }
+            seen = set()
+            for name in names:
+                if name in seen: continue
+                seen.add(name)
+                trm.discard(name + "@" + ms, trm.MAP)
+                found = self.map_index.find(name, mapset=ms)
+                if found is None: continue
+                if self.map_index.element_types[found[0]] == "raster":
+                    to_remove["rast"].append(name)
+                elif self.map_index.element_types[found[0]] == "vector":
+                    to_remove["vect"].append(name)
+            if not to_remove["rast"] and not to_remove["vect"]: continue
+            if ms != self.get_mapset():
+                self.change_mapset(ms)
+                changed_mapset = True
+            for map_type, type_names in to_remove.items():
+                if not type_names: continue
+                self.log.debug("Removing %d %s maps from mapset %s",
+                        len(type_names), map_type, ms)
+                for i in range(0, len(type_names), self.remove_chunk_size):
+                    chunk = type_names[i:i+self.remove_chunk_size]
+                    self.run_command(["g.remove", "%s=%s" % (map_type, ','.join(chunk))],
+                            logging.DEBUG)
+                    for name in chunk:
+                        self.map_index.remove(name, ms)
+
+        # change back to original mapset
+        if changed_mapset and self.get_mapset() != current_mapset:
+            self.change_mapset(current_mapset)
+
+    def move_maps(self, map_names, src_mapset, dest_mapset=None):
+        """ Move raster maps from src_mapset to dest_mapset, or the current
+        mapset, replacing any maps of the same name there.
+
+        This renames the files that make up each map instead of using g.copy
+        and g.remove, so the mapsets must be in the same location.
+        """
+        dest_mapset = dest_mapset or self.get_mapset()
+        src_dir = self.get_mapset_full_path(src_mapset)
+        dest_dir = self.get_mapset_full_path(dest_mapset)
+        for name in map_names:
+            for e in raster_elements:
+                dest = os.path.join(dest_dir, e, name)
+                if os.path.isdir(dest):
+                    shutil.rmtree(dest)
+                elif os.path.lexists(dest):
+                    os.remove(dest)
+            self.map_index.remove(name, dest_mapset)
+            for e in raster_elements:
+                src = os.path.join(src_dir, e, name)
+                if not os.path.lexists(src): continue
+                if not os.path.isdir(os.path.join(dest_dir, e)):
+                    os.makedirs(os.path.join(dest_dir, e))
+                os.rename(src, os.path.join(dest_dir, e, name))
+                if e in self.map_index.map_elements:
+                    self.map_index.add(name, e, dest_mapset)
+            self.map_index.remove(name, src_mapset)
+
     def mapcalc(self, map_name, expression):
-        map_name='"' + map_name + '"' 
-        self.run_command("r.mapcalc", to_input="%s = %s\nend\n"%(map_name,expression))
+        self.run_command("r.mapcalc", to_input='"%s" = %s\nend\n'%(map_name,expression))
+        self.map_index.add(map_name)
     
+    def mapcalc_batch(self):
+        """ Start a batch of mapcalc statements to be run together """
+        return MapcalcBatch(self)
+
     def make_mask(self, mask_name):
         if mask_name is None:
             self.run_command('r.mask -r');
@@ -737,14 +1415,11 @@ class GRASSInterface:
 
     def find_mapset(self,name,resource=None):
         if resource is None:
-            resource=[ "cell", "fcell", "dcell", "vector" ]
+            resource=[ "cell", "fcell", "vector" ]
         else: resource = [resource]
-        for t in resource:
-            p=os.popen("g.findfile element=%s file=%s" % (t,name), 'r')
-            output = p.read()
-            res=re.search("mapset='(.+)'",output)
-            if res is not None:
-                return res.groups()[0]
+        found = self.map_index.find(name, resource)
+        if found is not None:
+            return found[1]
         return None
 
     def find_mapsets(self,maps,resource=None):
@@ -753,20 +1428,15 @@ class GRASSInterface:
         return maps_w_mapset
     
     def check_map(self,file_name,mapset=None):
-        # Have to check all possible types of maps
-        map_types=[ "cell", "fcell", "dcell", "vector" ]
+        """ Check whether a map exists, returning "raster", "vector" or None.
+
+        If mapset is given then we change to that mapset first.
+        """
         if mapset: self.change_mapset(mapset)
-        
-        for t in map_types:
-            #print "checking for existing map " + file_name + " of type " + t
-            p=os.popen("g.findfile element=%s file=%s" % (t,file_name), 'r')
-            output = p.read()
-            res=re.search("name='(.+)'",output)
-            if res is not None:
-                if t in ["cell","fcell","dcell"]:
-                    # Return raster sub types simply as "raster"
-                    t = "raster"
-                return t
+        found = self.map_index.find(file_name)
+        if found is not None:
+            # Return raster sub types simply as "raster"
+            return self.map_index.element_types[found[0]]
         return None
 
     def update_grass_vars(self):
@@ -782,8 +1452,7 @@ class GRASSInterface:
         loc_str = ""
         if location:
             loc_str = " location=%s" % location
-        output = Popen("g.mapset -l "+loc_str, shell=True,
-                stdout=subprocess.PIPE).communicate()[0]
+        output = self.pipe_command("g.mapset -l "+loc_str)
         mapsets = output.split()
         if mapset_name in mapsets:
             return True
@@ -881,64 +1550,21 @@ class GRASSInterface:
         maps_to_combine is a list of maps to merge to generate the occupancy envelope.
         filename is the output map.
 
+        Each map is read as a SparseRaster and the cells it occupies (those
+        that aren't null) are counted, so the work done on each map scales
+        with the area it occupies. Cells never occupied are null.
+
         TODO: create equivalent for average populations/age
         """
-        if len(maps_to_combine) > 10000:
-            self.log.warning("Probability envelope not designed for more than 10000 maps")
-            return None
-        elif len(maps_to_combine) == 0: 
+        if len(maps_to_combine) == 0: 
             self.log.error("No maps provided for combining into probability envelope")
             return None
         
-        # Only do 100 maps at a time, since GRASS can only open so many files.
-        max_maps = 100
-        num_maps = len(maps_to_combine)
-        index = 0
-        c_maps = []
-        prob_env = None
-        while num_maps > 0:
-            # We have to replace population number or population age with
-            # a one, since we are interested in the percentage of occupancy.
-            reclass_to_occupancy_maps = []
-            for i in range(index,index+min(num_maps,max_maps)):
-                reclass_map = self.generate_map_name();
-                # check the map name isn't already being used
-                while reclass_map in reclass_to_occupancy_maps:
-                    reclass_map = self.generate_map_name();
-                p = Popen("r.reclass input=%s output=%s" % \
-                        (maps_to_combine[i],reclass_map), shell=True,
-                        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-                output = p.communicate("* = 1\nend\n")[0]
-                reclass_to_occupancy_maps.append(reclass_map)
-            map_str = ','.join(reclass_to_occupancy_maps)
-            index = index+max_maps
-            num_maps = num_maps - max_maps
-            temp_file = self.generate_map_name()
-            self.run_command("r.series input=%s output=%s method=count" % (map_str,temp_file))
-            # Now remove temporary reclass maps
-            for r_map in reclass_to_occupancy_maps:
-                self.remove_map(r_map)
-            c_maps.append(temp_file)
-        
-        # combine maps if more than 100 are being used.
-        if len(c_maps) > 1:
-            map_str = ','.join(c_maps)
-            prob_env = self.generate_map_name();
-            self.run_command("r.series input=%s output=%s method=sum" % (map_str,prob_env))
-        else:
-            prob_env = c_maps[0]
-            # clear c_maps so we don't try to delete c_map[0] later
-            c_maps = [] 
-        
-        # divide maps by total count and replace 0 with null()
-        # must use float in division so mapcalc knows that output map is
-        # FCELL/DCELL
-        self.mapcalc(filename, "if(%s==0.0,null(),%s/%f)"  % (prob_env,prob_env,float(len(maps_to_combine))))
-        
-        # remove temporary maps
-        for c in c_maps:
-            self.remove_map(c)
-        self.remove_map(prob_env)
+        region = self.get_region_info()
+        counter = sparse.OccupancyCounter((region['rows'], region['cols']))
+        for m in maps_to_combine:
+            counter.add(self.read_raster_sparse(m))
+        self.write_raster_sparse(counter.envelope(), filename)
         
         # set color table for occupancy envelope
         self.run_command("r.colors map=%s color=gyr --quiet" % (filename))
@@ -968,24 +1594,81 @@ class GRASSInterface:
             print "Dropping to pdb.\nYou can try to continue by entering c<enter>, or quit with q<enter>."
             import pdb; pdb.set_trace()
     
+    def get_session(self):
+        """ Get the persistent command session, starting it if necessary """
+        if self.session is None:
+            self.session = GRASSSession()
+        return self.session
+
+    def _exec(self, command, to_input='', direct=False):
+        """ Run a command and return (exit code, stdout, stderr).
+
+        command is either a shell command string or an argument list. The
+        latter is run directly without a shell when the persistent session
+        is disabled, or when direct is True. Direct commands run in their own
+        process, so they can be run from several threads at once. The time
+        taken is recorded against the GRASS module.
+        """
+        start_time = time.time()
+        if self.use_session and not direct:
+            ret, stdout, stderr = self.get_session().run(command, to_input)
+        else:
+            use_shell = isinstance(command, basestring)
+            p = Popen(command, shell=use_shell, stdout=subprocess.PIPE, \
+                    stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+            stdout, stderr = p.communicate(to_input)
+            ret = p.returncode
+        elapsed = time.time() - start_time
+        self.record_command_time(command, elapsed, len(to_input),
+                len(stdout) + len(stderr))
+        return ret, stdout, stderr
+
+    def record_command_time(self, command, elapsed, bytes_in=0, bytes_out=0):
+        if isinstance(command, basestring):
+            words = command.split()
+        else:
+            words = list(command)
+        module = words and words[0] or ''
+        stats = self.command_times.setdefault(module, [0, 0.0])
+        stats[0] += 1
+        stats[1] += elapsed
+        profiler.record(module, elapsed, bytes_in, bytes_out)
+        self.log.debug("%s took %.4fs" % (module, elapsed))
+
+    def log_command_times(self, log_level=logging.DEBUG):
+        """ Log the number of calls and mean latency of each GRASS module """
+        items = sorted(self.command_times.items(), key=lambda x: -x[1][1])
+        for module, (count, total) in items:
+            self.log.log(log_level, "%s: %d calls, %.2fs total, %.4fs mean" %
+                    (module, count, total, total / count))
+
+    def pipe_command(self, command, to_input=''):
+        """ Run a command and return its stdout, ignoring the exit code """
+        return self._exec(command, to_input)[1]
+
     def run_command(self, command_string, log_level=logging.DEBUG, to_input=''):
+        """ Run a GRASS command, raising GRASSCommandException if it fails.
+
+        command_string can also be an argument list, in which case it is run
+        without shell interpretation.
+        """
+        if not isinstance(command_string, basestring):
+            command_string = list(command_string)
         log_input = ''
         if to_input:
             log_input = ' <<< "' + to_input + '"'
-        self.log.log(log_level, "exec: " + command_string + log_input)
+        self.log.log(log_level, "exec: " + str(command_string) + log_input)
         ret = None
         
-        p = Popen(command_string, shell=True, stdout=subprocess.PIPE, \
-                stdin=subprocess.PIPE, stderr=subprocess.PIPE)
-        
-        self.stdout, self.stderr = p.communicate(to_input)
+        ret, self.stdout, self.stderr = self._exec(command_string, to_input)
         if self.stdout:
             self.log.debug("stdout: " + self.stdout)
         if log_level >= logging.INFO and self.stderr is not None and len(self.stderr) > 0:
             self.log.debug("stderr: " + self.stderr)
-        ret = p.returncode
 
         if (ret is not None) and ret != 0:
+            if not isinstance(command_string, basestring):
+                command_string = ' '.join(command_string)
             self.debug_dump_command(command_string, to_input, log_level)
             raise GRASSCommandException(command_string, self.stderr, ret)
         return ret
@@ -1015,7 +1698,19 @@ class GRASSInterface:
                         return exe_file + ext
         return None
 
+    def remove_temp_maps(self, map_names):
+        """ Remove maps given as name@mapset, used by the temporary resource
+        manager to remove any temporary maps that are left """
+        try:
+            self.remove_maps(map_names)
+        except (GRASSCommandException, SetMapsetException), e:
+            self.log.warning("Couldn't remove temporary maps: %s" % str(e))
+
     def clean_up(self):
+        # Remove temporary maps while we still have a GRASS environment
+        trm.cleanup(trm.MAP)
+        if trm.map_remover == self.remove_temp_maps:
+            trm.map_remover = None
         if self.blank_map is not None:
             self.destruct_map(self.blank_map)
         if self.in_grass_shell:
@@ -1025,10 +1720,13 @@ class GRASSInterface:
             self.grass_vars['GISDBASE']= self.old_gisdbase
             self.set_gis_env()
             self.log.debug('Restoring old region')
-            subprocess.Popen("g.region " + self.old_region, shell=True,
-                    stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
+            self.pipe_command("g.region " + self.old_region)
         # TODO remove all other temporary maps
         self.close_display()
+        self.log_command_times()
+        if self.session is not None:
+            self.session.close()
+            self.session = None
         # remove PID dir
         if self.pid_dir is not None and os.path.isdir(self.pid_dir):
             shutil.rmtree(self.pid_dir)
@@ -1040,36 +1738,21 @@ class GRASSInterface:
             self.run_command('r.mapcalc "' + blank_map_name + '=null()"')
         return self.blank_map
 
-    def generate_map_name(self, base=""):
-        random_name = None
-        while random_name is None or self.check_map(random_name) is not None:
-            random_name = repr(os.getpid()) + "_" + base + "_" + repr(int(random.random()*1000000))
-        return random_name
+    def generate_map_name(self, base="", temporary=True):
+        """ Get a new map name, which is guaranteed not to collide with other
+        generated names so no GRASS lookup is needed.
 
-    def get_range(self):
-        """ provides region data to be passed to LifestageTransition
-        (rowProcessing.process function from Steve Wangens popMod)
-        @todo rename to get_region
+        Temporary names are registered in the current mapset with the
+        temporary resource manager, so that they are removed at exit if
+        nothing else removes them.
         """
-        # sends command to GRASS session and returns result via stdout (piped)
-        output = subprocess.Popen("g.region -p", shell=True,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE).communicate()[0]
-        # pipes input from r.info and formats it as a StringIO object
-        # (additional functionality vs. string, like 'readlines')
-        pre_rangeData = StringIO.StringIO(output)
-        # creates a list (rangeData) where each entry is a different line of
-        # the g.region output
-        rangeData = pre_rangeData.readlines()
-        return (rangeData)
+        return trm.temp_map_name(base, self.get_mapset(), register=temporary)
 
     def get_index_raster(self,indexRaster):
         '''Imports the raster layers representing the index layer.'''
         cmd = "r.info -m %s --v" % (indexRaster)
-        r = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE)
-        r.stdout, r.stderr = r.communicate()
-        if r.stdout == '':
+        output = self.pipe_command(cmd)
+        if output == '':
             self.log.error("That raster does not exist in the current mapset.")
             #indexRaster = raw_input()
             #cmd = "r.info -m %s --v" %(indexRaster)
@@ -1078,72 +1761,202 @@ class GRASSInterface:
         self.log.debug('Index raster set to "' + str(indexRaster) + '"')
         return indexRaster
 
-    def raster_to_ascii(self,rasterName, IO=1, null_as_zero=False):
-        """ Creates a temporary file storing the raster data in ascii format
-        (accessable for LifestageTransition processing), and if IO=1 also
-        creates a temp file to write the new data to after being processed.
-        Returns the names of the temporary files.
-
-        @todo rename to exportRasterToASCII   
+    def get_region_info(self):
+        """ Get the current region as a dict with the keys n, s, e, w, nsres,
+        ewres, rows and cols. This is cached until the region changes. """
+        cache = self._get_region_cache()
+        if 'info' in cache:
+            return dict(cache['info'])
+        output = self.pipe_command("g.region -g")
+        info = {}
+        for line in output.splitlines():
+            if '=' not in line: continue
+            k, v = line.strip().split('=', 1)
+            try:
+                info[k] = float(v)
+            except ValueError:
+                info[k] = v
+        for k in ['rows', 'cols']:
+            if k in info: info[k] = int(info[k])
+        if 'rows' in info:
+            cache['info'] = dict(info)
+        return info
+
+    def read_raster(self, map_name, null=0.0, direct=False):
+        """ Read a raster in the current region into a 2D numpy array of
+        doubles via a binary export, rather than formatting it as text.
+
+        null is the value that null cells are given. If null is None, then a
+        numpy masked array is returned with the null cells masked. If direct
+        is True, the export doesn't go through the persistent session, which
+        lets several threads read rasters at the same time.
         """
-        null_char = '*'
-        if null_as_zero: null_char = '0'
-        imp_cmd = "r.out.ascii -h input=%s output=- null=%s" % (rasterName,null_char)
-        data = subprocess.Popen(imp_cmd, shell=True, stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE)
-        tempDataFile, tempDataFileName = (tempfile.mkstemp(prefix = 'popMod_inRast_', \
-                    suffix='.txt', text=True))
-        tempDataFile = os.fdopen(tempDataFile, 'w')
-        tempDataFile.write(data.communicate()[0])
-        tempDataFile.close()
-        if IO==1:
-            tempOutDataFile, tempOutDataFileName = (tempfile.mkstemp(prefix='popMod_outRast_', \
-                        suffix='.txt', text=True))
-            os.close(tempOutDataFile)
-            return tempDataFileName, tempOutDataFileName
+        region = self.get_region_info()
+        null_str = "nan"
+        if null is not None:
+            null_str = repr(float(null))
+        bin_fn = trm.temp_filename(prefix='mdig_rast_', suffix='.bin')
+        try:
+            cmd = ["r.out.bin", "-f", "input=%s" % map_name,
+                "output=%s" % bin_fn, "null=%s" % null_str, "bytes=8"]
+            if direct:
+                ret, stdout, stderr = self._exec(cmd, direct=True)
+                if ret != 0:
+                    raise GRASSCommandException(' '.join(cmd), stderr, ret)
+            else:
+                self.run_command(cmd)
+            data = numpy.fromfile(bin_fn, dtype=numpy.float64)
+        finally:
+            trm.release(bin_fn)
+        data = data.reshape((region['rows'], region['cols']))
+        if null is None:
+            data = numpy.ma.masked_invalid(data)
+        return data
+
+    def read_raster_cached(self, map_name, cache_dir):
+        """ Read a raster in the current region as a read-only numpy memmap
+        of doubles, with null cells as NaN.
+
+        The raster is exported to a binary file in cache_dir the first time,
+        named from the map, the mtime of its header and the region. Later
+        reads, including those by other processes sharing cache_dir, just
+        map that file until the raster or region changes.
+        """
+        found = self.map_index.find(map_name, ["cell", "fcell"])
+        if found is None:
+            raise MapNotFoundException(map_name)
+        name = "%s@%s" % (map_name.split("@")[0], found[1])
+        region = self.get_region_info()
+        stamp = "%s#%s#" % (name, repr(self._get_raster_stamp(name)))
+        region_key = repr([region[k] for k in ('n', 's', 'e', 'w', 'rows', 'cols')])
+        fn = os.path.join(cache_dir, "%s%s.bin" % (stamp,
+            hashlib.md5(region_key).hexdigest()))
+        if not os.path.isfile(fn):
+            if not os.path.isdir(cache_dir):
+                try:
+                    os.makedirs(cache_dir)
+                except OSError:
+                    # Another process made it first
+                    pass
+            fd, tmp_fn = tempfile.mkstemp(suffix='.tmp', dir=cache_dir)
+            os.close(fd)
+            try:
+                self.run_command(["r.out.bin", "-f", "input=%s" % name,
+                    "output=%s" % tmp_fn, "null=nan", "bytes=8"])
+                os.rename(tmp_fn, fn)
+            finally:
+                if os.path.exists(tmp_fn):
+                    os.remove(tmp_fn)
+            # Remove files for older versions of the raster
+            for old_fn in os.listdir(cache_dir):
+                if old_fn.startswith(name + "#") and old_fn.endswith(".bin") \
+                        and not old_fn.startswith(stamp):
+                    try:
+                        os.remove(os.path.join(cache_dir, old_fn))
+                    except OSError:
+                        pass
+        return numpy.memmap(fn, dtype=numpy.float64, mode='r',
+                shape=(region['rows'], region['cols']))
+
+    def read_raster_sparse(self, map_name, zero_is_null=False, direct=False):
+        """ Read a raster in the current region into a SparseRaster of its
+        non-null cells. With zero_is_null, cells that are zero are left out
+        too.
+
+        Only the bounding box of the non-null cells is exported, so reading
+        scales with the area the map occupies rather than the region, apart
+        from GRASS finding the bounding box. direct is as for read_raster,
+        but since threads share the region, a direct read exports the
+        whole region.
+        """
+        region = self.get_region_info()
+        shape = (region['rows'], region['cols'])
+        if direct:
+            return sparse.SparseRaster.from_array(self.read_raster(map_name,
+                null=None, direct=True), zero_is_null)
+        extent = self.get_occupied_extent(map_name)
+        if extent is None:
+            return sparse.SparseRaster(shape, [], [], [])
+        info = self.get_window(extent)
+        with self._window_context(info, ('window', map_name)):
+            window = sparse.SparseRaster.from_array(self.read_raster(map_name,
+                null=None), zero_is_null)
+        return sparse.SparseRaster(shape, window.rows + info['row_offset'],
+                window.cols + info['col_offset'], window.values)
+
+    def write_raster_sparse(self, raster, map_name, null=0.0, overwrite=True):
+        """ Write a SparseRaster covering the current region to a raster
+        map of doubles. Cells not in the SparseRaster, and any that are equal
+        to null, are stored as null.
+
+        Only the bounding box of the cells in the SparseRaster is written, so
+        the map's own extent is that box, and cells of the region outside of
+        it read as null.
+        """
+        region = self.get_region_info()
+        if len(raster) == 0:
+            rows, cols = numpy.array([0]), numpy.array([0])
         else:
-            return tempDataFileName
-
-    def index_to_ascii(self,indexRaster):
-        """ @todo merge with the above code and generalise """
-        # export index to temporary ascii map
-        imp_cmd = "r.out.ascii -hi input=%s output=-" % (indexRaster)
-        data = subprocess.Popen(imp_cmd, shell=True, stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE)
-        tempDataFile, tempDataFileName = (tempfile.mkstemp(prefix='popMod_inIndex_', \
-                    suffix='.txt', text=True))
-        tempDataFile = os.fdopen(tempDataFile, 'w')
-        tempDataFile.write(data.communicate()[0])
-        tempDataFile.close()
-        # create temporary output filename for ascii index map
-        tempOutDataFile, tempOutDataFileName = (tempfile.mkstemp(prefix='popMod_outIndex_', \
-                    suffix='.txt', text=True))
-        os.close(tempOutDataFile)
-        return tempDataFileName, tempOutDataFileName
-
-    def import_ascii_to_raster(self, ascii_fn, raster_fn, nv = None):
-        temp_to_rast_cmd = "r.in.ascii --o input=%s output=%s" % \
-            (ascii_fn, raster_fn)
-        if nv:
-            temp_to_rast_cmd += " nv=%s" % str(nv)
-        self.run_command(temp_to_rast_cmd)
+            rows, cols = raster.rows, raster.cols
+        r0, r1 = rows.min(), rows.max() + 1
+        c0, c1 = cols.min(), cols.max() + 1
+        data = numpy.empty((r1 - r0, c1 - c0))
+        data.fill(numpy.nan)
+        data[raster.rows - r0, raster.cols - c0] = raster.values
+        window = {
+            'n': region['n'] - r0 * region['nsres'],
+            's': region['n'] - r1 * region['nsres'],
+            'w': region['w'] + c0 * region['ewres'],
+            'e': region['w'] + c1 * region['ewres'],
+            'rows': r1 - r0, 'cols': c1 - c0,
+            }
+        self._write_binary(data, map_name, window, null, overwrite)
+
+    def write_raster(self, data, map_name, null=None, overwrite=True):
+        """ Write a 2D numpy array covering the current region to a raster
+        map of doubles.
+
+        Cells equal to null are stored as null in the raster, and if data is
+        a masked array the masked cells are too.
+        """
+        region = self.get_region_info()
+        if data.shape != (region['rows'], region['cols']):
+            raise ValueError("Array shape %s doesn't match region %dx%d" %
+                    (str(data.shape), region['rows'], region['cols']))
+        if numpy.ma.isMaskedArray(data):
+            data = data.filled(numpy.nan)
+        self._write_binary(data, map_name, region, null, overwrite)
+
+    def _write_binary(self, data, map_name, window, null, overwrite):
+        """ Import data into map_name with r.in.bin, with the extent and
+        size in window, and NaN and any cells equal to null as null """
+        data = numpy.array(data, dtype=numpy.float64)
+        nulls = numpy.isnan(data)
+        if null is not None and not numpy.isnan(null):
+            nulls |= data == null
+        data[nulls] = NULL_VALUE
+        bin_fn = trm.temp_filename(prefix='mdig_rast_', suffix='.bin')
+        try:
+            data.tofile(bin_fn)
+            cmd = ["r.in.bin", "-d", "input=%s" % bin_fn,
+                    "output=%s" % map_name, "bytes=8",
+                    "north=%r" % window['n'], "south=%r" % window['s'],
+                    "east=%r" % window['e'], "west=%r" % window['w'],
+                    "rows=%d" % window['rows'], "cols=%d" % window['cols'],
+                    "anull=%r" % NULL_VALUE]
+            if overwrite: cmd.append("--o")
+            self.run_command(cmd)
+            self.map_index.add(map_name)
+        finally:
+            trm.release(bin_fn)
 
     def count_sites(self, vmap):
         """ Counts the number of points within a vector map """
         # use v.info -t and parse result
-        p1 = Popen(["v.info", "-t", vmap], stdout=subprocess.PIPE)
-        p2 = Popen(["grep", "nodes"], stdin=p1.stdout, stdout=subprocess.PIPE)
-        p3 = Popen(["awk", "-F=","{print $2}"], stdin=p2.stdout, \
-                stdout=subprocess.PIPE)
-        output = p3.communicate()[0]
-        return int(output)
+        output = self.pipe_command(["v.info", "-t", vmap])
+        return int(re.search(r"nodes=(\d+)", output).group(1))
 
     def count_cells(self, rmap):
         """ Count the number cells occupied in a raster map """
-        p1 = Popen(r"r.univar" + " -g " + rmap, shell=True, stdout=subprocess.PIPE)
-        p2 = Popen(r"sed -n '1p;1q'", shell=True, stdin=p1.stdout,
-                stdout=subprocess.PIPE)
-        p3 = Popen(r"awk -F = '{print $2}'", shell=True, stdin=p2.stdout, \
-                stdout=subprocess.PIPE)
-        output = p3.communicate()[0]
-        return int(output)
+        output = self.pipe_command(["r.univar", "-g", rmap])
+        return int(output.splitlines()[0].split('=')[1])
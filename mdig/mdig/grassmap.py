@@ -120,9 +120,16 @@ class GrassMap:
         @param ls The lifestage to base dynamic maps on. So that if the map is created
         by mapcalc, POP_MAP will be replaced with the latest map from that
         lifestage.
+
+        A map that was generated in another mapset is generated again in the
+        current one, since the other mapset may have been removed, e.g. the
+        scratch mapset of a replicate run by a parallel worker.
         """
+        g = grass.get_g()
+        if self.ready and self.mapset and self.mapset != g.get_mapset():
+            self.filename = None
+            self.ready = False
         if self.filename is None or self.refresh:
-            g = grass.get_g()
             # If the map needs to be refreshed and has already been initiated
             # then destroy the old map...
             if self.refresh and self.ready:
@@ -9,6 +9,7 @@ import simplejson as json
 import lxml
 
 from replicate import Replicate
+import parallel
 from analysiscommand import AnalysisCommand
 import outputformats
 import grass
@@ -54,6 +55,9 @@ class DispersalInstance:
         
         self.listeners = []
         self.replicates = []
+        # Mapset that replicates are run in, if it isn't the instance's own
+        # mapset (parallel workers each run in a scratch mapset)
+        self.work_mapset = None
         
         # Control strategy that this instance is associated with, if any
         self.strategy = None
@@ -228,7 +232,13 @@ class DispersalInstance:
             # (these may get rerun if they are incomplete)
             self.replicates = new_reps
 
-    def run(self):
+    def run(self, jobs=1, queue=None):
+        if queue is not None:
+            parallel.QueueRunner(self.experiment, queue).run([self])
+            return
+        if jobs > 1:
+            parallel.ParallelRunner(self.experiment, jobs).run([self])
+            return
         # Catch when somebody has decreased the reps and there
         # are more reps saved than the new number expected
         self.init_mapset()
@@ -247,6 +257,29 @@ class DispersalInstance:
                 if "replicate_complete" in dir(l):
                     l.replicate_complete(rep)
 
+    def prepare_replicates(self):
+        """ Get the replicates that run() would run, with their seeds set,
+        but without running them.
+
+        Returns a list of (replicate, is_new) tuples. Seeds are taken from
+        the model's random stream in the same order as run() takes them, so
+        the replicates should then be run with Replicate.run(reset=False).
+        """
+        self.init_mapset()
+        self._purge_extraneous_replicates()
+        to_run = []
+        for rep in [x for x in self.replicates if not x.complete]:
+            # Replicates with a checkpoint keep their seed, to resume from it
+            if rep.load_checkpoint() is None:
+                rep.reset()
+            to_run.append((rep, False))
+        num_reps = self.experiment.get_num_replicates()
+        while len(self.replicates) < num_reps:
+            rep = Replicate(None,self)
+            rep.reset()
+            to_run.append((rep, True))
+        return to_run
+
     def run_command_on_replicates(self, cmd_string, ls, times=None):
         """ Run a command across all replicate maps.
 
@@ -579,7 +612,8 @@ class DispersalInstance:
         current_region = self.experiment.get_region(self.r_id)
         g = grass.get_g()
         try:
-            g.change_mapset(self.get_mapset(), self.experiment.infer_location())
+            g.change_mapset(self.work_mapset or self.get_mapset(),
+                    self.experiment.infer_location())
             g.set_region(current_region)
         except grass.SetRegionException, e:
             raise e
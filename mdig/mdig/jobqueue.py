@@ -0,0 +1,153 @@
+"""
+A queue of replicate jobs kept as files in a directory.
+
+The directory can be on a filesystem shared by several hosts, such as the
+GISDBASE mounted over NFS, since the queue only relies on renames being
+atomic. Jobs are files in pending/. A worker claims a job by renaming it into
+claimed/ with a token of its own added to the name, so only one worker can
+claim each job. While it runs the job, the worker touches the claim every so
+often as a heartbeat, and when the job is done it writes the result to done/
+(or failed/) and removes the claim. Claims that haven't been touched for a
+while are assumed to belong to a worker that has died, and are moved back to
+pending/.
+"""
+import os
+import time
+import itertools
+
+import simplejson as json
+
+
+class JobQueue(object):
+
+    dirs = ('pending', 'claimed', 'done', 'failed', 'tmp')
+
+    def __init__(self, queue_dir, stale_timeout=600):
+        self.queue_dir = queue_dir
+        # Seconds without a heartbeat before a claim is considered stale
+        self.stale_timeout = stale_timeout
+        for d in self.dirs:
+            d = os.path.join(self.queue_dir, d)
+            if not os.path.isdir(d):
+                os.makedirs(d)
+        self.counter = itertools.count()
+
+    def _path(self, d, name):
+        return os.path.join(self.queue_dir, d, name)
+
+    def _list(self, d):
+        return sorted([n for n in os.listdir(os.path.join(self.queue_dir, d))
+                if not n.startswith('.')])
+
+    def _write(self, d, name, data):
+        """ Write data as JSON so that it appears in d all at once """
+        tmp_fn = self._path('tmp', "%s.%d.%d" % (name, os.getpid(),
+                self.counter.next()))
+        f = open(tmp_fn, 'w')
+        try:
+            json.dump(data, f)
+        finally:
+            f.close()
+        os.rename(tmp_fn, self._path(d, name))
+
+    def _read(self, d, name):
+        f = open(self._path(d, name))
+        try:
+            return json.load(f)
+        finally:
+            f.close()
+
+    def _split_claim(self, name):
+        return name.rsplit('.', 1)
+
+    def put(self, job_id, job):
+        """ Add a job, which is a dict that can be stored as JSON """
+        self._write('pending', job_id, job)
+
+    def claim(self, token):
+        """ Claim the next pending job.
+
+        token identifies this claim, and must be unique across all the
+        workers. Returns a tuple of (job_id, job), or None if there are no
+        pending jobs.
+        """
+        for job_id in self._list('pending'):
+            claim_fn = self._path('claimed', "%s.%s" % (job_id, token))
+            try:
+                os.rename(self._path('pending', job_id), claim_fn)
+            except OSError:
+                # Another worker claimed it first
+                continue
+            # Renaming keeps the mtime of the pending file
+            os.utime(claim_fn, None)
+            return job_id, self._read('claimed', "%s.%s" % (job_id, token))
+        return None
+
+    def heartbeat(self, job_id, token):
+        """ Show that the job is still being run. Returns False if the claim
+        has been given up as stale. """
+        try:
+            os.utime(self._path('claimed', "%s.%s" % (job_id, token)), None)
+        except OSError:
+            return False
+        return True
+
+    def _finish(self, d, job_id, token, data):
+        self._write(d, "%s.%s" % (job_id, token), data)
+        try:
+            os.remove(self._path('claimed', "%s.%s" % (job_id, token)))
+        except OSError:
+            # The claim has been requeued, the result is still kept
+            pass
+
+    def complete(self, job_id, token, result):
+        self._finish('done', job_id, token, result)
+
+    def fail(self, job_id, token, message):
+        self._finish('failed', job_id, token, message)
+
+    def requeue_stale(self, timeout=None):
+        """ Move claims without a heartbeat for timeout seconds, or
+        stale_timeout, back to the pending jobs and return their job ids """
+        if timeout is None:
+            timeout = self.stale_timeout
+        requeued = []
+        now = time.time()
+        for name in self._list('claimed'):
+            claim_fn = self._path('claimed', name)
+            try:
+                if now - os.stat(claim_fn).st_mtime < timeout:
+                    continue
+                job_id = self._split_claim(name)[0]
+                os.rename(claim_fn, self._path('pending', job_id))
+            except OSError:
+                # The job finished or was requeued while we were looking
+                continue
+            requeued.append(job_id)
+        return requeued
+
+    def _collect(self, d):
+        items = []
+        for name in self._list(d):
+            job_id, token = self._split_claim(name)
+            items.append((job_id, token, self._read(d, name)))
+            os.remove(self._path(d, name))
+        return items
+
+    def results(self):
+        """ Remove and return the (job_id, token, result) of completed jobs """
+        return self._collect('done')
+
+    def failures(self):
+        """ Remove and return the (job_id, token, message) of failed jobs """
+        return self._collect('failed')
+
+    def is_empty(self):
+        """ Whether there are no pending or claimed jobs """
+        return not self._list('pending') and not self._list('claimed')
+
+    def clear(self):
+        """ Remove all jobs and results """
+        for d in self.dirs:
+            for name in self._list(d):
+                os.remove(self._path(d, name))
@@ -23,6 +23,8 @@ from grassmap import GrassMap
 from analysis import Analysis
 from event import Event
 import grass
+import config
+from mdig.commandprofile import profiler
 
 import lxml.etree
 
@@ -183,15 +185,18 @@ class Lifestage:
 
     def get_phenology_mask(self, interval, r_id):
         """
-        Get the phenology masks for "interval" and region "r_id". Generates as needed.
+        Get the phenology masks for "interval" and region "r_id". Generates as
+        needed, in each mapset they're used in, since the mapset they were
+        generated in may have been removed.
         """
-        if r_id not in self.bin_masks.keys():
-            self.bin_masks[r_id] = {}
+        key = (r_id, grass.get_g().get_mapset())
+        if key not in self.bin_masks:
+            self.bin_masks[key] = {}
 
-        if interval not in self.bin_masks[r_id].keys():
-            self.bin_masks[r_id][interval] = self._generate_mask(interval, r_id)
+        if interval not in self.bin_masks[key]:
+            self.bin_masks[key][interval] = self._generate_mask(interval, r_id)
 
-        return self.bin_masks[r_id][interval]
+        return self.bin_masks[key][interval]
 
     def _generate_mask(self, interval, r_id):
         """
@@ -204,7 +209,7 @@ class Lifestage:
 
         if r_id in self.bins.keys():
             bins = self.bins[r_id]
-        elif "__default" in self.bin.keys():
+        elif "__default" in self.bins.keys():
             bins = self.bins["__default"]
         else:
             self.log.error(
@@ -238,14 +243,36 @@ class Lifestage:
         maps_w_mapset = set(maps_w_mapset)  # remove duplicate maps
         return maps_w_mapset
 
-    def run(self, interval, rep, temp_map_names, strategy=None):
+    def get_reach(self, rep):
+        """ How far the lifestage's events can move populations between
+        them, or None if any of them have no known limit """
+        if not config.get_config().active_area or not self.events:
+            return None
+        intervals = self.get_phenology_intervals(rep.instance.r_id)
+        if intervals is not None and len(intervals) > 1:
+            # Phenology masks are made in the region when first needed
+            return None
+        reach = 0.0
+        for e in self.events:
+            e_reach = e.get_reach(rep, self.populationBased)
+            if e_reach is None:
+                return None
+            reach += e_reach
+        return reach
+
+    def run_events(self, interval, rep, temp_map_names):
         grass_i = grass.get_g()
+        mask = ""
+        p_intervals = self.get_phenology_intervals(rep.instance.r_id)
+        if len(p_intervals) > 1:
+            # Masks are generated once and kept for later timesteps and
+            # replicates
+            mask = self.get_phenology_mask(interval,
+                    rep.instance.r_id).get_map_filename()
         # Run through events for this lifestage
         for e in self.events:
-            mask = ""
-            p_intervals = self.get_phenology_intervals(rep.instance.r_id)
+            profiler.set_context(event=e.get_command())
             if len(p_intervals) > 1:
-                mask = self.get_phenology_mask(interval, rep.instance.r_id)
                 grass_i.make_mask(mask)
 
             metrics = e.run(temp_map_names[0], temp_map_names[1], rep, self.populationBased)
@@ -256,33 +283,44 @@ class Lifestage:
                 # using mapcalc
                 grass_i.make_mask(None)
 
-                # Join Maps
-                grass_i.mapcalc(temp_map_names[0], "if(isnull(%s),%s,%s)" % (
-                    mask, temp_map_names[0], temp_map_names[1]))
+                # Join Maps. The joined map is only needed by the merge
+                # below, so it's inlined rather than written to [0], and
+                # both steps run in a single r.mapcalc call.
+                batch = grass_i.mapcalc_batch()
+                batch.add(temp_map_names[0], "if(isnull(%s),%s,%s)" % (
+                    mask, temp_map_names[0], temp_map_names[1]), write=False)
 
                 # Merge value outside of original mask, e.g. long distance jumps
                 if self.populationBased:
-                    grass_i.mapcalc(temp_map_names[1], "if(isnull(%s) && isnull(%s),%s,%s+%s)" % (
+                    batch.add(temp_map_names[1], "if(isnull(%s) && isnull(%s),%s,%s+%s)" % (
                         mask, temp_map_names[1], temp_map_names[0], temp_map_names[0], temp_map_names[1]))
                 else:
-                    grass_i.mapcalc(temp_map_names[1], "if(isnull(%s) && isnull(%s),%s,%s)" % (
+                    batch.add(temp_map_names[1], "if(isnull(%s) && isnull(%s),%s,%s)" % (
                         mask, temp_map_names[1], temp_map_names[0], temp_map_names[1]))
+                batch.run()
 
             temp_map_names.reverse()
 
+    def run(self, interval, rep, temp_map_names, strategy=None):
+        grass_i = grass.get_g()
+        # Only process the area the events can reach from the populations
+        with grass_i.active_area_context(temp_map_names[0], self.get_reach(rep)):
+            self.run_events(interval, rep, temp_map_names)
+
         # Get management strategy treatments that affect this lifestage.
         treatments = []
         if strategy is not None:
             treatments = strategy.get_treatments_for_ls(self.name, rep.current_t)
 
         for t in treatments:
+            profiler.set_context(event="treatment %d" % t.index)
             self.log.debug("Applying treatment %d for strategy %s" %
                           (t.index, strategy.get_name()))
 
             t_area = t.get_treatment_area_map(rep)
             self.log.debug("Treatment area map is %s" % t_area)
 
-            if 'NULL' in grass_i.get_raster_range(t_area).values():
+            if t.is_area_empty():
                 # If mask is empty then don't run treatment, as it does
                 # nothing, and GRASS's mask system is broken.
                 # http://trac.osgeo.org/grass/ticket/1999
@@ -299,11 +337,10 @@ class Lifestage:
             grass_i.make_mask(None)
             # Now we have to combine the unmasked region from the original map with the
             # the alteration made by the treatment on the masked area.
+            # This is written straight to the destination map.
             if t_area is not None:
-                self.tempmap = "wibble_foss"
-                grass_i.mapcalc(self.tempmap, 'if(isnull("%s"),"%s","%s")' %
+                grass_i.mapcalc(temp_map_names[1], 'if(isnull("%s"),"%s","%s")' %
                                (t_area, temp_map_names[0], temp_map_names[1]))
-                grass_i.copy_map(self.tempmap, temp_map_names[1], overwrite=True)
             temp_map_names.reverse()
 
     def analyses(self):
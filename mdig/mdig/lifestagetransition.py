@@ -3,12 +3,10 @@ import sys
 import os
 import logging
 import re
+import ast
 import pdb
 import xml.dom.minidom
 
-import subprocess
-from subprocess import Popen
-
 import math
 import numpy
 
@@ -16,6 +14,111 @@ from numpy import vstack, concatenate, random, array, loadtxt
 
 import mdig
 import grass
+from sparse import SparseRaster, occupied_cells
+
+def _call(f, args, node):
+    return ast.copy_location(ast.Call(func=ast.Name(id=f, ctx=ast.Load()),
+        args=args, keywords=[], starargs=None, kwargs=None), node)
+
+class ArrayExpression(ast.NodeTransformer):
+    """ Rewrites an expression so that it can be evaluated with arrays for
+    its parameters and maps, one value for each cell.
+
+    Division and modulo use the numpy.ma functions, which mask the result
+    where the divisor is zero instead of raising an exception. Functions
+    from math, min and max, conditional expressions, and/or/not and chained
+    comparisons, which only work with single values, are replaced by their
+    numpy equivalents. Anything else that doesn't work with arrays is
+    evaluated one cell at a time by TVGenerator.build_matrices.
+    """
+
+    functions = {
+            ast.Div: '_ma_divide',
+            ast.FloorDiv: '_ma_floor_divide',
+            ast.Mod: '_ma_remainder',
+            }
+    math_functions = {'pow': 'power'}
+    builtins = {'min': '_ma_minimum', 'max': '_ma_maximum', 'round': '_ma_round'}
+
+    def visit_BinOp(self, node):
+        self.generic_visit(node)
+        f = self.functions.get(type(node.op))
+        if f is None:
+            return node
+        return _call(f, [node.left, node.right], node)
+
+    def visit_Call(self, node):
+        self.generic_visit(node)
+        func = node.func
+        if isinstance(func, ast.Attribute) and isinstance(func.value, ast.Name) \
+                and func.value.id == 'math':
+            attr = self.math_functions.get(func.attr, func.attr)
+            if hasattr(numpy, attr):
+                node.func = ast.copy_location(ast.Attribute(
+                    value=ast.Name(id='numpy', ctx=ast.Load()), attr=attr,
+                    ctx=ast.Load()), func)
+        elif isinstance(func, ast.Name) and func.id in self.builtins and \
+                not node.keywords and node.starargs is None and \
+                node.kwargs is None:
+            if func.id == 'round':
+                return _call(self.builtins['round'], node.args, node)
+            if len(node.args) > 1:
+                result = node.args[0]
+                for arg in node.args[1:]:
+                    result = _call(self.builtins[func.id], [result, arg], node)
+                return result
+        return node
+
+    def visit_IfExp(self, node):
+        self.generic_visit(node)
+        return _call('_ma_where', [node.test, node.body, node.orelse], node)
+
+    def visit_BoolOp(self, node):
+        # Keeps Python's semantics of returning the deciding value
+        self.generic_visit(node)
+        result = node.values[0]
+        for value in node.values[1:]:
+            if isinstance(node.op, ast.And):
+                result = _call('_ma_where', [result, value, result], node)
+            else:
+                result = _call('_ma_where', [result, result, value], node)
+        return result
+
+    def visit_UnaryOp(self, node):
+        self.generic_visit(node)
+        if isinstance(node.op, ast.Not):
+            return _call('_logical_not', [node.operand], node)
+        return node
+
+    def visit_Compare(self, node):
+        self.generic_visit(node)
+        if len(node.ops) == 1:
+            return node
+        left = node.left
+        result = None
+        for op, right in zip(node.ops, node.comparators):
+            c = ast.copy_location(ast.Compare(left=left, ops=[op],
+                comparators=[right]), node)
+            if result is None:
+                result = c
+            else:
+                result = _call('_logical_and', [result, c], node)
+            left = right
+        return result
+
+# What compiled expressions can use besides their parameters and maps
+_expression_globals = dict(globals())
+_expression_globals.update({
+        '_ma_divide': numpy.ma.divide,
+        '_ma_floor_divide': numpy.ma.floor_divide,
+        '_ma_remainder': numpy.ma.remainder,
+        '_ma_minimum': numpy.ma.minimum,
+        '_ma_maximum': numpy.ma.maximum,
+        '_ma_round': numpy.ma.round,
+        '_ma_where': numpy.ma.where,
+        '_logical_and': numpy.ma.logical_and,
+        '_logical_not': numpy.ma.logical_not,
+        })
 
 class TVGenerator(list):
     """ Generates a transition value
@@ -25,6 +128,8 @@ class TVGenerator(list):
         self.parameters = parameters
         self.expressions = expressions
         self.parameters_in_expressions = []
+        # (code, names of parameters and maps used) for each expression
+        self.compiled = []
         self.log = logging.getLogger("mdig.tvgen")
 
         # Should we continue if an expression in the transition matrix tries to
@@ -35,23 +140,10 @@ class TVGenerator(list):
             self.log.error("Parameters were not okay: exiting...")
             sys.exit(mdig.mdig_exit_codes['popmod'])
         
-        self.map_pattern = re.compile(r'MAP_(\w*)', re.VERBOSE)
         for i in range(len(expressions)):
-            # Parse the expressions
-
-            # Sort parameter names by length so prefixes don't break longer names
-            p_keys = parameters.keys()
-            p_keys.sort(key=lambda x: -len(x))
-
-            self.parameters_in_expressions.append({})
-            # find all occurrences of parameter names
-            for p in p_keys:
-                if expressions[i].find(p) != -1:
-                    self.parameters_in_expressions[i][p] = 1
-            # search for MAP_* occurrences 
-            #matches = self.map_pattern.findall(self.expressions[i])
-            for m in self.map_pattern.finditer(self.expressions[i]):
-                self.parameters_in_expressions[i][m.group()] = 1
+            code, names = self.compile_expression(expressions[i])
+            self.compiled.append((code, names))
+            self.parameters_in_expressions.append(dict.fromkeys(names, 1))
             
         self.log.debug("Expressions for transitions matrix: [\n" + str(self) + " ]")
         #self.generate_default_parameter_map(index_values)
@@ -93,54 +185,100 @@ class TVGenerator(list):
                         self.parameters[par][int(index_value)] = \
                             self.parameters[par]["None"]
 
-    def build_matrix(self, index_value, coords, pop_maps):
-        tv_list=[]
-	
+    def compile_expression(self, expression):
+        """ Parse an expression and compile it so that it can be evaluated
+        with arrays for its parameters and MAP_<lifestage> populations.
+
+        Returns the code and the names of the parameters and maps it uses.
+        """
+        try:
+            tree = ast.parse(expression.strip(), mode='eval')
+        except SyntaxError, e:
+            self.log.error("%s in expression: %s" % (str(e), expression))
+            sys.exit(mdig.mdig_exit_codes['tmatrix'])
+        names = set()
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Name) and \
+                    (node.id in self.parameters or node.id.startswith("MAP_")):
+                names.add(node.id)
+        tree = ast.fix_missing_locations(ArrayExpression().visit(tree))
+        return compile(tree, "<expression>", "eval"), sorted(names)
+
+    def select_generator(self, param_name, index_value):
+        """ Return the ParamGenerator for param_name in cells with
+        index_value, and the index value to pass it """
+        p = self.parameters[param_name]
+        if index_value in p:
+            return p[index_value], index_value
+        # protect against float based index maps when parameters use int
+        elif int(index_value) in p:
+            return p[int(index_value)], int(index_value)
+        return p["None"], index_value
+
+    def build_matrices(self, index_value, rows, cols, pop_values, rng=random):
+        """ Build the transition matrices for a block of cells that all have
+        index_value in the index map.
+
+        rows and cols are arrays of the cell coordinates, and pop_values maps
+        lifestage ids to arrays of the population in each cell. Random
+        parameters are drawn from the numpy RandomState rng. Returns an
+        array of shape (tm_size, tm_size, number of cells).
+        """
+        n = len(rows)
+        tv = numpy.empty((len(self.expressions), n))
         for i in range(len(self.expressions)):
-            # arrange parameters so that longest get replaced first
-            keys = self.parameters_in_expressions[i].keys()
-            keys.sort(key=lambda x: -len(x))
-            expanded_expression = self.expressions[i]
-            for param_name in keys:
-                if param_name[0:3] == "MAP":
-                    ls_name = param_name[4:len(param_name)]
-                    #print "ls stage is " + ls_name
-                    #print "pop_maps keys " + str(pop_maps)
-                    if ls_name in pop_maps:
-                        expanded_expression = expanded_expression.replace(param_name, str(pop_maps[ls_name]))
+            code, names = self.compiled[i]
+            values = {}
+            for name in names:
+                if name.startswith("MAP_"):
+                    if name[4:] in pop_values:
+                        values[name] = pop_values[name[4:]]
                     else:
-                        self.log.error("Couldn't find map %s for expression %s" % (ls_name, self.expressions[i]))
+                        self.log.error("Couldn't find map %s for expression %s"
+                                % (name[4:], self.expressions[i]))
                 else:
-                    # check whether index_value exists for parameter
-                    if index_value in self.parameters[param_name]:
-                        expanded_expression = expanded_expression.replace(param_name, \
-                             str(self.parameters[param_name][index_value].gen_val(index_value, coords)))
-                    # protect against float based index maps when
-                    # parameters use int
-                    elif int(index_value) in self.parameters[param_name]:
-			int_index = int(index_value)
-                        expanded_expression = expanded_expression.replace(param_name, \
-                             str(self.parameters[param_name][int_index].gen_val(int_index, coords)))
-                    else:
-                        expanded_expression = expanded_expression.replace(param_name, \
-                             str(self.parameters[param_name]["None"].gen_val(index_value, coords)))
+                    gen, gen_index = self.select_generator(name, index_value)
+                    values[name] = gen.gen_vals(gen_index, rows, cols, rng)
             try:
-                expression_result = eval(expanded_expression)
-                tv_list.append(expression_result)
-            except ZeroDivisionError:
+                with numpy.errstate(divide='ignore', invalid='ignore'):
+                    try:
+                        result = eval(code, _expression_globals, values)
+                    except (TypeError, ValueError):
+                        # Something in the expression only works with
+                        # single values
+                        result = self._eval_by_cell(code, values, n)
+            except (NameError, TypeError, ValueError), e:
+                self.log.error("%s in expression: %s" % (str(e),
+                    self.expressions[i]))
+                sys.exit(mdig.mdig_exit_codes['tmatrix'])
+            div_by_zero = numpy.ma.getmaskarray(result)
+            if div_by_zero.any():
                 self.log.error("ZeroDivisionError in expression" + \
-                        ": %s" % expanded_expression)
+                        ": %s" % self.expressions[i])
                 if not self.ignore_div_by_zero:
                     sys.exit(mdig.mdig_exit_codes['tmatrix'])
-                else:
-                    tv_list.append(0.0)
-            except NameError, e:
-                self.log.error("%s in expression" + \
-                        ": %s" % (str(e),expanded_expression))
-                sys.exit(mdig.mdig_exit_codes['tmatrix'])
-        tm = array(tv_list)
-        tm = tm.reshape(self.tm_size, self.tm_size)
-        return tm
+            tv[i] = numpy.ma.filled(result, 0.0)
+        return tv.reshape(self.tm_size, self.tm_size, n)
+
+    def _eval_by_cell(self, code, values, n):
+        """ Evaluate compiled expression code separately for each of n
+        cells, with the values for the cell of any arrays in values """
+        result = numpy.ma.zeros(n)
+        for j in range(n):
+            cell_values = {}
+            for name, v in values.items():
+                if numpy.ndim(v) > 0:
+                    v = v[j]
+                cell_values[name] = v
+            result[j] = eval(code, _expression_globals, cell_values)
+        return result
+
+    def build_matrix(self, index_value, coords, pop_maps, rng=random):
+        """ Build the transition matrix for the single cell at coords """
+        pop_values = dict([(ls, array([v])) for ls, v in pop_maps.items()])
+        tm = self.build_matrices(index_value, array([coords[0]]),
+                array([coords[1]]), pop_values, rng)
+        return tm[:, :, 0]
 
 class ParamGenerator():
     """ Generator for parameters.
@@ -150,7 +288,7 @@ class ParamGenerator():
     Produces either static or random values,
     from source specified in xml file.
     """
-    def __init__(self, source, index, dist, vals, model_dir):
+    def __init__(self, source, index, dist, vals, model_dir, cache_dir=None):
         self.data = [0]
         self.source = source
         self.coda = None
@@ -158,6 +296,9 @@ class ParamGenerator():
         self.dist = dist
         self.vals = vals
         self.model_dir = model_dir
+        # Where map sources are cached as binary files, see
+        # GRASSInterface.read_raster_cached
+        self.cache_dir = cache_dir
         self.ready = False # haven't yet loaded coda or maps
         self.log = logging.getLogger("mdig.paramgen")
         #print '%s   %s   %s   %s is parameter value source' %(source, index, dist, vals)
@@ -170,21 +311,16 @@ class ParamGenerator():
         model_dir = self.model_dir
         try:
             if source == 'map':
-                # TODO create a GRASSInterface command to load map to an array
                 g = grass.get_g()
                 self.map_name = str(vals[0])
                 if (g.check_map(self.map_name) != "raster"):
                     raise grass.MapNotFoundException(self.map_name)
-                map_range = g.get_range()
-                n_rows = int(map_range[8][6:])
-                n_cols = int(map_range[9][6:])
-                cmd = "r.out.ascii -h input=" + self.map_name
-                p = Popen(cmd, shell=True, stdout=subprocess.PIPE)
-                map_ascii = p.communicate()[0]
-                if map_ascii.find('*') != -1:
+                if self.cache_dir is None:
+                    self.mat = g.read_raster(self.map_name, null=numpy.nan)
+                else:
+                    self.mat = g.read_raster_cached(self.map_name, self.cache_dir)
+                if numpy.isnan(self.mat).any():
                     raise Exception("Null values in parameter map %s not allowed" % self.map_name) 
-                self.mat = numpy.matrix(map_ascii)
-                self.mat = self.mat.reshape((n_rows,n_cols))
             elif source == 'CODA':
                 self.coda = {}
                 prefix = ""
@@ -202,7 +338,7 @@ class ParamGenerator():
                             self.coda[j+1] = concatenate((self.coda[j+1], \
                                 temp[int(self.coda_index[j,1]-1):int(self.coda_index[j,2]), 1]))
             elif source == 'random':
-                self.str = ("(%s.%s(%f,%f))" %(source, dist, vals[0], vals[1]))
+                self.distribution = frozen_distribution(dist, vals[0], vals[1])
 #elif source == 'zero':
 #break
             elif source == 'static':
@@ -213,28 +349,59 @@ class ParamGenerator():
             self.log.error(errstr + "\nAre your CODA files okay?")
             raise e
 
-    def gen_val(self, index_value, coords):
-        """Draws a random CODA iteration from the range specified in index for
-           the corresponding parameter level
+    def sample(self, index_value, size=None, rng=random):
+        """ Draw size values for cells with index_value in one go, or a
+        single value if size is None.
+
+        rng is the numpy RandomState to draw random values from.
         """
         if not self.ready:
             self._load_parameter()
         if self.source == 'CODA':
-            if index_value in self.coda:
-                return self.coda[index_value][random.random_integers(0,len(self.coda[index_value])-1)]
-            elif int(index_value) in self.coda:
-                return self.coda[int(index_value)][random.random_integers(0,len(self.coda[int(index_value)])-1)]
+            for key in (index_value, int(index_value)):
+                if key in self.coda:
+                    c = self.coda[key]
+                    return c[rng.randint(0, len(c), size)]
         elif self.source == 'random':
-            return eval(self.str)
+            return self.distribution(rng, size)
         elif self.source == 'zero':
             return 0
         elif self.source == 'static':
             return self.static
-        elif self.source == 'map':
+
+    def gen_vals(self, index_value, rows, cols, rng=random):
+        """ Like gen_val, but returns a value for each cell at rows and
+        cols, as an array or as a single value if it's the same for all """
+        if not self.ready:
+            self._load_parameter()
+        if self.source == 'map':
+            return self.mat[rows, cols]
+        return self.sample(index_value, len(rows), rng)
+
+    def gen_val(self, index_value, coords, rng=random):
+        """Draws a random CODA iteration from the range specified in index for
+           the corresponding parameter level
+        """
+        if not self.ready:
+            self._load_parameter()
+        if self.source == 'map':
             return self.mat[coords[0], coords[1]]
+        return self.sample(index_value, None, rng)
+
+def frozen_distribution(dist, a, b):
+    """ Return a function that draws from the numpy distribution dist with
+    parameters a and b, given a RandomState and the number of values """
+    if not hasattr(random.RandomState, dist):
+        raise ValueError("Unknown distribution %s" % dist)
+    def sample(rng, size=None):
+        return getattr(rng, dist)(a, b, size)
+    return sample
 
 class LifestageTransition:
 
+    # Maximum number of cells to build transition matrices for at once
+    block_size = 65536
+
     def __init__(self,xml_file, model):
         # Init timing of load process
         start_time = time.time()
@@ -244,7 +411,7 @@ class LifestageTransition:
         self.log = logging.getLogger("mdig.popmod")
 
         # Do lifestage transitions by individual rather than using
-        # matrix multiplication. (SLOW!)
+        # matrix multiplication, which keeps populations whole.
         self.by_individual = False
 
         # XML parsing
@@ -264,14 +431,6 @@ class LifestageTransition:
             self.parameters = self.xml_to_param(os.path.dirname(self.xml_file))
         self.expressions = self.xml_to_expression_list()
 
-        # determine size of rasters
-        self.range_data = grass.get_g().get_range()
-        # process range_data
-        self.n_rows = int(self.range_data[8][6:])
-        self.n_cols = int(self.range_data[9][6:])
-        self.header = str(self.range_data[2] + self.range_data[3] + self.range_data[4] +
-                self.range_data[5] + self.range_data[8] + self.range_data[9])
-
         # End timing of load process
         load_time = time.time() - start_time
         self.log.debug('Transition sources loaded.  Load time %f seconds'
@@ -287,172 +446,127 @@ class LifestageTransition:
         self.t_matrix = TVGenerator(self.parameters, self.expressions,
                 self.tm_size, index_values)
 
-    def apply_transition(self, ls_ids, current_pop_maps, destination_maps):
+    def apply_transition(self, ls_ids, current_pop_maps, destination_maps,
+            rng=None):
         #Timing of process
         start_time = time.time()
+        g = grass.get_g()
 
         ## Import Rasters
         # check Index raster name, check it exists
-        index_raster = grass.get_g().get_index_raster(self.index_source)
-        # check list of rasters that comprise stages (in order)
-        pop_raster_list = current_pop_maps
-
-        self.log.debug("Converting stage rasters to ASCII...")
-        ascii_pop_rasters = []
-        ascii_out_rasters = []
-        for i in pop_raster_list:
-            # output to ascii, and also replace null values with 0
-            data_fn, data_out_fn = grass.get_g().raster_to_ascii(i,null_as_zero=True)
-            ascii_pop_rasters.append(data_fn)
-            ascii_out_rasters.append(data_out_fn)
-
-        self.log.debug("Converting index file...")
-        ascii_indexes = grass.get_g().index_to_ascii(index_raster)
-
-        # TODO temp ascii files are currently cleaned up by process rows,
-        # but should probably be removed outside of the function as they
-        # generated above.
+        index_raster = g.get_index_raster(self.index_source)
+
+        self.log.debug("Reading stage and index rasters...")
+        # null values in the population rasters are treated as zero
+        pops = [g.read_raster_sparse(m, zero_is_null=True)
+                for m in current_pop_maps]
+        index_array = g.read_raster(index_raster, null=0.0)
 
         # apply matrix multiplication
-        self.process_rows(ls_ids, ascii_indexes, ascii_pop_rasters, ascii_out_rasters,
-                destination_maps) 
+        out_pops = self.process_sparse(ls_ids, index_array, pops, rng)
 
-        # remove temporary ascii files
-        for i in ascii_indexes: os.remove(i)
+        for out_pop, rast_name in zip(out_pops, destination_maps):
+            # cells without any population are stored as null
+            g.write_raster_sparse(out_pop, rast_name, null=0.0)
 
         processingTime = time.time() - start_time
         self.log.debug('Transition matrix application completed. ' + \
             'Processing time %f seconds' % processingTime)
 
-    def process_rows(self, ls_ids, indexes, temp_rasters, temp_out_rasters, \
-            out_pop_rasters):
+    def process_rows(self, ls_ids, index_array, pop_arrays, rng=None):
         """ Applies an instance of the transition matrix to the population 
-        rasters and outputs new rasters to the current GRASS workspace.
+        arrays and returns an array of the new populations, with the
+        lifestage as the first dimension.
 
-        @todo This should eventually be externalised into a C module that
-        directly reads the GRASS maps, but for now we convert to/from and
-        process ASCII maps.
+        index_array is a 2D array of index values, and pop_arrays is a list
+        of 2D arrays with the population of each lifestage, in the same order
+        as ls_ids. See process_sparse.
         """
-        numpy.set_printoptions(linewidth=200)
-        array_depth = len(temp_rasters) + 1
-
-        # create empty array for storing current row data
-        in_row_array = numpy.zeros((array_depth, self.n_cols))
-        out_row_array = numpy.zeros((array_depth, self.n_cols))
-
-        # Create empty lists to hold file objects (current row data is read
-        # from these file objects
-        fo_in_list = []
-        fo_out_list = []
-
-        # add readable file object containing index data
-        f_in = open(indexes[0])
-        fo_in_list.append(f_in)
-        # 2nd (write) index file once opened erases contents of temp file
-        f_out = open(indexes[1], 'w')
-        fo_out_list.append(f_out)
-
-        # add read and write file objects containing stage raster data
-        for i in range(len(temp_rasters)):
-            f_in = open(temp_rasters[i])
-            fo_in_list.append(f_in)
-            f_out = open(temp_out_rasters[i], 'w')
-            fo_out_list.append(f_out)
-    
-        # Append array with raster data file objects from list        
-        # .. for each row of the region
-        for row in range(self.n_rows):
-            # for each file
-            for i in range(array_depth):
-                temp_row = fo_in_list[i].readline().split()
-                in_row_array[i] = temp_row
-
-            # process individual cells
-            # TODO: only works if an index map is specified - should
-            # be able to work without one when it's all the same
-            for j in range(in_row_array.shape[1]):
-                #Calculate cell coordinates
-                coords = (row,j)
-
-                #Create and apply transition matrix instance            
-                # in_row_array[0,j] because that's the index
-                # in_row_array[1:,j] is data
-                pop_maps = {}
-                for l_i in range(0,len(ls_ids)):
-                    pop_maps[ls_ids[l_i]] = in_row_array[l_i+1,j]
-                    
-                tm = self.t_matrix.build_matrix(in_row_array[0,j], coords, pop_maps)
-                
-                #print "cell contents: " + str(inRowArray[1:,j]) + str(type(inRowArray[1:,j]))
-                #print "len(cell contents) = " +str(len(inRowArray[1:,j]))
-                pop_cell = in_row_array[1:,j]
-                #print "popCell.shape = " + str(popCell.shape)
-                pop_cell = pop_cell.reshape((1, pop_cell.shape[0]))
-                #print "popCell = " + str(popCell)
-                
-                # Long way to calculate transition, by individual behaviour
+        pops = [SparseRaster.from_array(numpy.asarray(a, dtype=numpy.float64),
+            zero_is_null=True) for a in pop_arrays]
+        out_pops = self.process_sparse(ls_ids, index_array, pops, rng)
+        return numpy.array([p.to_array(0.0) for p in out_pops])
+
+    def process_sparse(self, ls_ids, index_array, pops, rng=None):
+        """ Applies an instance of the transition matrix to the cells with a
+        population, and returns a SparseRaster of the new population of each
+        lifestage.
+
+        pops is a list of SparseRasters of the population of each lifestage,
+        in the same order as ls_ids, without the empty cells. Cells that are
+        empty for every lifestage are left empty, since multiplying by any
+        matrix leaves them empty, and their matrices aren't built at all.
+
+        Occupied cells are grouped by their index value, and the matrices for
+        up to block_size cells of a group are built and applied together.
+        Random values are drawn from the numpy RandomState rng, or the global
+        numpy random state if it's None.
+        """
+        if rng is None:
+            rng = random
+        rows, cols = occupied_cells(pops)
+        pop_cells = numpy.empty((len(pops), len(rows)))
+        for i in range(len(pops)):
+            pop_cells[i] = pops[i].values_at(rows, cols)
+        out_cells = numpy.zeros(pop_cells.shape)
+        index_values = numpy.asarray(index_array)[rows, cols]
+
+        # TODO: only works if an index map is specified - should
+        # be able to work without one when it's all the same
+        for index_value in numpy.unique(index_values):
+            group = numpy.nonzero(index_values == index_value)[0]
+            for start in range(0, len(group), self.block_size):
+                block = group[start:start + self.block_size]
+                b_pop_cells = pop_cells[:, block]
+                pop_values = dict(zip(ls_ids, b_pop_cells))
+                tms = self.t_matrix.build_matrices(index_value, rows[block],
+                        cols[block], pop_values, rng)
                 if self.by_individual:
-                    n_ls = pop_cell.shape[1]
-                    out_cell = numpy.zeros(n_ls)
-                    for ls_pop in range(0,n_ls):
-                        if pop_cell[0,ls_pop] == 0: continue
-                        norm_tm = tm[:,ls_pop]
-                        sum_col = norm_tm.sum()
-                        if sum_col > 1.0:
-                            norm_tm = norm_tm / sum_col
-                            # stochastically decide if decimal part of sum
-                            # considered an individual
-                            remainder = sum_col - int(sum_col)
-                            if random.rand() < remainder:
-                                sum_col = int(sum_col) + 1
-                            else:
-                                sum_col = int(sum_col)
-                        else: sum_col = 1
-                        x = random.rand(int(pop_cell[0,ls_pop] * sum_col))
-                        threshold = 0; sum_so_far = 0
-                        for ls_dest in range(0,n_ls):
-                            threshold += norm_tm[ls_dest]
-                            individuals = (x < threshold).sum()
-                            out_cell[ls_dest] += individuals - sum_so_far
-                            sum_so_far = individuals
+                    out_cells[:, block] = self.transition_by_individual(tms,
+                            b_pop_cells, rng)
                 else:
-                    out_cell = numpy.dot(tm,in_row_array[1:,j])
-                #if pop_cell[0,0] != 0:
-                #    print "T matrix: " + str(tm)
-                #    print "before: " + str(pop_cell)
-                #    print "after: " + str(out_cell)
-                out_row_array[0,j] = in_row_array[0,j]
-                out_row_array[1:,j] = out_cell
-                
-            for i in range(array_depth): 
-                if row == 0:
-                    fo_out_list[i].writelines(self.header)
-                self.write_lines_remove_zero(fo_out_list[i], out_row_array[i])
-
-            
-        for i in range(1,len(fo_out_list)):
-            fo_out_list[i].close() # close temp out files
-            fo_in_list[i].close() # close temp in files
-            if i==0:
-                pass # closes index file without re-writing it
-            else: # re-write temp ascii files to rasters in GRASS workspace
-                ascii_fn = temp_out_rasters[i-1]
-                rast_name = out_pop_rasters[i-1]
-                grass.get_g().import_ascii_to_raster(ascii_fn,rast_name,0)
-            # remove temporary ascii map files
-            os.remove(temp_rasters[i-1])
-            os.remove(temp_out_rasters[i-1])
-
-    def write_lines_remove_zero(self,out_file,out_row):
-        for val in out_row:
-            if val == 0:
-                out_file.write('* ')
-            else:
-                out_file.write(str(val) + " ")
-        out_file.write("\n")
-
-        #out_file.writelines(str(out_row_array[i]).strip(' []') \
-                #+ '\n')
+                    out_cells[:, block] = numpy.einsum('ijn,jn->in', tms,
+                            b_pop_cells)
+        return [SparseRaster(p.shape, rows, cols, out) for p, out in
+                zip(pops, out_cells)]
+
+    def transition_by_individual(self, tms, pop_cells, rng=random):
+        """ Calculate the transition by individual behaviour, for a block of
+        cells at once.
+
+        tms has shape (n_ls, n_ls, n) and pop_cells (n_ls, n). Each column of
+        a cell's matrix gives the probability that an individual of that
+        lifestage becomes one of each lifestage, with the rest dying. If a
+        column sums to more than 1.0 then it is normalised, and each
+        individual instead becomes the sum of the column individuals,
+        rounded up or down at random in proportion to the fraction. The
+        individuals of each source lifestage are then shared out between
+        the destinations with a multinomial draw, done as a binomial draw
+        for each destination in turn.
+        """
+        n_ls, n = pop_cells.shape
+        out_cells = numpy.zeros((n_ls, n))
+        for ls_pop in range(0, n_ls):
+            norm_tm = tms[:, ls_pop, :]
+            sum_col = norm_tm.sum(axis=0)
+            multiple = sum_col > 1.0
+            norm_tm = numpy.where(multiple, norm_tm / numpy.where(multiple,
+                sum_col, 1.0), norm_tm)
+            # stochastically decide if decimal part of sum
+            # considered an individual
+            whole = numpy.floor(sum_col)
+            rounded = whole + (rng.rand(n) < sum_col - whole)
+            sum_col = numpy.where(multiple, rounded, 1)
+            remaining = (pop_cells[ls_pop] * sum_col).astype(numpy.int64)
+            remaining_p = numpy.ones(n)
+            for ls_dest in range(0, n_ls):
+                p = numpy.clip(norm_tm[ls_dest] / numpy.maximum(remaining_p,
+                    1e-300), 0.0, 1.0)
+                individuals = rng.binomial(remaining, p)
+                out_cells[ls_dest] += individuals
+                remaining -= individuals
+                remaining_p -= norm_tm[ls_dest]
+        return out_cells
 
     def xml_to_index(self):
         x = self.xml_dom.getElementsByTagName("populationModule")[0]
@@ -505,6 +619,12 @@ class LifestageTransition:
                 # Not actually None, but CODA deals with index within gen_val
                 param_dict[parameter]["None"] = ParamGenerator(source, index, dist,
                     value_list, model_dir)
+            elif source == 'map':
+                # Maps are shared read-only by replicates and workers
+                cache_dir = os.path.join(self.model.get_mdig_dir_path(),
+                        "raster_cache")
+                param_dict[parameter][index] = ParamGenerator(source, index, dist,
+                    value_list, model_dir, cache_dir)
             else:
                 param_dict[parameter][index] = ParamGenerator(source, index, dist,
                     value_list, model_dir)
@@ -193,6 +193,10 @@ class Treatment(object):
         self.index = t_index
         # temporary map name
         self.area_temp = None
+        # the instance and mapset that area_temp is for, and whether it has
+        # no cells
+        self.area_key = None
+        self.area_empty = None
         # temporary map name
         self.var_temp = "x_t___strategy_" + \
             self.strategy.get_name() + "_var_t_" + str(self.index)
@@ -257,33 +261,63 @@ class Treatment(object):
                     self.areas.append(TreatmentArea(a, self, len(self.areas)))
         return self.areas
 
-    def get_treatment_area_map(self, replicate):
+    def get_treatment_area_map(self, replicate, batch=None):
         """ Ensure all TreatmentAreas are initialised and return a merged map.
 
         Returns None if there is no area specified. This would mean the treatment
         is for the whole region.
+
+        If a MapcalcBatch is given, then a merged map that needs regenerating
+        is added to the batch instead of being created immediately.
         """
         areas = self.load_areas()
         if len(areas) == 0:
             return None
-        return self._merge_areas(replicate)
+        g = grass.get_g()
+        key = (replicate.instance, g.get_mapset())
+        if key != self.area_key:
+            # Areas that don't change are still different for each instance,
+            # e.g. when they use START_MAP, and parallel replicates each run
+            # in a scratch mapset that the map doesn't outlive
+            if self.area_temp is not None and self.area_key[1] == key[1]:
+                g.remove_map(self.area_temp)
+            self.area_key = key
+            self.area_empty = None
+            self.area_temp = None
+        return self._merge_areas(replicate, batch)
 
-    def _merge_areas(self, replicate):
+    def is_dynamic(self):
+        """ True if any of the treatment's areas change each timestep """
+        for a in self.load_areas():
+            if a.is_dynamic():
+                return True
+        return False
+
+    def is_area_empty(self):
+        """ True if the treatment area map last returned by
+        get_treatment_area_map has no cells.
+
+        For areas that aren't dynamic, this is only checked once for each
+        instance.
+        """
+        if self.area_temp is None:
+            # The treatment is for the whole region
+            return False
+        if self.area_empty is None or self.is_dynamic():
+            range_info = grass.get_g().get_raster_range(self.area_temp)
+            self.area_empty = 'NULL' in range_info.values()
+        return self.area_empty
+
+    def _merge_areas(self, replicate, batch=None):
         """
         Merge all the TreatmentArea maps based on the combine attribute
         ("and" or "or" them)
         """
         # Check whether the component Areas change between calls
         if self.area_temp is not None:
-            # Whether we need to regenerate the merged area map
-            generate = False
-            for a in self.areas:
-                if a.is_dynamic():
-                    # if just one component area is dynamic, we have to regenerate
-                    # the merged treatment area.
-                    generate = True
-                    break
-            if not generate:
+            # if just one component area is dynamic, we have to regenerate
+            # the merged treatment area.
+            if not self.is_dynamic():
                 # We can just return the last area map we generated if it's not dynamic
                 return self.area_temp
         else:
@@ -296,7 +330,12 @@ class Treatment(object):
         component_areas = self._get_component_area_maps(replicate)
         if len(component_areas) > 1:
             merge_str = self._get_area_merge_mapcalc_expression(component_areas)
-            g.mapcalc(self.area_temp, merge_str)
+            if batch is not None:
+                batch.add(self.area_temp, merge_str)
+            else:
+                g.mapcalc(self.area_temp, merge_str)
+        elif batch is not None:
+            batch.add(self.area_temp, component_areas[0])
         else:
             g.copy_map(component_areas[0], self.area_temp)
         return self.area_temp
@@ -373,7 +412,10 @@ class Treatment(object):
         """
         if not self.affects_var(var_key):
             return None
-        area_mask_map = self.get_treatment_area_map(replicate)
+        # If the area map needs regenerating, do it in the same r.mapcalc
+        # call as the variable map
+        batch = grass.get_g().mapcalc_batch()
+        area_mask_map = self.get_treatment_area_map(replicate, batch)
         if area_mask_map is None:
             # This means the treatment is applied globally, no need to return
             # a map
@@ -384,9 +426,9 @@ class Treatment(object):
         orig_value = var_val
         if orig_value is None:
             orig_value = "null()"
-        grass.get_g().mapcalc(self.var_temp,
-                              "if(" + area_mask_map + "==1,"
-                              + str(altered_value) + "," + str(orig_value) + ")")
+        batch.add(self.var_temp, "if(" + area_mask_map + "==1,"
+                  + str(altered_value) + "," + str(orig_value) + ")")
+        batch.run()
         return self.var_temp
 
     def get_altered_variable_value(self, var_key, var_val):
@@ -45,6 +45,7 @@ import mdig.outputformats as outputformats
 import mdig.grass as grass
 import mdig.config as config
 import mdig.utils as utils
+import mdig.parallel as parallel
 
 from mdig.region import Region
 from mdig.instance import DispersalInstance, DispersalInstanceException
@@ -84,6 +85,7 @@ class DispersalModel(object):
         self.regions={}
         self.ls_ids=None
         self.lifestages={}
+        self.phenology_schedules={}
         self.instances = None
         self.strategies = None
         self.activeInstances = []
@@ -456,10 +458,23 @@ class DispersalModel(object):
     def remove_listener(self,l):
         self.listeners.remove(l)
     
-    def run(self, instances=None):
+    def run(self, instances=None, jobs=1, queue=None):
+        """ Run all incomplete instances, with replicates spread over jobs
+        worker processes if jobs is more than 1, or put in a job queue for
+        workers on other hosts if a queue is given. """
         self.active = True
         self.start_time = datetime.now()
         self.log.info("Starting simulations at " + self.start_time.isoformat())
+
+        if queue is not None or jobs > 1:
+            if queue is not None:
+                runner = parallel.QueueRunner(self, queue)
+            else:
+                runner = parallel.ParallelRunner(self, jobs)
+            runner.run(instances)
+            self.active = False
+            self.end_time = datetime.now()
+            return
         
         r_instances = self._get_instances_by_region()
         
@@ -599,6 +614,13 @@ class DispersalModel(object):
         nodes = self.xml_model.xpath('/model/name')
         nodes[0].text = name
 
+    def get_engine(self):
+        """ Get the engine replicates are run with, "grass" or "array" """
+        engine = self.xml_model.xpath('/model/@engine')
+        if len(engine) == 1:
+            return engine[0].strip()
+        return "grass"
+
     def get_location(self):
         nodes = self.xml_model.xpath('/model/GISLocation')
         if len(nodes) == 0:
@@ -1158,35 +1180,33 @@ class DispersalModel(object):
                 maxInterval=max(maxInterval,max(intervals))
         return maxInterval
     
-    def phenology_iterator(self, region_id):
-        current_interval = -1
-        max_interval = self.get_max_phenology_interval(region_id)
+    def get_phenology_schedule(self, region_id):
+        """ Get the phenology schedule of a region, which is a list of
+        (interval, lifestages) in order of interval, where lifestages are
+        those that have the interval, in the order they are in the model.
 
-        while current_interval < max_interval:
-            (ls, interval)=self.get_earliest_lifestage(region_id, current_interval)
-            current_interval=interval
-            
-            for l in ls:
-                #TODO: Make the lifestage ordering predictable (when interval is the same)
-                yield (interval, ls)
+        The schedule is worked out the first time it's needed and kept for
+        any instances in the region.
+        """
+        if region_id not in self.phenology_schedules:
+            schedule = {}
+            for ls_id in self.get_lifestage_ids():
+                ls = self.get_lifestage(ls_id)
+                intervals = ls.get_phenology_intervals(region_id) or []
+                for interval in sorted(set(intervals)):
+                    if interval > -1:
+                        schedule.setdefault(interval, []).append(ls)
+            self.phenology_schedules[region_id] = sorted(schedule.items())
+        return self.phenology_schedules[region_id]
+
+    def phenology_iterator(self, region_id):
+        return iter(self.get_phenology_schedule(region_id))
 
     def get_earliest_lifestage(self, region_id, from_interval):
-        earliest_interval = self.get_max_phenology_interval(region_id)
-        earliest_ls = []
-        
-        for ls_id in self.get_lifestage_ids():
-            ls=self.get_lifestage(ls_id)
-            intervals = ls.get_phenology_intervals(region_id)
-            intervals = [i for i in intervals if i > from_interval]
-            if len(intervals) == 0:
-                # No more intervals in this lifestage
-                continue
-            if min(intervals) < earliest_interval:
-                earliest_ls = [ls]
-                earliest_interval=min(intervals)
-            elif min(intervals) == earliest_interval:
-                earliest_ls.append(ls)
-        return (earliest_ls,earliest_interval)
+        for interval, ls in self.get_phenology_schedule(region_id):
+            if interval > from_interval:
+                return (list(ls), interval)
+        return ([], self.get_max_phenology_interval(region_id))
             
     def remove_active_instance(self, instance):
         if instance in self.activeInstances:
@@ -1304,6 +1324,12 @@ class DispersalModel(object):
         """
         return self.get_name()
 
+    def get_mdig_dir_path(self):
+        """ Get the mdig directory in the model's mapset """
+        g = self.grass_i
+        db = g.grass_vars['GISDBASE']
+        return os.path.join(db, self.infer_location(), self.get_mapset(), 'mdig')
+
     def get_mapsets(self, include_root=True):
         """ Return all the mapsets that instances refer to.
 
@@ -1499,10 +1525,14 @@ class DispersalModel(object):
                      self.backup_filename = self.backup_file(filename)
                  else:
                      self.backup_file(filename,self.backup_filename)
-            fo = open(filename,'w')
+            # Write to a temporary file first, so that workers reading the
+            # model never see it half written
+            tmp_filename = filename + ".tmp"
+            fo = open(tmp_filename,'w')
 #print >>fo, self._indent_xml(self.xml_model)
             print >>fo, lxml.etree.tostring(self.xml_model,pretty_print=True)
             fo.close()
+            os.rename(tmp_filename, filename)
             self.model_file = filename
         except OSError, e:
             self.log.error("Couldn't save updated version of model file")
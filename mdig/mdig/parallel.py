@@ -0,0 +1,296 @@
+"""
+Running replicates in parallel worker processes.
+
+The replicates to run are prepared in this process, in the order that
+DispersalModel.run would run them, so each replicate gets the same seed from
+the model's random stream however many workers there are. Workers are forked
+after this, and each gets its own GISRC and GIS_LOCK so their GRASS commands
+don't interfere. A replicate is run in a scratch mapset of its own, then its
+maps are moved into the instance mapset and its XML node replaces the one in
+the model.
+
+Replicates can also be farmed out to workers on other hosts that share the
+GISDBASE. The replicates are prepared in the same way and put in a JobQueue
+in the model's mdig directory, then "mdig.py worker" processes claim and run
+them, and write their results for the coordinating process to merge.
+"""
+import logging
+import multiprocessing
+import traceback
+import datetime
+import threading
+import socket
+import time
+import os
+import re
+import itertools
+
+import lxml.etree
+
+import grass
+from commandprofile import profiler
+from tempresource import trm
+from jobqueue import JobQueue
+
+# The model being run, which forked workers inherit
+_model = None
+
+
+class WorkerException(Exception):
+    """ A replicate failed in a worker, the message is the traceback """
+    pass
+
+
+def scratch_mapset_name(instance, r_index):
+    return "%s_rep%d" % (instance.get_mapset(), r_index)
+
+
+def _init_worker():
+    grass.get_g().init_worker()
+    # Temporary resources and profile stats so far belong to the parent
+    trm.temp_files = set()
+    profiler.reset()
+
+
+def run_in_mapset(model, i_index, r_index, scratch):
+    """ Run a prepared replicate in the scratch mapset, and return its XML
+    node as a string and the time it took """
+    instance = model.get_instances()[i_index]
+    rep = instance.replicates[r_index]
+    grass.get_g().change_mapset(scratch, model.infer_location(),
+            create=True,
+            in_path=[instance.get_mapset(), model.get_mapset()])
+    instance.work_mapset = scratch
+    try:
+        rep.run(reset=False, save=False)
+    finally:
+        instance.work_mapset = None
+    return lxml.etree.tostring(rep.node), instance.rep_times[-1]
+
+
+def _run_job(job):
+    i_index, r_index = job
+    try:
+        scratch = scratch_mapset_name(_model.get_instances()[i_index], r_index)
+        node_xml, rep_time = run_in_mapset(_model, i_index, r_index, scratch)
+        result = (i_index, r_index, scratch, node_xml, rep_time, profiler.stats)
+        profiler.reset()
+        return result
+    except Exception:
+        raise WorkerException(traceback.format_exc())
+
+
+class ParallelRunner(object):
+    """ Runs the replicates of several instances in a pool of processes """
+
+    def __init__(self, model, jobs):
+        self.model = model
+        self.jobs = jobs
+        self.log = logging.getLogger("mdig.parallel")
+        # (instance index, replicate index) -> whether replicate is new
+        self.pending = {}
+
+    def order_instances(self, instances=None):
+        """ Order incomplete instances the way DispersalModel.run does """
+        if instances is None:
+            instances = self.model.get_instances()
+        ordered = []
+        for r_id, r_instances in self.model._get_instances_by_region().items():
+            remaining = [i for i in r_instances if i in instances and
+                    i.enabled and not i.is_complete()]
+            while remaining:
+                i = self.model._get_instance_w_smallest_reps_remaining(remaining)
+                ordered.append(i)
+                remaining.remove(i)
+        return ordered
+
+    def prepare(self, instances=None):
+        """ Set up the replicates to run, and return their jobs """
+        job_list = []
+        for instance in self.order_instances(instances):
+            i_index = instance.get_index()
+            for rep, is_new in instance.prepare_replicates():
+                job = (i_index, instance.replicates.index(rep))
+                self.pending[job] = is_new
+                job_list.append(job)
+        # Seeds have been taken from the random stream, so save that
+        self.model.save_model()
+        return job_list
+
+    def run(self, instances=None):
+        global _model
+        job_list = self.prepare(instances)
+        if not job_list:
+            return
+        self.log.info("Running %d replicates with %d workers" %
+                (len(job_list), self.jobs))
+        _model = self.model
+        pool = multiprocessing.Pool(self.jobs, _init_worker)
+        try:
+            for result in pool.imap_unordered(_run_job, job_list):
+                self.merge(result)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+            _model = None
+
+    def merge(self, result):
+        """ Move a completed replicate's maps and XML into the model """
+        i_index, r_index, scratch, node_xml, rep_time, stats = result
+        instance = self.model.get_instances()[i_index]
+        rep = instance.replicates[r_index]
+        g = grass.get_g()
+
+        new_node = lxml.etree.fromstring(node_xml)
+        map_names = [m.text for m in new_node.xpath('lifestage/maps/map')]
+        g.move_maps(map_names, scratch, instance.get_mapset())
+        g.remove_mapset(scratch, force=True)
+
+        rep.node.getparent().replace(rep.node, new_node)
+        rep.node = new_node
+        rep.saved_maps = None
+        rep.complete = True
+        instance.rep_times.append(rep_time)
+        profiler.merge(stats)
+        self.model.save_model()
+        self.log.debug("Merged replicate %d of instance %d from %s" %
+                (r_index, i_index, scratch))
+
+        if self.pending.pop((i_index, r_index)):
+            for l in instance.listeners:
+                if "replicate_complete" in dir(l):
+                    l.replicate_complete(rep)
+
+
+def job_id(i_index, r_index):
+    return "i%d_r%d" % (i_index, r_index)
+
+
+def get_job_queue(model, stale_timeout=600):
+    """ Get the job queue in the mdig directory of the model's mapset """
+    return JobQueue(os.path.join(model.get_mdig_dir_path(), "jobs"),
+            stale_timeout)
+
+
+class QueueRunner(ParallelRunner):
+    """ Puts replicates in a job queue for workers on other hosts to run,
+    and merges the results as they complete """
+
+    def __init__(self, model, queue, poll_interval=5):
+        super(QueueRunner, self).__init__(model, 0)
+        self.queue = queue
+        self.poll_interval = poll_interval
+
+    def run(self, instances=None):
+        job_list = self.prepare(instances)
+        if not job_list:
+            return
+        self.queue.clear()
+        for i_index, r_index in job_list:
+            rep = self.model.get_instances()[i_index].replicates[r_index]
+            self.queue.put(job_id(i_index, r_index), {"instance": i_index,
+                "replicate": r_index, "seed": rep.get_seed()})
+        self.log.info("Queued %d replicates in %s, waiting for workers" %
+                (len(job_list), self.queue.queue_dir))
+        while self.pending:
+            self.poll()
+            if self.pending:
+                time.sleep(self.poll_interval)
+
+    def poll(self):
+        for j_id in self.queue.requeue_stale():
+            self.log.warning("No heartbeat from worker running %s, requeued" % j_id)
+        for j_id, token, result in self.queue.results():
+            job = (result["instance"], result["replicate"])
+            if job not in self.pending:
+                # Job was requeued and completed twice
+                self.log.debug("Ignoring repeated result for %s" % j_id)
+                grass.get_g().remove_mapset(result["mapset"], force=True)
+                continue
+            stats = dict([(tuple(k), v) for k, v in result["stats"]])
+            self.merge(job + (result["mapset"], result["node"],
+                datetime.timedelta(seconds=result["seconds"]), stats))
+        for j_id, token, message in self.queue.failures():
+            raise WorkerException("Job %s failed on worker %s:\n%s" %
+                    (j_id, token, message))
+
+
+class QueueWorker(object):
+    """ Claims replicate jobs from a queue and runs them until there are
+    none left """
+
+    def __init__(self, model, queue, heartbeat_interval=60, poll_interval=5,
+            wait=False):
+        self.model = model
+        self.queue = queue
+        self.heartbeat_interval = heartbeat_interval
+        self.poll_interval = poll_interval
+        # Keep waiting for jobs once the queue is empty
+        self.wait = wait
+        self.log = logging.getLogger("mdig.parallel")
+        host = re.sub("[^A-Za-z0-9]", "", socket.gethostname())
+        self.token_base = "%s%d" % (host, os.getpid())
+        self.claim_counter = itertools.count()
+
+    def run(self):
+        while True:
+            token = "%s_%d" % (self.token_base, self.claim_counter.next())
+            claim = self.queue.claim(token)
+            if claim is None:
+                if not self.wait and self.queue.is_empty():
+                    break
+                time.sleep(self.poll_interval)
+                continue
+            j_id, job = claim
+            self.log.info("Claimed job %s" % j_id)
+            stop = threading.Event()
+            beat = threading.Thread(target=self._heartbeat,
+                    args=(j_id, token, stop))
+            beat.daemon = True
+            beat.start()
+            try:
+                result = self.run_job(job, token)
+            except Exception:
+                self.log.error("Job %s failed" % j_id)
+                self.queue.fail(j_id, token, traceback.format_exc())
+            else:
+                self.queue.complete(j_id, token, result)
+            finally:
+                stop.set()
+                beat.join()
+
+    def _heartbeat(self, j_id, token, stop):
+        while not stop.wait(self.heartbeat_interval):
+            if not self.queue.heartbeat(j_id, token):
+                self.log.warning("Claim on job %s was requeued" % j_id)
+                return
+
+    def get_replicate(self, i_index, r_index, seed):
+        """ Find the replicate for a job, reloading the model if the job was
+        queued after we loaded it """
+        for reload_model in (False, True):
+            if reload_model:
+                self.log.debug("Reloading model %s" % self.model.model_file)
+                self.model.remove_log_handler()
+                self.model = self.model.__class__(self.model.model_file,
+                        self.model.action)
+            reps = self.model.get_instances()[i_index].replicates
+            if r_index < len(reps) and reps[r_index].get_seed() == seed:
+                return reps[r_index]
+        raise WorkerException("Replicate %d of instance %d doesn't have seed %d"
+                % (r_index, i_index, seed))
+
+    def run_job(self, job, token):
+        i_index, r_index = job["instance"], job["replicate"]
+        self.get_replicate(i_index, r_index, job["seed"])
+        instance = self.model.get_instances()[i_index]
+        scratch = "%s_%s" % (scratch_mapset_name(instance, r_index), token)
+        profiler.reset()
+        node_xml, rep_time = run_in_mapset(self.model, i_index, r_index,
+                scratch)
+        seconds = rep_time.days * 86400 + rep_time.seconds + \
+                rep_time.microseconds / 1.0e6
+        return {"instance": i_index, "replicate": r_index, "mapset": scratch,
+                "node": node_xml, "seconds": seconds,
+                "stats": [[list(k), v] for k, v in profiler.stats.items()]}
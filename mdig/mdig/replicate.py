@@ -24,14 +24,18 @@ import string
 import os
 import datetime
 import dateutil.parser
+import cPickle as pickle
+import numpy
 from operator import itemgetter
 
 import grass 
 import config
 import outputformats
 import model
+import arrayengine
 from mdig.grass import MapNotFoundException
 from mdig.analysis import AnalysisOutputFileExists
+from mdig.commandprofile import profiler
 
 
 class Metric(object):
@@ -121,9 +125,6 @@ class Metric(object):
 class Replicate(object):
     """
     Replicate is a class for each replication simulated for an DispersalInstance
-
-    @todo: load/store and use previous maps. getprevious_map doesn't work as
-    intended.
     """
 
     def __init__(self, node, instance, r_index=0):
@@ -137,6 +138,7 @@ class Replicate(object):
         self.current_t = -1
         self.initial_maps = {}
         self.previous_maps = None
+        self.history_depths = None
         self.saved_maps = None
         self.map_intervals = None
         # used to keep track of index in replicates while loading:
@@ -168,6 +170,8 @@ class Replicate(object):
 
         self.random = random.Random()
         self.random.seed(self.get_seed())
+        # Used for random parameters of lifestage transitions
+        self.np_random = numpy.random.RandomState(self.get_seed() % (2 ** 32))
         
     def check_complete(self):
         complete = True
@@ -246,6 +250,7 @@ class Replicate(object):
         TODO: update xml 
         """
         g = grass.get_g()
+        maps_to_remove = []
         for ls_id in self.instance.experiment.get_lifestage_ids():
             ls_saved_maps=[]
             try:
@@ -259,9 +264,9 @@ class Replicate(object):
                         self.instance.get_mapset() + \
                         "', so forgetting about it.")
             finally:
-                for m in ls_saved_maps:
-                    # remove map
-                    g.remove_map(m,self.instance.get_mapset())
+                # saved maps are keyed by time step
+                if ls_saved_maps:
+                    maps_to_remove.extend(ls_saved_maps.values())
         
             ls_node = self.node.xpath('lifestage[@id="%s"]' % ls_id)
             if len(ls_node) == 0: continue
@@ -269,6 +274,8 @@ class Replicate(object):
             maps_node = ls_node[0].xpath('maps')
             if len(maps_node) != 0:
                 ls_node[0].remove(maps_node[0])
+        if maps_to_remove:
+            g.remove_maps(maps_to_remove, self.instance.get_mapset())
         
     def null_bitmask(self, generate_null=True):
         """ Create null bitmasks for raster maps"""
@@ -338,6 +345,18 @@ class Replicate(object):
         maps = self.previous_maps[ls_id]
         return maps
         
+    def get_history_depth(self,ls_id):
+        """ Return how many previous maps are kept for lifestage ls_id, which
+        is the most that any of its analyses look back """
+        if self.history_depths is None:
+            self.history_depths = {}
+            exp = self.instance.experiment
+            for ls_key in exp.get_lifestage_ids():
+                depths = [a.get_history_depth() for a in
+                        exp.get_lifestage(ls_key).analyses()]
+                self.history_depths[ls_key] = max([0] + depths)
+        return self.history_depths[ls_id]
+
     def get_previous_map(self,ls_id,offset=1):
         maps = self.get_previous_maps(ls_id)
         if offset <= len(maps):
@@ -355,17 +374,182 @@ class Replicate(object):
     
     def reset(self):
         # Map are removed/overwritten automatically
+        self.remove_checkpoint()
         self.node.getparent().remove(self.node)
         del self.node
         self.node = self.instance.experiment.add_replicate(self.instance.node)
         self.complete = False
         self.set_seed(self.instance.experiment.next_random_value())
+        # So the replicate can be rerun from the seed saved in the model
+        self.random.seed(self.seed)
+        self.np_random.seed(self.seed % (2 ** 32))
+
+    def get_checkpoint_filename(self):
+        return os.path.join(self.instance.experiment.base_dir, "checkpoints",
+                self.get_map_name_base())
+
+    def save_checkpoint(self, t, save_model=True):
+        """ Save what is needed to resume the replicate from the start of
+        timestep t.
+
+        The current population maps are copied to maps that aren't removed
+        at exit, and everything else goes in a file in the model's
+        checkpoints directory. The model is saved too so that the seed the checkpoint is
+        for isn't lost. The previous maps are copied too, since record_maps
+        reuses their names once the history is full. Treatment area maps
+        aren't saved, since they're made again from the populations when
+        they're next needed.
+
+        The replicate's XML node is kept in the checkpoint as well, because
+        parallel workers don't save the model, so the maps and analyses
+        recorded before the checkpoint would otherwise be forgotten.
+        """
+        g = self.grass_i
+        state = {
+            'seed': self.get_seed(),
+            'time': t,
+            'mapset': g.get_mapset(),
+            'maps': {},
+            'previous_maps': {},
+            'analysis_files': {},
+            'metrics': self.metrics.metrics,
+            'node': lxml.etree.tostring(self.node),
+            'random': self.random.getstate(),
+            'np_random': self.np_random.get_state()
+        }
+        for ls_id, names in self.temp_map_names.items():
+            m = "%s_checkpoint_%s" % (self.get_map_name_base(), ls_id)
+            g.copy_map(names[0], m, True)
+            state['maps'][ls_id] = m
+        for fn in self.get_analysis_append_files():
+            # Output appended after the checkpoint is removed on restore
+            size = 0
+            if os.path.isfile(fn):
+                size = os.path.getsize(fn)
+            state['analysis_files'][fn] = size
+        for ls_id, names in (self.previous_maps or {}).items():
+            state['previous_maps'][ls_id] = []
+            for i, name in enumerate(names):
+                m = "%s_checkpoint_%s_prev_%d" % (self.get_map_name_base(), ls_id, i)
+                g.copy_map(name, m, True)
+                state['previous_maps'][ls_id].append(m)
+        if save_model:
+            self.instance.experiment.save_model()
+        fn = self.get_checkpoint_filename()
+        if not os.path.isdir(os.path.dirname(fn)):
+            os.makedirs(os.path.dirname(fn))
+        f = open(fn + ".tmp", 'wb')
+        try:
+            pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+        os.rename(fn + ".tmp", fn)
+        self.log.debug("Saved checkpoint for t=%d to %s" % (t, fn))
+
+    def get_analysis_append_files(self):
+        """ The files that the replicate's analyses append to """
+        exp = self.instance.experiment
+        files = []
+        for ls_id in exp.get_lifestage_ids():
+            for a in exp.get_lifestage(ls_id).analyses():
+                fn = a.get_append_file(self)
+                if fn is not None:
+                    files.append(fn)
+        return files
+
+    def _read_checkpoint(self, fn):
+        try:
+            f = open(fn, 'rb')
+            try:
+                return pickle.load(f)
+            finally:
+                f.close()
+        except (IOError, EOFError, pickle.UnpicklingError), e:
+            self.log.warning("Couldn't load checkpoint %s: %s" % (fn, str(e)))
+            return None
+
+    def load_checkpoint(self):
+        """ Load the replicate's checkpoint, or return None if there isn't
+        one for the replicate's current seed """
+        fn = self.get_checkpoint_filename()
+        if not os.path.isfile(fn):
+            return None
+        state = self._read_checkpoint(fn)
+        if state is None or state['seed'] != self.get_seed():
+            return None
+        return state
+
+    def restore_checkpoint(self, state):
+        """ Restore the state saved by save_checkpoint, and return the
+        timestep to resume from """
+        g = self.grass_i
+        mapset = state['mapset']
+        if 'node' in state:
+            node = lxml.etree.fromstring(state['node'])
+            self.node.getparent().replace(self.node, node)
+            self.node = node
+            self.saved_maps = None
+            if mapset != g.get_mapset():
+                # Maps output before the checkpoint are in the old mapset
+                for m in node.xpath('lifestage/maps/map'):
+                    g.copy_map(m.text + "@" + mapset, m.text, True)
+        for ls_id, m in state['maps'].items():
+            g.copy_map(m + "@" + mapset, self.temp_map_names[ls_id][0], True)
+        if self.previous_maps:
+            g.remove_maps(sum(self.previous_maps.values(), []))
+        self.previous_maps = None
+        for ls_id, names in state['previous_maps'].items():
+            for m in names:
+                new_map = g.generate_map_name(ls_id, temporary=False)
+                g.copy_map(m + "@" + mapset, new_map, True)
+                self.push_previous_map(ls_id, new_map)
+        for fn, size in state.get('analysis_files', {}).items():
+            if os.path.isfile(fn) and os.path.getsize(fn) > size:
+                f = open(fn, 'r+b')
+                try:
+                    f.truncate(size)
+                finally:
+                    f.close()
+        self.metrics.metrics = state['metrics']
+        self.random.setstate(state['random'])
+        if 'np_random' in state:
+            self.np_random.set_state(state['np_random'])
+        return state['time']
+
+    def remove_checkpoint(self):
+        """ Remove the checkpoint file and maps, if there are any """
+        fn = self.get_checkpoint_filename()
+        if not os.path.isfile(fn):
+            return
+        state = self._read_checkpoint(fn)
+        if state is not None:
+            maps = state['maps'].values() + \
+                sum(state['previous_maps'].values(), [])
+            self.grass_i.remove_maps([m + "@" + state['mapset'] for m in maps])
+        os.remove(fn)
 
     def record_maps(self, remove_null=False):
+        """ Copy the current maps to the previous maps of each lifestage.
+
+        Only as many previous maps are kept as the lifestage's analyses use,
+        so once there are enough the oldest map is overwritten, and nothing
+        is recorded for lifestages without analyses that use them.
+        """
         # If not active, then there are no temp_map_names to copy
         if not self.active: return
         for ls_id in self.instance.experiment.get_lifestage_ids():
-            new_map = grass.get_g().generate_map_name(ls_id)
+            depth = self.get_history_depth(ls_id)
+            if depth == 0: continue
+            maps = self.get_previous_maps(ls_id)
+            new_map = None
+            while len(maps) >= depth:
+                old_map = maps.pop(0)
+                if new_map is None:
+                    new_map = old_map
+                else:
+                    self.grass_i.remove_map(old_map)
+            if new_map is None:
+                new_map = grass.get_g().generate_map_name(ls_id, temporary=False)
             self.grass_i.copy_map(self.temp_map_names[ls_id][0],new_map,True)
             self.push_previous_map(ls_id,new_map)
             if remove_null:
@@ -390,20 +574,72 @@ class Replicate(object):
         self.log.log(logging.INFO, rep_info_str)
 
 
-    def run(self, remove_null=False):
-        self.reset()
+    def run(self, remove_null=False, reset=True, save=True):
+        """ Run the replicate.
+
+        reset=False keeps the seed that the replicate already has, and
+        save=False doesn't save the model file once the replicate completes.
+        Both are used when the replicate is run in a parallel worker.
+
+        If the replicate has a checkpoint from an earlier run with the same
+        seed, then it resumes from the checkpoint instead of being reset.
+        """
+        checkpoint = self.load_checkpoint()
+        if checkpoint is None and reset:
+            self.reset()
         self.active = True
         self.instance.add_active_rep(self)
         
         exp = self.instance.experiment
         
         self._log_replicate_start()
+        profiler.set_context(instance=self.instance.get_index(),
+                replicate=self.r_index, timestep=None)
         
         self.instance.set_region()
         
         # Get the initial distribution maps for the region
         self.initial_maps = exp.get_initial_maps(self.instance.r_id)
 
+        if not self._run_with_array_engine():
+            self._run_with_grass(remove_null, checkpoint, save)
+
+        self.instance.rep_times.append(datetime.datetime.now() - self.start_time)
+
+        self.instance.remove_active_rep(self)
+        if save:
+            self.instance.experiment.save_model()
+        self.metrics.save()
+        self.remove_checkpoint()
+
+        self.active = False
+        self.current_t = -1
+        profiler.set_context(instance=None, replicate=None, timestep=None)
+        self.complete = True
+        self.clean_up()
+
+    def _run_with_array_engine(self):
+        """ Run the time loop with the ArrayEngine, if the model asks for it.
+
+        Returns False if the model uses the GRASS engine or something the
+        ArrayEngine doesn't support, in which case nothing has been run.
+        """
+        if self.instance.experiment.get_engine() != "array":
+            return False
+        engine = arrayengine.ArrayEngine(self)
+        try:
+            engine.check()
+        except arrayengine.UnsupportedModelException, e:
+            self.log.warning("Array engine doesn't support %s, using GRASS" % str(e))
+            return False
+        self.start_time = datetime.datetime.now()
+        engine.run()
+        return True
+
+    def _run_with_grass(self, remove_null=False, checkpoint=None, save=True):
+        """ Run the time loop with GRASS modules and rasters, from the start
+        of the period or from checkpoint """
+        exp = self.instance.experiment
         ls_keys = exp.get_lifestage_ids()
         
         for ls_key in ls_keys:
@@ -413,6 +649,10 @@ class Replicate(object):
                 self.grass_i.generate_map_name(ls_key),
                 self.grass_i.generate_map_name(ls_key)
             ]
+            if checkpoint is not None:
+                # Analyses carry on with the output they already had at the
+                # checkpoint
+                continue
             
             # copy initial map to temporary source map, overwrite if necessary
             self.grass_i.copy_map(
@@ -441,12 +681,24 @@ class Replicate(object):
         if strategy is not None:
             strategy.set_instance(self.instance)
 
+        start_t = period[0]
+        if checkpoint is not None:
+            start_t = self.restore_checkpoint(checkpoint)
+            self.log.info("Resuming replicate from checkpoint at t=%d", start_t)
+        checkpoint_interval = config.get_config().checkpoint_interval
+
         self.start_time = datetime.datetime.now()
         
-        for t in range(period[0], period[1] + 1):
+        schedule = exp.get_phenology_schedule(self.instance.r_id)
+        for t in range(start_t, period[1] + 1):
             self.current_t = t
+            profiler.set_context(timestep=t)
             self.log.log(logging.INFO, "t=%d", t)
 
+            if checkpoint_interval and t != start_t and \
+                    (t - period[0]) % checkpoint_interval == 0:
+                self.save_checkpoint(t, save)
+
             # keep a record of previous maps by saving to a non-temporary name
             self.record_maps(remove_null)
 
@@ -462,20 +714,21 @@ class Replicate(object):
                     dest_maps.append(self.temp_map_names[ls_id][1])
                 # Lifestage transition should automatically swap source/dest maps
                 self.log.debug("Applying lifestage transition matrix")
-                ls_transition.apply_transition(ls_keys, source_maps, dest_maps)
+                with profiler.scope(event="lifestage transition"):
+                    ls_transition.apply_transition(ls_keys, source_maps, dest_maps,
+                            self.np_random)
                 # swap the source/dest maps in preparation for next iteration
                 for ls_id in ls_keys:
                     self.temp_map_names[ls_id].reverse()
             
-            phenology_iterator = exp.phenology_iterator(self.instance.r_id)
-            
             # Run through phenology intervals
-            for current_interval, p_lifestages in phenology_iterator:
+            for current_interval, p_lifestages in schedule:
                 for lifestage in p_lifestages:
                     ls_key = lifestage.name
                     self.log.log(logging.INFO, 'Interval %d - Lifestage "%s"' +
                             ' started', current_interval, ls_key)
-                    lifestage.run(current_interval, self, self.temp_map_names[ls_key], strategy)
+                    with profiler.scope(lifestage=ls_key):
+                        lifestage.run(current_interval, self, self.temp_map_names[ls_key], strategy)
                 self.log.log(logging.INFO, 'Interval %d completed.', current_interval)
 
             # Run Analyses for each lifestage
@@ -484,24 +737,14 @@ class Replicate(object):
                 analyses = l.analyses()
                 if len(analyses) > 0:
                     self.log.info('Lifestage %s - Running analyses',ls_id)
-                    for a in analyses:
-                        a.run(self.temp_map_names[ls_key][0], self)
+                    with profiler.scope(lifestage=ls_id, event="analysis"):
+                        for a in analyses:
+                            a.run(self.temp_map_names[ls_id][0], self)
                     self.log.info('Lifestage %s - Analyses complete',ls_id)
                 else:
                     self.log.debug('Lifestage %s - No analyses',ls_id)
             self.fire_time_completed(t)
 
-        self.instance.rep_times.append(datetime.datetime.now() - self.start_time)
-
-        self.instance.remove_active_rep(self)
-        self.instance.experiment.save_model()
-        self.metrics.save()
-
-        self.active = False
-        self.current_t = -1
-        self.complete = True
-        self.clean_up()
-
     
     def add_analysis_result(self, ls_id, analysis_cmd):
         """
@@ -549,13 +792,12 @@ class Replicate(object):
         a.text = filename
 
     def clean_up(self):
+        maps_to_remove = []
         for l in self.temp_map_names.values():
-            self.grass_i.remove_map(l[0])
-            self.grass_i.remove_map(l[1])
+            maps_to_remove.extend(l)
         for ls_key in self.instance.experiment.get_lifestage_ids():
-            prev_maps = self.get_previous_maps(ls_key)
-            for m in prev_maps:
-                self.grass_i.remove_map(m)
+            maps_to_remove.extend(self.get_previous_maps(ls_key))
+        self.grass_i.remove_maps(maps_to_remove)
         self.previous_maps = None
                         
     def fire_time_completed(self,t):
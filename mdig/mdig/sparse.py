@@ -0,0 +1,117 @@
+"""
+Sparse rasters, for populations that only occupy a few cells of a region.
+
+A SparseRaster keeps just the coordinates and values of the cells that
+aren't null, in row major order, so work done on it scales with the number
+of occupied cells rather than the size of the region. GRASSInterface has
+read_raster_sparse and write_raster_sparse to convert to and from GRASS
+rasters.
+"""
+import numpy
+
+
+def univariate_stats(values, cells):
+    """ Calculate the statistics that r.univar -g reports for the values of
+    the non-null cells of a raster with cells cells in total.
+
+    The standard deviation and variance are population ones, as in r.univar,
+    and values r.univar can't report (e.g. when there are no non-null cells)
+    are left out.
+    """
+    stats = {'n': float(len(values)), 'cells': float(cells)}
+    stats['null_cells'] = stats['cells'] - stats['n']
+    if len(values) == 0:
+        return stats
+    stats['min'] = float(values.min())
+    stats['max'] = float(values.max())
+    stats['range'] = stats['max'] - stats['min']
+    stats['sum'] = float(values.sum())
+    stats['mean'] = stats['sum'] / stats['n']
+    stats['mean_of_abs'] = float(numpy.abs(values).sum()) / stats['n']
+    stats['variance'] = float(values.var())
+    stats['stddev'] = stats['variance'] ** 0.5
+    if stats['mean'] != 0.0:
+        stats['coeff_var'] = 100.0 * stats['stddev'] / stats['mean']
+    return stats
+
+
+class SparseRaster(object):
+    """ The non-null cells of a raster with the given shape, as arrays of
+    their rows, columns and values in row major order """
+
+    def __init__(self, shape, rows, cols, values):
+        self.shape = tuple(shape)
+        self.rows = numpy.asarray(rows, dtype=numpy.intp)
+        self.cols = numpy.asarray(cols, dtype=numpy.intp)
+        self.values = numpy.asarray(values, dtype=numpy.float64)
+
+    @classmethod
+    def from_array(cls, data, zero_is_null=False):
+        """ Make a SparseRaster from a 2D array, where NaN or masked cells
+        are null. With zero_is_null, cells that are zero are left out too,
+        as for population maps where both mean the cell is empty. """
+        data = numpy.ma.masked_invalid(data)
+        present = ~numpy.ma.getmaskarray(data)
+        if zero_is_null:
+            present &= (data.data != 0)
+        rows, cols = numpy.nonzero(present)
+        return cls(data.shape, rows, cols, data.data[rows, cols])
+
+    def __len__(self):
+        return len(self.values)
+
+    def flat_index(self):
+        return self.rows * self.shape[1] + self.cols
+
+    def to_array(self, null=numpy.nan):
+        """ Return a 2D array with null cells set to null """
+        data = numpy.empty(self.shape)
+        data.fill(null)
+        data[self.rows, self.cols] = self.values
+        return data
+
+    def values_at(self, rows, cols, null=0.0):
+        """ Return the values of the cells at rows and cols, with null for
+        those that aren't in the raster """
+        flat = self.flat_index()
+        wanted = numpy.asarray(rows) * self.shape[1] + numpy.asarray(cols)
+        result = numpy.empty(len(wanted))
+        result.fill(null)
+        if len(flat) == 0:
+            return result
+        i = numpy.minimum(numpy.searchsorted(flat, wanted), len(flat) - 1)
+        found = flat[i] == wanted
+        result[found] = self.values[i[found]]
+        return result
+
+    def univariate_stats(self):
+        return univariate_stats(self.values, self.shape[0] * self.shape[1])
+
+
+def occupied_cells(rasters):
+    """ Return the rows and columns, in row major order, of the cells that
+    are in any of the SparseRasters """
+    shape = rasters[0].shape
+    flat = numpy.unique(numpy.concatenate([r.flat_index() for r in rasters]))
+    return flat // shape[1], flat % shape[1]
+
+
+class OccupancyCounter(object):
+    """ Counts how many of a set of rasters occupy each cell """
+
+    def __init__(self, shape):
+        self.shape = tuple(shape)
+        self.counts = numpy.zeros(self.shape[0] * self.shape[1], dtype=numpy.int64)
+        self.total = 0
+
+    def add(self, raster):
+        self.counts[raster.flat_index()] += 1
+        self.total += 1
+
+    def envelope(self):
+        """ Return a SparseRaster of the proportion of the rasters that
+        occupied each cell, with cells that were never occupied as null """
+        flat = numpy.nonzero(self.counts)[0]
+        return SparseRaster(self.shape, flat // self.shape[1],
+                flat % self.shape[1],
+                self.counts[flat] / float(max(self.total, 1)))
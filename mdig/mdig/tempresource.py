@@ -1,5 +1,7 @@
 from tempfile import NamedTemporaryFile, mkstemp
+import itertools
 import os
+import time
 
 class TempResourceManager(object):
     """ Manage all requests for temporary files, maps, etc.
@@ -13,6 +15,14 @@ class TempResourceManager(object):
 
     def __init__(self):
         self.temp_files = set()
+        # Temporary map names are the pid, a token from when we started and
+        # a counter, so they can't collide with each other or with the maps
+        # of earlier runs that had the same pid.
+        self.map_counter = itertools.count()
+        self.map_token = "%x" % int(time.time())
+        # Callable that is passed a list of name@mapset strings to remove.
+        # Set by the GRASS interface, since we can't remove maps without it.
+        self.map_remover = None
 
     def temp_filename(self, prefix, suffix=''):
         """ mkstemp annoying opens a unix file descriptor instead of just creating a filename """
@@ -21,6 +31,23 @@ class TempResourceManager(object):
         os.close(f)
         return filename
 
+    def temp_map_name(self, base="", mapset=None, register=True):
+        """ Allocate a map name that no other call will return.
+
+        If register is True, and mapset is given, the map is removed on
+        cleanup unless it has been released or discarded first.
+        """
+        name = "%d_%s_%s_%d" % (os.getpid(), base, self.map_token,
+                self.map_counter.next())
+        if register and mapset:
+            self.temp_files.add((self.MAP, name + "@" + mapset))
+        return name
+
+    def discard(self, filename, resource_type=FILE):
+        """ Stop tracking a resource without removing it, e.g. because it
+        has been removed already """
+        self.temp_files.discard((resource_type, filename))
+
     def release(self, filename, resource_type=FILE):
         identifier = (resource_type, filename)
         if identifier not in self.temp_files:
@@ -32,13 +59,26 @@ class TempResourceManager(object):
         if resource_type == TempResourceManager.FILE:
             os.remove(filename)
         elif resource_type == TempResourceManager.MAP:
-            pass
+            self._release_maps([filename])
         elif resource_type == TempResourceManager.REGION:
             pass
 
-    def cleanup(self):
-        for file_type, filename in self.temp_files:
-            self._release(filename, file_type)
+    def _release_maps(self, map_names):
+        if self.map_remover is not None and len(map_names) > 0:
+            self.map_remover(map_names)
+
+    def cleanup(self, resource_type=None):
+        """ Release all resources, or just those of resource_type """
+        to_release = [x for x in self.temp_files
+                if resource_type is None or x[0] == resource_type]
+        maps = [filename for file_type, filename in to_release
+                if file_type == self.MAP]
+        # maps are removed together, since it's much faster to do in bulk
+        self._release_maps(maps)
+        for file_type, filename in to_release:
+            if file_type != self.MAP:
+                self._release(filename, file_type)
+            self.temp_files.discard((file_type, filename))
 
 
 trm = TempResourceManager()
@@ -0,0 +1,122 @@
+import unittest
+from mock import *
+
+import numpy
+from numpy import nan
+
+import mdig
+from mdig import arrayengine
+
+
+class ArrayEventTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = numpy.random.RandomState(1)
+        self.res = (1.0, 1.0)
+
+    def test_kernel_spread(self):
+        pop = numpy.ones((50, 50)) * nan
+        pop[25, 25] = 10
+        out = arrayengine.kernel_spread(pop, self.rng, self.res,
+                kernel='exponential', d_b=5.0, frequency=100.0)
+        # each jump adds an individual, and the source is unchanged
+        self.assertEqual(out[25, 25], 10.0)
+        added = numpy.nansum(out) - 10
+        self.assertTrue(0 < added <= 100 + 30)
+        self.assertTrue(numpy.all(out[~numpy.isnan(out)] >= 1))
+        # boolean jumps only mark presence
+        out = arrayengine.kernel_spread(pop, self.rng, self.res,
+                kernel='exponential', d_b=5.0, frequency=100.0, boolean=True)
+        out[25, 25] = nan
+        self.assertTrue(numpy.all(out[~numpy.isnan(out)] == 1))
+
+    def test_kernel_limits(self):
+        pop = numpy.ones((20, 20)) * nan
+        pop[10, 10] = 1
+        out = arrayengine.kernel_spread(pop, self.rng, self.res,
+                kernel='cauchy', d_b=5.0, frequency=50.0, limit=3.0)
+        rows, cols = numpy.nonzero(~numpy.isnan(out))
+        self.assertTrue(numpy.all(numpy.hypot(rows - 10, cols - 10) <= 3.75))
+        # immature cells are removed
+        out = arrayengine.kernel_spread(pop, self.rng, self.res, agem=2,
+                frequency=0.0)
+        self.assertTrue(numpy.all(numpy.isnan(out)))
+
+    def test_clark(self):
+        p = numpy.array([0.0, 0.5, 0.9])
+        d = arrayengine.clark(p, 10.0, 1.0)
+        self.assertEqual(d[0], 0.0)
+        # with shape 1 it's exponential with mean d
+        self.assertAlmostEqual(d[1], 10.0 * numpy.log(2), 1)
+        self.assertTrue(d[2] > d[1])
+
+    def test_spread_area(self):
+        # 8 neighbours within a radius of 1.5, minus one like the module
+        self.assertEqual(arrayengine.spread_area(1, self.res), 3)
+        self.assertEqual(arrayengine.spread_area(2, self.res), 11)
+        self.assertEqual(len(arrayengine.spread_offsets(1.5, self.res)), 8)
+
+    def test_local_spread_boolean(self):
+        pop = numpy.ones((5, 5)) * nan
+        pop[0, 0] = 1
+        out = arrayengine.local_spread(pop, self.res, 1.5, boolean=True)
+        self.assertEqual(numpy.nansum(out), 4)
+        self.assertEqual(out[1, 1], 1)
+        self.assertTrue(numpy.isnan(out[2, 2]))
+
+    def test_local_spread_population(self):
+        pop = numpy.ones((5, 5)) * nan
+        pop[2, 2] = 10
+        out = arrayengine.local_spread(pop, self.res, 1.0, proportion=0.5)
+        # 5 individuals over spread_area = 3 cells, so 1 each to the 4
+        # neighbours, and 2 left over stay
+        self.assertEqual(out[2, 2], 7)
+        self.assertEqual(out[1, 2], 1)
+        self.assertEqual(out[2, 3], 1)
+        self.assertTrue(numpy.isnan(out[1, 1]))
+
+    def test_survival(self):
+        pop = numpy.ones((100, 100))
+        out = arrayengine.survival(pop, self.rng, 30.0)
+        survived = numpy.sum(~numpy.isnan(out)) / 10000.0
+        self.assertTrue(0.27 < survived < 0.33)
+        self.assertTrue(numpy.all(numpy.isnan(
+            arrayengine.survival(pop, self.rng, 0.0))))
+
+    def test_growth(self):
+        pop = numpy.array([nan, 0.0, 10.0, 50.0])
+        out = arrayengine.growth(pop, 'skellam', 1.0, 100.0)
+        self.assertTrue(numpy.isnan(out[0]))
+        self.assertEqual(list(out[1:]), [0.0, 19.0, 75.0])
+        # integer maps use integer division like r.mapcalc
+        out = arrayengine.growth(pop, 'skellam', 1.0, 100.0, integer=True)
+        self.assertEqual(list(out[1:]), [0.0, 20.0, 100.0])
+        out = arrayengine.growth(pop, 'beverton', 2.0, 100.0)
+        self.assertAlmostEqual(out[2], 20.0 / 1.1)
+
+    def test_age_pop_recruit(self):
+        pop = numpy.array([nan, 0.0, 3.0])
+        out = arrayengine.age_pop(pop)
+        self.assertEqual(list(out[1:]), [0.0, 4.0])
+        out = arrayengine.recruit(pop, 0.5)
+        self.assertEqual(list(out[1:]), [0.0, 1.5])
+
+    def test_active_window(self):
+        pop = numpy.ones((20, 30)) * nan
+        self.assertEqual(arrayengine.active_window(pop, 1.0, self.res), None)
+        pop[5, 10] = 4.0
+        pop[6, 12] = 2.0
+        self.assertEqual(arrayengine.active_window(pop, None, self.res), None)
+        window = arrayengine.active_window(pop, 1.5, self.res)
+        self.assertEqual(window, (slice(2, 10), slice(7, 16)))
+        # Windows are clipped to the region
+        window = arrayengine.active_window(pop, 0.0, (2.0, 4.0))
+        self.assertEqual(window, (slice(4, 8), slice(9, 14)))
+        self.assertEqual(arrayengine.active_window(pop, 20.0, self.res), None)
+        # Spreading within the window gives the same result
+        window = arrayengine.active_window(pop, 2.0, self.res)
+        out = arrayengine.local_spread(pop, self.res, 2.0)
+        w_out = numpy.ones(pop.shape) * nan
+        w_out[window] = arrayengine.local_spread(pop[window], self.res, 2.0)
+        self.assertTrue(numpy.array_equal(numpy.isnan(out), numpy.isnan(w_out)))
+        self.assertEqual(numpy.nansum(out), numpy.nansum(w_out))
@@ -0,0 +1,62 @@
+import unittest
+import os
+import tempfile
+import csv
+
+import mdig
+from mdig.commandprofile import CommandProfiler
+
+class CommandProfilerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.p = CommandProfiler()
+        self.p.enabled = True
+
+    def test_disabled(self):
+        self.p.enabled = False
+        self.p.record('r.mapcalc', 1.0)
+        self.assertEqual(self.p.stats, {})
+
+    def test_record(self):
+        self.p.set_context(instance=0, replicate=1, timestep=2000)
+        self.p.record('r.mapcalc', 1.0, 10, 0)
+        with self.p.scope(lifestage='all', event='r.dispersal'):
+            self.p.record('r.dispersal', 3.0)
+            self.p.record('r.mapcalc', 0.5, 5, 2)
+        self.assertEqual(self.p.context['event'], None)
+        self.assertEqual(self.p.context['timestep'], 2000)
+        key = ('r.mapcalc', 0, 1, 2000, 'all', 'r.dispersal')
+        self.assertEqual(self.p.stats[key], [1, 0.5, 5, 2])
+        totals = self.p.module_totals()
+        self.assertEqual(totals[0], ('r.dispersal', 1, 3.0, 0, 0))
+        self.assertEqual(totals[1], ('r.mapcalc', 2, 1.5, 15, 2))
+        self.assertRaises(KeyError, self.p.set_context, wibble=1)
+        table = self.p.format_table()
+        self.assertTrue(table.split('\n')[1].startswith('r.dispersal'))
+
+    def test_merge(self):
+        self.p.record('r.mapcalc', 1.0, 10, 0)
+        other = CommandProfiler()
+        other.enabled = True
+        other.set_context(replicate=3)
+        other.record('r.mapcalc', 2.0, 5, 1)
+        other.record('g.region', 1.0)
+        self.p.merge(other.stats)
+        self.p.merge(other.stats)
+        totals = dict([(x[0], x[1:]) for x in self.p.module_totals()])
+        self.assertEqual(totals['r.mapcalc'], (3, 5.0, 20, 2))
+        self.assertEqual(totals['g.region'], (2, 2.0, 0, 0))
+
+    def test_write_csv(self):
+        self.p.record('r.mapcalc', 1.0)
+        self.p.record('g.region', 1.0)
+        fd, fn = tempfile.mkstemp(suffix='.csv')
+        os.close(fd)
+        try:
+            self.p.write_csv(fn)
+            rows = list(csv.reader(open(fn)))
+        finally:
+            os.remove(fn)
+        self.assertEqual(rows[0][0], 'module')
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(rows[1][:2], ['g.region', ''])
@@ -31,6 +31,24 @@ class DispersalModelTest(unittest.TestCase):
         # Check root xml node has been created
         self.assertEqual(dm.xml_model.tag, "model")
 
+    def test_phenology_schedule(self):
+        dm = DispersalModel()
+        ls = {}
+        for ls_id, intervals in [('a', [3, 1, 1]), ('b', [1, 5]), ('c', [])]:
+            ls[ls_id] = Mock()
+            ls[ls_id].get_phenology_intervals.return_value = intervals
+        dm.ls_ids = ['a', 'b', 'c']
+        dm.lifestages = ls
+        schedule = dm.get_phenology_schedule('r')
+        self.assertEqual(schedule, [(1, [ls['a'], ls['b']]), (3, [ls['a']]),
+            (5, [ls['b']])])
+        # Each group is only run once
+        self.assertEqual(list(dm.phenology_iterator('r')), schedule)
+        self.assertEqual(dm.get_earliest_lifestage('r', 1), ([ls['a']], 3))
+        # The schedule is kept
+        ls['c'].get_phenology_intervals.return_value = [2]
+        self.assertTrue(dm.get_phenology_schedule('r') is schedule)
+
     def test_model_constructor(self):
         dm = DispersalModel(the_action = RunAction())
         dm = DispersalModel(the_action = RunAction(), setup=False)
@@ -0,0 +1,67 @@
+import unittest
+from mock import *
+
+from lxml import etree
+
+from mdig.event import Event
+
+class EventTest(unittest.TestCase):
+
+    def setUp(self):
+        xml = """
+    <event name="r.mdig.kernel">
+      <param name="kernel"><value>cauchy</value></param>
+      <param name="d_a"><variable id="d_a"/></param>
+      <param name="freq"><variable id="freq"/></param>
+      <param name="seed"><seed/></param>
+      <ifPopulationBased><flag name="p"/></ifPopulationBased>
+    </event>
+    """
+        self.event = Event(etree.fromstring(xml))
+        self.instance = Mock()
+        self.instance.strategy = None
+        self.instance.experiment.get_management_strategy.return_value = None
+        self.instance.get_var.side_effect = {'d_a': 2.0, 'freq': None}.get
+        self.rep = Mock()
+        self.rep.instance = self.instance
+        self.rep.random.randint.return_value = 42
+
+    def test_compile(self):
+        template = self.event.get_template(self.instance, True)
+        self.assertTrue(template is self.event.get_template(self.instance, True))
+        self.assertFalse(template is self.event.get_template(self.instance, False))
+        args = template.command.split()
+        self.assertEqual(args[0], 'r.mdig.kernel')
+        self.assertEqual(sorted(args[1:]), ['-p', 'd_a=2.0', 'kernel=cauchy'])
+        self.assertEqual(sorted([x[1] for x in template.slots]),
+                ['IN', 'OUT', 'SEED'])
+
+    @patch('mdig.grass.get_g')
+    def test_run(self, m_get_g):
+        self.event.run('in_map', 'out_map', self.rep, False)
+        cmd = m_get_g.return_value.run_command.call_args[0][0]
+        self.assertEqual(sorted(cmd.split()[1:]), ['d_a=2.0',
+            'input=in_map', 'kernel=cauchy', 'output=out_map', 'seed=42'])
+        m_get_g.return_value.remove_map.assert_called_with('out_map')
+        # Variables are only looked up when the template is compiled
+        self.event.run('in_map', 'out_map', self.rep, False)
+        self.assertEqual(self.instance.get_var.call_count, 2)
+
+    @patch('mdig.grass.get_g')
+    def test_run_treatment(self, m_get_g):
+        s = Mock()
+        t = Mock()
+        t.affects_var.side_effect = lambda x: x == 'd_a'
+        t.get_variable_map.return_value = None
+        t.get_altered_variable_value.return_value = 1.0
+        s.get_treatments.return_value = [t]
+        s.get_treatments_for_param.return_value = []
+        self.instance.experiment.get_management_strategy.return_value = s
+        self.event.run('in_map', 'out_map', self.rep, False)
+        cmd = m_get_g.return_value.run_command.call_args[0][0]
+        self.assertTrue(' d_a=2.0 ' in cmd)
+        s.get_treatments_for_param.return_value = [t]
+        self.event.run('in_map', 'out_map', self.rep, False)
+        cmd = m_get_g.return_value.run_command.call_args[0][0]
+        self.assertTrue(' d_a=1.0 ' in cmd)
+        s.set_instance.assert_called_with(self.instance)
@@ -28,6 +28,189 @@ class GRASSCommandExceptionTest(unittest.TestCase):
         self.assertTrue('g.region' in str(e))
         self.assertTrue('10' in str(e))
 
+class GRASSSessionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.s = grass.GRASSSession()
+
+    def tearDown(self):
+        self.s.close()
+
+    def test_run(self):
+        self.assertEqual(self.s.run('echo hi; echo err >&2'), (0, 'hi\n', 'err\n'))
+        self.assertEqual(self.s.run('cat', 'some input\n'), (0, 'some input\n', ''))
+        # same shell is reused
+        pid = self.s.process.pid
+        self.s.run('true')
+        self.assertEqual(self.s.process.pid, pid)
+
+    def test_run_argv(self):
+        self.assertEqual(self.s.run(['echo', 'a b', "c'd"])[1], "a b c'd\n")
+
+    def test_exit_code(self):
+        self.assertEqual(self.s.run('false')[0], 1)
+        # commands that kill the shell cause it to be restarted
+        self.assertEqual(self.s.run('exit 3')[0], 3)
+        self.assertEqual(self.s.run('echo after'), (0, 'after\n', ''))
+
+    def test_environment(self):
+        os.environ['MDIG_SESSION_TEST'] = 'a value'
+        self.assertEqual(self.s.run('echo $MDIG_SESSION_TEST')[1], 'a value\n')
+        del os.environ['MDIG_SESSION_TEST']
+        self.assertEqual(self.s.run('echo "[$MDIG_SESSION_TEST]"')[1], '[]\n')
+
+    def test_close(self):
+        self.s.run('true')
+        work_dir = self.s.work_dir
+        self.s.close()
+        self.assertFalse(os.path.isdir(work_dir))
+        self.assertFalse(self.s.is_alive())
+
+
+class MapIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.loc_dir = tempfile.mkdtemp(prefix='mdig_index_test')
+        for mapset in ['PERMANENT', 'other']:
+            for e in ['cell', 'vector']:
+                os.makedirs(os.path.join(self.loc_dir, mapset, e))
+        self.touch('PERMANENT', 'cell', 'base_map')
+        self.touch('other', 'cell', 'other_map')
+        os.makedirs(os.path.join(self.loc_dir, 'other', 'vector', 'a_vector'))
+        g = Mock()
+        g.get_mapset.return_value = 'other'
+        g.get_mapset_full_path.side_effect = lambda x: os.path.join(self.loc_dir, x)
+        self.index = grass.MapIndex(g)
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.loc_dir)
+
+    def touch(self, mapset, element, name):
+        open(os.path.join(self.loc_dir, mapset, element, name), 'w').close()
+
+    def test_find(self):
+        idx = self.index
+        self.assertEqual(idx.find('other_map'), ('cell', 'other'))
+        self.assertEqual(idx.find('base_map'), ('cell', 'PERMANENT'))
+        self.assertEqual(idx.find('a_vector'), ('vector', 'other'))
+        self.assertEqual(idx.find('base_map@other'), None)
+        self.assertEqual(idx.find('base_map', mapset='PERMANENT'), ('cell', 'PERMANENT'))
+        self.assertEqual(idx.find('missing'), None)
+        self.assertEqual(idx.find('other_map', ['windows']), None)
+
+    def test_search_path(self):
+        idx = self.index
+        f = open(os.path.join(self.loc_dir, 'other', 'SEARCH_PATH'), 'w')
+        f.write('other\n')
+        f.close()
+        self.assertEqual(idx.get_search_path(), ['other'])
+        self.assertEqual(idx.find('base_map'), None)
+
+    def test_external_change(self):
+        idx = self.index
+        self.assertEqual(idx.find('new_map'), None)
+        # created outside of the index
+        self.touch('other', 'cell', 'new_map')
+        self.assertEqual(idx.find('new_map'), ('cell', 'other'))
+        os.remove(os.path.join(self.loc_dir, 'other', 'cell', 'new_map'))
+        self.assertEqual(idx.find('new_map'), None)
+
+    def test_cached_listing(self):
+        idx = self.index
+        idx.get_names('other', 'cell')
+        e_dir = os.path.join(self.loc_dir, 'other', 'cell')
+        mtime, scan_time, names = idx.listings[e_dir]
+        # pretend the listing was taken long after the dir last changed
+        idx.listings[e_dir] = (mtime, scan_time + 10, set(['cached_map']))
+        self.assertEqual(idx.find('cached_map'), ('cell', 'other'))
+        idx.remove('cached_map')
+        self.assertEqual(idx.find('cached_map'), None)
+        idx.add('cached_map')
+        self.assertEqual(idx.find('cached_map'), ('cell', 'other'))
+
+
+class RasterFilesTest(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.mapset_dir = tempfile.mkdtemp(prefix='mdig_raster_files_test')
+        self.write('cellhd', 'pop', 'proj: 99\n')
+        self.write('fcell', 'pop', 'data')
+        self.write('colr', 'pop', 'colours')
+        self.write(os.path.join('cell_misc', 'pop'), 'null', 'nulls')
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.mapset_dir)
+
+    def write(self, element, name, text):
+        e_dir = os.path.join(self.mapset_dir, element)
+        if not os.path.isdir(e_dir):
+            os.makedirs(e_dir)
+        f = open(os.path.join(e_dir, name), 'w')
+        f.write(text)
+        f.close()
+
+    def path(self, *args):
+        return os.path.join(self.mapset_dir, *args)
+
+    def test_link(self):
+        self.assertTrue(grass.link_raster_files(self.mapset_dir, 'pop',
+            self.mapset_dir, 'pop_2010'))
+        # data files are shared, the rest are copies
+        self.assertEqual(os.stat(self.path('fcell', 'pop')).st_nlink, 2)
+        self.assertEqual(os.stat(self.path('cell_misc', 'pop_2010', 'null')).st_nlink, 2)
+        self.assertEqual(os.stat(self.path('colr', 'pop_2010')).st_nlink, 1)
+        self.assertEqual(open(self.path('cellhd', 'pop_2010')).read(), 'proj: 99\n')
+        # won't overwrite an existing map
+        self.assertFalse(grass.link_raster_files(self.mapset_dir, 'pop',
+            self.mapset_dir, 'pop_2010'))
+        self.assertFalse(grass.link_raster_files(self.mapset_dir, 'missing',
+            self.mapset_dir, 'pop_2011'))
+        self.assertFalse(os.path.exists(self.path('cellhd', 'pop_2011')))
+
+    def test_reclass(self):
+        self.write('cellhd', 'reclassed', 'reclass\nname: pop\n')
+        self.assertFalse(grass.link_raster_files(self.mapset_dir, 'reclassed',
+            self.mapset_dir, 'pop_2010'))
+        self.assertFalse(grass.rename_raster_files(self.mapset_dir, 'reclassed',
+            'pop_2010'))
+
+    def test_rename(self):
+        self.assertTrue(grass.rename_raster_files(self.mapset_dir, 'pop', 'pop_2010'))
+        self.assertFalse(os.path.exists(self.path('fcell', 'pop')))
+        self.assertEqual(open(self.path('cell_misc', 'pop_2010', 'null')).read(), 'nulls')
+        self.write('cellhd', 'pop', 'proj: 99\n')
+        self.assertFalse(grass.rename_raster_files(self.mapset_dir, 'pop', 'pop_2010'))
+        self.assertTrue(os.path.exists(self.path('cellhd', 'pop')))
+
+class UnivariateStatsTest(unittest.TestCase):
+
+    def test_stats(self):
+        import numpy
+        data = numpy.ma.masked_invalid([[1.0, 2.0], [-3.0, numpy.nan]])
+        stats = grass.univariate_stats(data)
+        self.assertEqual(stats['n'], 3)
+        self.assertEqual(stats['null_cells'], 1)
+        self.assertEqual(stats['cells'], 4)
+        self.assertEqual(stats['min'], -3.0)
+        self.assertEqual(stats['max'], 2.0)
+        self.assertEqual(stats['range'], 5.0)
+        self.assertEqual(stats['sum'], 0.0)
+        self.assertEqual(stats['mean'], 0.0)
+        self.assertEqual(stats['mean_of_abs'], 2.0)
+        self.assertAlmostEqual(stats['variance'], 14.0 / 3)
+        self.assertAlmostEqual(stats['stddev'], (14.0 / 3) ** 0.5)
+        # can't divide by a mean of zero
+        self.assertFalse('coeff_var' in stats)
+
+    def test_all_null(self):
+        import numpy
+        stats = grass.univariate_stats(numpy.ones((2, 2)) * numpy.nan)
+        self.assertEqual(stats, {'n': 0, 'null_cells': 4, 'cells': 4})
+
 class GRASSInterfaceTest(unittest.TestCase):
 
     def setUp(self):
@@ -61,16 +244,17 @@ class GRASSInterfaceTest(unittest.TestCase):
         os.environ['GISRC'] = 'robocop'
         os.environ['GRASS_PYTHON'] = 'robocop2'
 
-        g.check_environment()
-        self.assertEqual(g.grass_vars['GISRC'],'robocop')
-        self.assertEqual(g.grass_vars['GRASS_PYTHON'],'robocop2')
-        self.assertEqual(m_get_env.call_count, 1)
-
-        #remove test files from environ
-        os.environ['GISRC'] = old_rc_file
-        g.grass_vars['GISRC'] = old_rc_file
-        os.environ['GRASS_PYTHON'] = old_python
-        g.grass_vars['GRASS_PYTHON'] = old_python
+        try:
+            g.check_environment()
+            self.assertEqual(g.grass_vars['GISRC'],'robocop')
+            self.assertEqual(g.grass_vars['GRASS_PYTHON'],'robocop2')
+            self.assertEqual(m_get_env.call_count, 1)
+        finally:
+            #remove test files from environ
+            os.environ['GISRC'] = old_rc_file
+            g.grass_vars['GISRC'] = old_rc_file
+            os.environ['GRASS_PYTHON'] = old_python
+            g.grass_vars['GRASS_PYTHON'] = old_python
 
     def test_check_paths(self):
         g = self.g
@@ -131,6 +315,7 @@ class GRASSInterfaceTest(unittest.TestCase):
     @patch('grass.Popen')
     def test_run_command_w_error(self, m_popen):
         g = self.g
+        g.use_session = False
         lh = ListHandler()
         logging.getLogger('mdig').addHandler(lh)
         m_popen.return_value.communicate.return_value = ['','']
@@ -140,6 +325,237 @@ class GRASSInterfaceTest(unittest.TestCase):
         self.assertTrue(any(['stack trace' in e for e in lh.error]))
         self.assertEqual('test', context.exception.cmd)
 
+    @patch('grass.Popen')
+    def test_run_command_argv(self, m_popen):
+        g = self.g
+        g.use_session = False
+        m_popen.return_value.communicate.return_value = ['','']
+        m_popen.return_value.returncode = 0
+        g.run_command(['g.remove', 'rast=a_map'])
+        self.assertEqual(m_popen.call_args[0][0], ['g.remove', 'rast=a_map'])
+        self.assertEqual(m_popen.call_args[1]['shell'], False)
+        self.assertEqual(g.command_times['g.remove'][0], 1)
+
+    def test_run_command_session(self):
+        g = self.g
+        # the test config uses the session, as the default config does
+        self.assertTrue(g.use_session)
+        g.run_command('g.region -p')
+        self.assertTrue(g.session.is_alive())
+        pid = g.session.process.pid
+        self.assertTrue('res' in g.stdout)
+        self.assertRaises(grass.GRASSCommandException,
+                g.run_command, 'g.region fake_option=1', logging.INFO)
+        self.assertEqual(g.command_times['g.region'][0], 2)
+        # a failed command doesn't stop the session being used
+        g.run_command(['g.region', '-g'])
+        self.assertEqual(g.session.process.pid, pid)
+        self.assertTrue('nsres=' in g.stdout)
+        self.assertEqual(g.pipe_command('g.gisenv get=MAPSET').strip(),
+                g.get_mapset())
+
+    def test_read_write_raster(self):
+        import numpy
+        g = self.g
+        region = g.get_region_info()
+        self.assertTrue(region['rows'] > 0 and region['cols'] > 0)
+        shape = (region['rows'], region['cols'])
+        data = numpy.zeros(shape)
+        data[0,0] = 5.5
+        data[-1,-1] = 2.0
+        map_name = g.generate_map_name('rw_test')
+        g.write_raster(data, map_name, null=0.0)
+        # zero is null in the map, and null can be read back as any value
+        read_data = g.read_raster(map_name, null=-1.0)
+        self.assertEqual(read_data[0,0], 5.5)
+        self.assertEqual(read_data[-1,-1], 2.0)
+        self.assertEqual(read_data[0,-1], -1.0)
+        read_data = g.read_raster(map_name, null=None)
+        self.assertEqual(read_data.count(), 2)
+        g.remove_map(map_name)
+        self.assertRaises(ValueError, g.write_raster, numpy.zeros((1,1)), map_name)
+
+    def test_read_raster_cached(self):
+        import numpy
+        import tempfile
+        import shutil
+        g = self.g
+        region = g.get_region_info()
+        data = numpy.ones((region['rows'], region['cols']))
+        map_name = g.generate_map_name('cache_test')
+        g.write_raster(data, map_name)
+        cache_dir = tempfile.mkdtemp()
+        try:
+            mat = g.read_raster_cached(map_name, cache_dir)
+            self.assertEqual(mat.shape, data.shape)
+            self.assertEqual(mat[0,0], 1.0)
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+            # The exported file is reused
+            g.run_command = Mock()
+            g.read_raster_cached(map_name, cache_dir)
+            self.assertEqual(g.run_command.call_count, 0)
+        finally:
+            del g.run_command
+            shutil.rmtree(cache_dir)
+            g.remove_map(map_name)
+        self.assertRaises(grass.MapNotFoundException, g.read_raster_cached,
+                map_name, cache_dir)
+
+    def test_active_area_context(self):
+        import numpy
+        g = self.g
+        region = g.get_region_info()
+        data = numpy.zeros((region['rows'], region['cols']))
+        data[1,1] = 1.0
+        map_name = g.generate_map_name('active_test')
+        g.write_raster(data, map_name, null=0.0)
+        try:
+            extent = g.get_occupied_extent(map_name)
+            self.assertAlmostEqual(extent['n'], region['n'] - region['nsres'])
+            with g.active_area_context(map_name, 0.0):
+                info = g.get_region_info()
+                self.assertEqual((info['rows'], info['cols']), (3, 3))
+            self.assertEqual(g.get_region_info(), region)
+            with g.active_area_context(map_name, None):
+                self.assertEqual(g.get_region_info(), region)
+        finally:
+            g.remove_map(map_name)
+
+    def test_sparse_raster_io(self):
+        import numpy
+        from mdig import sparse
+        g = self.g
+        region = g.get_region_info()
+        data = numpy.zeros((region['rows'], region['cols']))
+        data[1,2] = 2.0
+        data[3,1] = 5.0
+        map_name = g.generate_map_name('sparse_test')
+        g.write_raster_sparse(sparse.SparseRaster.from_array(data,
+            zero_is_null=True), map_name)
+        try:
+            extent = g.get_occupied_extent(map_name)
+            self.assertAlmostEqual(extent['n'], region['n'] - region['nsres'])
+            self.assertAlmostEqual(extent['e'], region['w'] + 3 * region['ewres'])
+            s = g.read_raster_sparse(map_name)
+            self.assertEqual(s.to_array(0.0).tolist(), data.tolist())
+            # empty cells inside the bounding box are null
+            self.assertEqual(len(s), 2)
+            self.assertTrue(g.read_raster(map_name, null=None).mask[1,1])
+            self.assertEqual(g.get_region_info(), region)
+        finally:
+            g.remove_map(map_name)
+
+    def test_generate_map_name(self):
+        from mdig.tempresource import trm
+        g = self.g
+        n1 = g.generate_map_name('test')
+        n2 = g.generate_map_name('test')
+        self.assertNotEqual(n1, n2)
+        full_name = n1 + "@" + g.get_mapset()
+        self.assertTrue((trm.MAP, full_name) in trm.temp_files)
+        # left over temporary maps are removed by clean up
+        g.mapcalc(n1, "1")
+        g.clean_up()
+        self.assertEqual(g.check_map(n1), None)
+        self.assertFalse((trm.MAP, full_name) in trm.temp_files)
+        # non-temporary names aren't registered
+        n3 = g.generate_map_name('test', temporary=False)
+        self.assertFalse((trm.MAP, n3 + "@" + g.get_mapset()) in trm.temp_files)
+
+    def test_remove_maps(self):
+        g = self.g
+        m_run = g.run_command = Mock()
+        m_change = g.change_mapset = Mock()
+        g.map_index = Mock()
+        g.map_index.element_types = grass.MapIndex.element_types
+        types = {'r1': ('cell', 'm1'), 'r2': ('fcell', 'm1'),
+                'v1': ('vector', 'm1'), 'r3': ('cell', 'm2')}
+        g.map_index.find.side_effect = lambda name, mapset: types.get(name)
+        g.remove_maps(['r1', 'r2', 'v1', 'missing', 'r3@m2'], 'm1')
+        self.assertEqual(m_run.call_count, 3)
+        cmds = sorted([c[0][0] for c in m_run.call_args_list])
+        self.assertEqual(cmds, [['g.remove', 'rast=r1,r2'], ['g.remove', 'rast=r3'],
+            ['g.remove', 'vect=v1']])
+        # changed once to each mapset
+        self.assertEqual(m_change.call_count, 2)
+
+        # nothing to remove means no GRASS calls
+        m_run.reset_mock()
+        g.remove_maps(['missing'])
+        self.assertEqual(m_run.call_count, 0)
+
+        # chunking
+        m_run.reset_mock()
+        types = dict([('r%d' % i, ('cell', g.get_mapset())) for i in range(250)])
+        g.remove_maps(types.keys())
+        self.assertEqual(m_run.call_count, 3)
+
+    def test_mapcalc_batch(self):
+        g = self.g
+        m_run = g.run_command = Mock()
+        g.map_index = Mock()
+        batch = g.mapcalc_batch()
+        batch.add('a', 'if(isnull(m),x,y)', write=False)
+        batch.add('b', 'if(isnull(m) && isnull("b"),a,a+b)')
+        batch.add('c', 'ab + a_1 + a@PERMANENT')
+        batch.run()
+        self.assertEqual(m_run.call_count, 1)
+        stdin = m_run.call_args[1]['to_input']
+        self.assertEqual(stdin.split('\n'), [
+            '"b" = if(isnull(m) && isnull("b"),(if(isnull(m),x,y)),(if(isnull(m),x,y))+b)',
+            '"c" = ab + a_1 + a@PERMANENT', 'end', ''])
+        self.assertEqual(g.map_index.add.call_count, 2)
+        # nothing to run
+        batch.run()
+        self.assertEqual(m_run.call_count, 1)
+
+    def test_set_region_cache(self):
+        g = self.g
+        m_run = g.run_command = Mock()
+        g.set_region('a_region')
+        g.set_region('a_region')
+        self.assertEqual(m_run.call_count, 1)
+        g.set_region('b_region')
+        self.assertEqual(m_run.call_count, 2)
+        # a change to the WIND file from elsewhere invalidates the cache
+        wind_fn = os.path.join(g.get_mapset_full_path(), 'WIND')
+        g.region_cache[wind_fn]['stamp'] = (0, 0, '')
+        g.set_region('b_region')
+        self.assertEqual(m_run.call_count, 3)
+        # so does a change that keeps the WIND file's mtime and size
+        st = os.stat(wind_fn)
+        f = open(wind_fn)
+        contents = f.read()
+        f.close()
+        f = open(wind_fn, 'w')
+        f.write(contents[::-1])
+        f.close()
+        os.utime(wind_fn, (st.st_atime, st.st_mtime))
+        try:
+            g.set_region('b_region')
+            self.assertEqual(m_run.call_count, 4)
+        finally:
+            f = open(wind_fn, 'w')
+            f.write(contents)
+            f.close()
+
+    def test_region_context(self):
+        g = self.g
+        g.get_region_info()
+        m_run = g.run_command = Mock()
+        with g.region_context('a_region'):
+            self.assertEqual(m_run.call_count, 1)
+        # old region is restored from its extents
+        self.assertEqual(m_run.call_count, 2)
+        self.assertEqual(m_run.call_args[0][0][0], 'g.region')
+        self.assertTrue('rows' in m_run.call_args[0][0][5])
+        # the region already matches, so nothing is run
+        m_run.reset_mock()
+        g.set_region('a_region')
+        with g.region_context('a_region'):
+            pass
+        self.assertEqual(m_run.call_count, 1)
+
     def test_normalise_map_colors(self):
         maps = []
         for i in range(0,5):
@@ -0,0 +1,72 @@
+import unittest
+import os
+import shutil
+import tempfile
+import time
+
+from mdig.jobqueue import JobQueue
+
+
+class JobQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        # A local directory stands in for the shared filesystem
+        self.queue_dir = tempfile.mkdtemp(prefix="mdig_jobqueue_test")
+        self.q = JobQueue(self.queue_dir, stale_timeout=60)
+
+    def tearDown(self):
+        shutil.rmtree(self.queue_dir)
+
+    def test_claim(self):
+        self.assertEqual(self.q.claim('a_0'), None)
+        self.assertTrue(self.q.is_empty())
+        self.q.put('i0_r0', {'instance': 0, 'replicate': 0, 'seed': 5})
+        self.q.put('i0_r1', {'instance': 0, 'replicate': 1, 'seed': 6})
+        self.assertFalse(self.q.is_empty())
+        job_id, job = self.q.claim('a_0')
+        self.assertEqual(job_id, 'i0_r0')
+        self.assertEqual(job['seed'], 5)
+        # another worker gets the other job
+        second = JobQueue(self.queue_dir)
+        self.assertEqual(second.claim('b_0')[0], 'i0_r1')
+        self.assertEqual(second.claim('b_1'), None)
+        # claimed jobs aren't finished
+        self.assertFalse(self.q.is_empty())
+        self.assertTrue(self.q.heartbeat('i0_r0', 'a_0'))
+        self.assertFalse(self.q.heartbeat('i0_r0', 'b_0'))
+
+    def test_complete(self):
+        self.q.put('i0_r0', {'seed': 5})
+        self.q.put('i0_r1', {'seed': 6})
+        self.q.claim('a_0')
+        self.q.claim('a_1')
+        self.q.complete('i0_r0', 'a_0', {'mapset': 'x'})
+        self.q.fail('i0_r1', 'a_1', 'traceback')
+        self.assertTrue(self.q.is_empty())
+        self.assertEqual(self.q.results(), [('i0_r0', 'a_0', {'mapset': 'x'})])
+        self.assertEqual(self.q.results(), [])
+        self.assertEqual(self.q.failures(), [('i0_r1', 'a_1', 'traceback')])
+
+    def test_requeue_stale(self):
+        self.q.put('i0_r0', {'seed': 5})
+        self.q.put('i0_r1', {'seed': 6})
+        self.q.claim('a_0')
+        self.q.claim('b_0')
+        # worker a has stopped sending heartbeats
+        old = time.time() - 120
+        os.utime(os.path.join(self.queue_dir, 'claimed', 'i0_r0.a_0'), (old, old))
+        self.assertEqual(self.q.requeue_stale(), ['i0_r0'])
+        self.assertFalse(self.q.heartbeat('i0_r0', 'a_0'))
+        self.assertEqual(self.q.claim('c_0')[0], 'i0_r0')
+        # the stale worker finishing late doesn't remove the new claim
+        self.q.complete('i0_r0', 'a_0', {'mapset': 'a'})
+        self.assertTrue(self.q.heartbeat('i0_r0', 'c_0'))
+        self.assertEqual(len(self.q.results()), 1)
+
+    def test_clear(self):
+        self.q.put('i0_r0', {'seed': 5})
+        self.q.claim('a_0')
+        self.q.put('i0_r1', {'seed': 6})
+        self.q.clear()
+        self.assertTrue(self.q.is_empty())
+        self.assertEqual(self.q.claim('a_1'), None)
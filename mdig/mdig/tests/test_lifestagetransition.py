@@ -0,0 +1,175 @@
+import unittest
+from mock import patch
+
+import math
+
+import numpy
+
+import mdig
+from mdig.lifestagetransition import LifestageTransition, TVGenerator, \
+        ParamGenerator
+
+class LifestageTransitionTest(unittest.TestCase):
+
+    def setUp(self):
+        fecundity = ParamGenerator('static', None, None, [2.0], '')
+        survival = ParamGenerator('map', None, None, ['survival'], '')
+        survival.mat = numpy.array([[0.1, 0.2, 0.3], [0.4, 0.5, 0.6]])
+        survival.ready = True
+        self.parameters = {
+            'f': {1: fecundity, 2: ParamGenerator('zero', None, None, [], '')},
+            'fs': {'None': survival},
+            }
+        self.expressions = ['0', 'f * fs',
+                'fs', 'MAP_adult / (MAP_juv + MAP_adult)']
+        self.lt = self.make_transition(self.expressions)
+
+    @patch.object(LifestageTransition, '__init__')
+    def make_transition(self, expressions, m_init):
+        m_init.return_value = None
+        lt = LifestageTransition()
+        lt.t_matrix = TVGenerator(self.parameters, expressions, 2, [1, 2])
+        lt.by_individual = False
+        return lt
+
+    def test_compile_expression(self):
+        code, names = self.lt.t_matrix.compile_expression(
+                'max(f, fs) / MAP_juv % 2')
+        self.assertEqual(names, ['MAP_juv', 'f', 'fs'])
+        self.assertEqual(eval(code, mdig.lifestagetransition._expression_globals,
+            {'f': 1.0, 'fs': 3.0, 'MAP_juv': 1.0}), 1.0)
+        self.assertTrue(eval(code, mdig.lifestagetransition._expression_globals,
+            {'f': 1.0, 'fs': 3.0, 'MAP_juv': 0.0}) is numpy.ma.masked)
+        self.assertRaises(SystemExit, self.lt.t_matrix.compile_expression,
+                'f *')
+
+    def test_scalar_forms(self):
+        # Expressions written for single values work with arrays
+        pops = {'juv': numpy.array([1.0, 4.0]), 'adult': numpy.array([0.0, 2.0])}
+        def build(expression):
+            lt = self.make_transition([expression, '0', '0', '0'])
+            tm = lt.t_matrix.build_matrices(1, numpy.array([0, 1]),
+                    numpy.array([0, 1]), pops)
+            return tm[0, 0].tolist()
+        self.assertTrue(numpy.allclose(build('math.exp(MAP_adult)'),
+            [1.0, math.exp(2.0)]))
+        self.assertEqual(build('math.pow(MAP_juv, 2)'), [1.0, 16.0])
+        self.assertEqual(build('min(MAP_juv, MAP_adult, 1)'), [0.0, 1.0])
+        self.assertEqual(build('max(MAP_juv, 3)'), [3.0, 4.0])
+        self.assertEqual(build('1 if MAP_adult > 0 else 2'), [2.0, 1.0])
+        self.assertEqual(build('MAP_adult and MAP_juv'), [0.0, 4.0])
+        self.assertEqual(build('MAP_adult or 5'), [5.0, 2.0])
+        self.assertEqual(build('not MAP_adult'), [1.0, 0.0])
+        self.assertEqual(build('1 < MAP_juv <= 4'), [0.0, 1.0])
+        # Division by zero is still caught in the branch that's used
+        self.lt.t_matrix.ignore_div_by_zero = False
+        self.assertEqual(build('1 / MAP_adult if MAP_adult else 0'), [0.0, 0.5])
+        self.assertRaises(SystemExit, build, '1 if MAP_juv > 2 else 1 / MAP_adult')
+        # Other functions are evaluated one cell at a time
+        self.assertEqual(build('float(math.factorial(int(MAP_juv)))'), [1.0, 24.0])
+        self.assertRaises(SystemExit, build, 'math.factorial(-1)')
+
+    def test_process_rows(self):
+        ls_ids = ['juv', 'adult']
+        index_array = numpy.array([[1, 2, 1], [2.0, 1, 1]])
+        juv = numpy.array([[1, 2, 3], [4, 5, 6]], dtype=numpy.float64)
+        adult = numpy.array([[6, 5, 4], [3, 2, 1]], dtype=numpy.float64)
+        f = numpy.where(index_array == 1, 2.0, 0.0)
+        fs = self.parameters['fs']['None'].mat
+        expected = [f * fs * adult, fs * juv + adult * adult / (juv + adult)]
+        out = self.lt.process_rows(ls_ids, index_array, [juv, adult])
+        self.assertTrue(numpy.allclose(out, expected))
+        # Blocks smaller than the groups give the same result
+        self.lt.block_size = 2
+        out = self.lt.process_rows(ls_ids, index_array, [juv, adult])
+        self.assertTrue(numpy.allclose(out, expected))
+        tm = self.lt.t_matrix.build_matrix(1, (1, 2), {'juv': 6.0, 'adult': 1.0})
+        self.assertTrue(numpy.allclose(tm, [[0, 1.2], [0.6, 1 / 7.0]]))
+
+    def test_process_rows_div_by_zero(self):
+        ls_ids = ['juv', 'adult']
+        lt = self.make_transition(['0', 'f * fs', 'fs', 'MAP_adult / MAP_juv'])
+        index_array = numpy.ones((1, 3))
+        pops = numpy.array([[[1, 0, 0]], [[1, 0, 2]]], dtype=numpy.float64)
+        self.assertRaises(SystemExit, lt.process_rows, ls_ids,
+                index_array, list(pops))
+        lt.t_matrix.ignore_div_by_zero = True
+        out = lt.process_rows(ls_ids, index_array, list(pops))
+        # Only the value for the cell without juveniles is replaced by zero
+        self.assertTrue(numpy.allclose(out[:, 0, :],
+            [[0.2, 0.0, 1.2], [1.1, 0.0, 0.0]]))
+
+    def test_process_rows_skips_empty(self):
+        ls_ids = ['juv', 'adult']
+        index_array = numpy.ones((1, 3))
+        pops = numpy.array([[[1, 0, 3]], [[1, 0, 0]]], dtype=numpy.float64)
+        # The empty cell would divide by zero, but it's never evaluated
+        out = self.lt.process_rows(ls_ids, index_array, list(pops))
+        self.assertTrue(numpy.allclose(out[:, 0, :],
+            [[0.2, 0.0, 0.0], [0.6, 0.0, 0.9]]))
+
+    def test_process_rows_random(self):
+        self.parameters['r'] = {'None':
+                ParamGenerator('random', None, 'uniform', [0.5, 0.5], '')}
+        lt = self.make_transition(['r', '0', '0', 'r'])
+        pops = numpy.ones((2, 2, 3))
+        out = lt.process_rows(['juv', 'adult'], numpy.ones((2, 3)), list(pops))
+        self.assertTrue(numpy.allclose(out, 0.5))
+
+    def test_process_rows_by_individual(self):
+        self.lt.by_individual = True
+        ls_ids = ['juv', 'adult']
+        index_array = numpy.array([[2, 2]])
+        pops = numpy.array([[[10, 0]], [[5, 5]]], dtype=numpy.float64)
+        out = self.lt.process_rows(ls_ids, index_array, list(pops))
+        # No fecundity in index 2, and survival of adults is always 1.0
+        self.assertEqual(out[0].tolist(), [[0, 0]])
+        self.assertEqual(out[1, 0, 1], 5)
+
+    def test_sample(self):
+        p = ParamGenerator('random', 'None', 'normal', [100.0, 10.0], '')
+        values = p.sample('None', 5, numpy.random.RandomState(1))
+        self.assertEqual(values.shape, (5,))
+        self.assertEqual(values.tolist(),
+                numpy.random.RandomState(1).normal(100, 10, 5).tolist())
+        self.assertEqual(numpy.ndim(p.gen_val('None', (0, 0))), 0)
+
+        p = ParamGenerator('CODA', 'index.txt', None, [], '')
+        p.coda = {1: numpy.array([1.0, 2.0]), 2: numpy.array([3.0])}
+        p.ready = True
+        self.assertEqual(p.sample(2.0, 3).tolist(), [3.0, 3.0, 3.0])
+        self.assertTrue(set(p.sample(1, 20)) <= set([1.0, 2.0]))
+
+        self.assertEqual(ParamGenerator('static', None, None, [2.0], '').sample(1, 3), 2.0)
+        self.assertRaises(ValueError,
+                ParamGenerator('random', None, 'wibble', [1, 2], '').sample, 1)
+
+    def test_process_rows_seeded(self):
+        self.parameters['r'] = {'None':
+                ParamGenerator('random', None, 'beta', [87, 3167], '')}
+        lt = self.make_transition(['r', '0', 'fs', 'r'])
+        pops = [numpy.ones((2, 3)), numpy.ones((2, 3))]
+        out = lt.process_rows(['juv', 'adult'], numpy.ones((2, 3)), pops,
+                numpy.random.RandomState(42))
+        out2 = lt.process_rows(['juv', 'adult'], numpy.ones((2, 3)), pops,
+                numpy.random.RandomState(42))
+        self.assertEqual(out.tolist(), out2.tolist())
+
+    def test_transition_by_individual(self):
+        rng = numpy.random.RandomState(1)
+        n = 2000
+        # Juveniles survive with 0.5 and adults each give 1.5 juveniles
+        tms = numpy.zeros((2, 2, n))
+        tms[0, 1] = 1.5
+        tms[1, 0] = 0.5
+        tms[1, 1] = 0.25
+        pops = numpy.array([[10.0] * n, [4.0] * n])
+        out = self.lt.transition_by_individual(tms, pops, rng)
+        self.assertEqual(out.dtype, numpy.float64)
+        self.assertTrue((out == numpy.floor(out)).all())
+        # Adults making 1 or 2 individuals, split 6:1 between the stages
+        self.assertTrue((out.sum(axis=0) >= 4).all())
+        self.assertTrue((out.sum(axis=0) <= 18).all())
+        means = out.mean(axis=1)
+        self.assertAlmostEqual(means[0], 6.0, delta=0.2)
+        self.assertAlmostEqual(means[1], 5.0 + 1.0, delta=0.2)
@@ -140,3 +140,43 @@ class ManagementStrategyTest(unittest.TestCase):
         test_del()
         self.assertEqual(get_g.return_value.remove_map.call_count, 2)
 
+    @patch('mdig.grass.get_g')
+    def test_static_area_cache(self,get_g):
+        from lxml import etree
+        xml = """
+    <strategy name="static_area" region="a">
+      <description>Test that static areas are cached.</description>
+      <treatments>
+        <t>
+          <area ls="all">
+            <map>a_map</map>
+          </area>
+          <event ls="all" name="r.mdig.survival">
+            <param name="survival"><value>80</value></param>
+          </event>
+        </t>
+      </treatments>
+    </strategy>
+    """
+        tree = etree.parse(StringIO(xml))
+        s = ManagementStrategy(tree.getroot(),Mock())
+        t = s.get_treatments()[0]
+        g = get_g.return_value
+        g.get_raster_range.return_value = {'min': 'NULL', 'max': 'NULL'}
+        rep = Mock()
+        rep.temp_map_names = {'all': ['pop', 'pop_out']}
+        rep.initial_maps = {'all': Mock()}
+        area = t.get_treatment_area_map(rep)
+        self.assertEqual(g.copy_map.call_count, 1)
+        self.assertTrue(t.is_area_empty())
+        # Not regenerated or checked again for the same instance
+        self.assertEqual(t.get_treatment_area_map(rep), area)
+        self.assertTrue(t.is_area_empty())
+        self.assertEqual(g.copy_map.call_count, 1)
+        self.assertEqual(g.get_raster_range.call_count, 1)
+        # but is for another instance
+        rep.instance = Mock()
+        g.get_raster_range.return_value = {'min': '1', 'max': '1'}
+        t.get_treatment_area_map(rep)
+        self.assertFalse(t.is_area_empty())
+        self.assertEqual(g.copy_map.call_count, 2)
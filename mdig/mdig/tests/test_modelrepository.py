@@ -247,7 +247,7 @@ class ModelRepositoryTest(unittest.TestCase):
         temp_model_fn = os.path.join(os.path.dirname(a_file),"with_location_model.xml")
         dm.save_model(filename=temp_model_fn)
 
-        get_g.return_value.get_range.return_value = [ 'xxxxxx10' ] * 10
+        get_g.return_value.get_region_info.return_value = {'rows': 10, 'cols': 10}
         get_g.return_value.raster_value_freq.return_value = [ [1],[2],[3] ]
         m_ls.return_value = {}
 
@@ -0,0 +1,281 @@
+import unittest
+from mock import *
+import datetime
+import shutil
+import tempfile
+
+import lxml.etree
+
+import mdig
+from mdig import parallel
+from mdig.parallel import ParallelRunner, QueueRunner, QueueWorker
+from mdig.jobqueue import JobQueue
+
+
+class ParallelRunnerTest(unittest.TestCase):
+
+    def make_instance(self, r_id, completed, complete=False):
+        i = Mock()
+        i.r_id = r_id
+        i.enabled = True
+        i.is_complete.return_value = complete
+        i.replicates = [Mock(complete=True) for x in range(completed)]
+        return i
+
+    def test_order_instances(self):
+        from mdig.model import DispersalModel
+        model = Mock()
+        i0 = self.make_instance('a', 1)
+        i1 = self.make_instance('a', 3)
+        i2 = self.make_instance('a', 0, complete=True)
+        model.get_instances.return_value = [i0, i1, i2]
+        model._get_instances_by_region.return_value = {'a': [i0, i1, i2]}
+        model._get_instance_w_smallest_reps_remaining = \
+            lambda x: DispersalModel._get_instance_w_smallest_reps_remaining.im_func(model, x)
+        pr = ParallelRunner(model, 2)
+        self.assertEqual(pr.order_instances(), [i1, i0])
+        self.assertEqual(pr.order_instances([i0]), [i0])
+
+    @patch('mdig.grass.get_g')
+    def test_merge(self, m_g):
+        model = Mock()
+        instance = Mock()
+        instance.get_mapset.return_value = 'model_i0'
+        instance.rep_times = []
+        listener = Mock()
+        listener.replicate_complete = Mock()
+        instance.listeners = [listener]
+        model.get_instances.return_value = [instance]
+        reps_node = lxml.etree.Element('replicates')
+        rep = Mock()
+        rep.node = lxml.etree.SubElement(reps_node, 'replicate')
+        rep.complete = False
+        instance.replicates = [rep]
+        node_xml = '<replicate ts="now"><seed>5</seed><lifestage id="all">' + \
+            '<maps><map time="1">m_1</map><map time="2">m_2</map></maps>' + \
+            '</lifestage></replicate>'
+        pr = ParallelRunner(model, 2)
+        pr.pending[(0, 0)] = True
+        pr.merge((0, 0, 'model_i0_rep0', node_xml, 10, {}))
+        m_g.return_value.move_maps.assert_called_once_with(['m_1', 'm_2'],
+                'model_i0_rep0', 'model_i0')
+        m_g.return_value.remove_mapset.assert_called_once_with('model_i0_rep0',
+                force=True)
+        self.assertEqual(len(reps_node), 1)
+        self.assertEqual(reps_node[0].find('seed').text, '5')
+        self.assertEqual(rep.node, reps_node[0])
+        self.assertTrue(rep.complete)
+        self.assertEqual(instance.rep_times, [10])
+        self.assertTrue(model.save_model.called)
+        instance.listeners[0].replicate_complete.assert_called_once_with(rep)
+
+    @patch('mdig.grass.get_g')
+    def test_static_treatment_area(self, m_g):
+        from StringIO import StringIO
+        from mdig.management import ManagementStrategy
+        xml = """
+    <strategy name="static_area" region="a">
+      <description>Static area used by more replicates than workers</description>
+      <treatments>
+        <t>
+          <area ls="all"><map>a_map</map></area>
+          <event ls="all" name="r.mdig.survival">
+            <param name="survival"><value>80</value></param>
+          </event>
+        </t>
+      </treatments>
+    </strategy>
+    """
+        g = m_g.return_value
+        mapsets = []
+        g.change_mapset.side_effect = lambda m, *args, **kw: mapsets.append(m)
+        g.get_mapset.side_effect = lambda: mapsets[-1]
+        # where the merged area map was made
+        made_in = []
+        g.copy_map.side_effect = lambda src, dest: made_in.append(mapsets[-1])
+
+        s = ManagementStrategy(lxml.etree.parse(StringIO(xml)).getroot(), Mock())
+        t = s.get_treatments()[0]
+        model = Mock()
+        instance = Mock()
+        instance.rep_times = [1]
+        model.get_instances.return_value = [instance]
+        instance.replicates = []
+        for r_index in range(3):
+            rep = Mock()
+            rep.instance = instance
+            rep.temp_map_names = {'all': ['pop', 'pop_out']}
+            rep.initial_maps = {'all': Mock()}
+            rep.node = lxml.etree.Element('replicate')
+            rep.run.side_effect = lambda r=rep, **kw: t.get_treatment_area_map(r)
+            instance.replicates.append(rep)
+        # One worker runs all the replicates in turn
+        for r_index in range(3):
+            scratch = parallel.scratch_mapset_name(instance, r_index)
+            parallel.run_in_mapset(model, 0, r_index, scratch)
+        self.assertEqual(made_in, mapsets)
+        self.assertEqual(len(set(made_in)), 3)
+
+    @patch('mdig.grass.get_g')
+    def test_generated_initial_map(self, m_g):
+        from mdig.model import DispersalModel
+        from mdig.lifestage import Lifestage
+        xml = """
+    <lifestage name="all">
+      <initialDistribution region="a">
+        <sites><s x="1" y="2"/><s x="3" y="4" count="10"/></sites>
+      </initialDistribution>
+    </lifestage>
+    """
+        g = m_g.return_value
+        mapsets = []
+        g.change_mapset.side_effect = lambda m, *args, **kw: mapsets.append(m)
+        g.get_mapset.side_effect = lambda: mapsets[-1]
+        g.init_map.side_effect = lambda m, r: ('sites_%d' % len(mapsets), 'raster')
+        ls = Lifestage(lxml.etree.fromstring(xml))
+        model = Mock()
+        instance = Mock()
+        instance.get_mapset.return_value = 'model_i0'
+        instance.rep_times = [1]
+        model.get_instances.return_value = [instance]
+        instance.replicates = []
+        for r_index in range(2):
+            rep = Mock()
+            rep.node = lxml.etree.Element('replicate')
+            rep.run.side_effect = lambda **kw: g.copy_map(
+                    ls.initial_maps['a'].get_map_filename(), 'pop', True)
+            instance.replicates.append(rep)
+        # One worker runs both replicates, and each scratch mapset is removed
+        # once its replicate is merged
+        for r_index in range(2):
+            scratch = parallel.scratch_mapset_name(instance, r_index)
+            parallel.run_in_mapset(model, 0, r_index, scratch)
+        self.assertEqual(g.init_map.call_count, 2)
+        sources = [c[0][0] for c in g.copy_map.call_args_list]
+        self.assertEqual(sources, ['sites_1@model_i0_rep0',
+            'sites_2@model_i0_rep1'])
+
+    @patch('mdig.grass.get_g')
+    def test_resume_checkpoint(self, m_g):
+        from mdig.model import DispersalModel
+        from mdig.replicate import Replicate
+        g = m_g.return_value
+        mapsets = []
+        g.change_mapset.side_effect = lambda m, *args, **kw: mapsets.append(m)
+        g.get_mapset.side_effect = lambda: mapsets[-1]
+
+        base_dir = tempfile.mkdtemp(prefix="mdig_parallel_test")
+        model = Mock()
+        instance = Mock()
+        instance.get_mapset.return_value = 'model_i0'
+        instance.get_map_name_base.return_value = 'model_i0'
+        instance.rep_times = [1]
+        instance.listeners = []
+        instance.node = lxml.etree.Element('instance')
+        instance.replicates = []
+        instance.experiment.base_dir = base_dir
+        instance.experiment.get_lifestage_ids.return_value = []
+        instance.experiment.next_random_value.return_value = 5
+        instance.experiment.add_replicate.side_effect = lambda node: \
+            lxml.etree.SubElement(node, 'replicate')
+        model.get_instances.return_value = [instance]
+        rep = Replicate(None, instance)
+
+        def run_until_killed(**kw):
+            for t in range(1, 4):
+                if t == 3:
+                    rep.save_checkpoint(t, False)
+                rep.add_completed_raster_map(t, 'all', 'm_%d' % t)
+            raise KeyboardInterrupt()
+
+        def resume(**kw):
+            start_t = rep.restore_checkpoint(rep.load_checkpoint())
+            for t in range(start_t, 5):
+                rep.add_completed_raster_map(t, 'all', 'm_%d' % t)
+
+        # The worker is killed after the checkpoint, so the model doesn't
+        # know about the maps it made
+        model_node = lxml.etree.tostring(rep.node)
+        rep.run = Mock(side_effect=run_until_killed)
+        scratch = parallel.scratch_mapset_name(instance, 0)
+        self.assertRaises(KeyboardInterrupt, parallel.run_in_mapset, model, 0,
+                0, scratch)
+        node = lxml.etree.fromstring(model_node)
+        rep.node.getparent().replace(rep.node, node)
+        rep.node = node
+
+        rep.run = Mock(side_effect=resume)
+        result = parallel.run_in_mapset(model, 0, 0, scratch)
+        pr = ParallelRunner(model, 2)
+        pr.pending[(0, 0)] = False
+        pr.merge((0, 0, scratch) + result + ({},))
+        g.move_maps.assert_called_once_with(['m_1', 'm_2', 'm_3', 'm_4'],
+                scratch, 'model_i0')
+        shutil.rmtree(base_dir)
+
+    def test_scratch_mapset_name(self):
+        instance = Mock()
+        instance.get_mapset.return_value = 'model_i0'
+        self.assertEqual(parallel.scratch_mapset_name(instance, 3),
+                'model_i0_rep3')
+
+
+class QueueTest(unittest.TestCase):
+
+    def setUp(self):
+        # A local directory stands in for the shared filesystem
+        self.queue_dir = tempfile.mkdtemp(prefix="mdig_parallel_test")
+        self.queue = JobQueue(self.queue_dir)
+        self.model = Mock()
+        self.rep = Mock()
+        self.rep.get_seed.return_value = 1234
+        instance = Mock()
+        instance.get_mapset.return_value = 'model_i0'
+        instance.replicates = [Mock(), self.rep]
+        self.model.get_instances.return_value = [instance]
+
+    def tearDown(self):
+        shutil.rmtree(self.queue_dir)
+
+    @patch('mdig.parallel.run_in_mapset')
+    def test_worker(self, m_run):
+        m_run.return_value = ('<replicate/>', datetime.timedelta(seconds=90))
+        self.queue.put('i0_r1', {'instance': 0, 'replicate': 1, 'seed': 1234})
+        self.queue.put('i0_r2', {'instance': 0, 'replicate': 2, 'seed': 1})
+        w = QueueWorker(self.model, self.queue, poll_interval=0)
+        w.run()
+        self.assertTrue(self.queue.is_empty())
+        self.assertEqual(m_run.call_count, 1)
+        scratch = m_run.call_args[0][3]
+        self.assertTrue(scratch.startswith('model_i0_rep1_'))
+        results = self.queue.results()
+        self.assertEqual(len(results), 1)
+        result = results[0][2]
+        self.assertEqual(result['mapset'], scratch)
+        self.assertEqual(result['seconds'], 90)
+        self.assertEqual(result['node'], '<replicate/>')
+        # the replicate for the second job doesn't exist, even after
+        # reloading the model
+        self.assertEqual(len(self.queue.failures()), 1)
+
+    @patch('mdig.grass.get_g')
+    def test_runner_poll(self, m_g):
+        r = QueueRunner(self.model, self.queue)
+        r.merge = Mock(side_effect=lambda x: r.pending.pop(x[:2]))
+        r.pending[(0, 1)] = True
+        result = {'instance': 0, 'replicate': 1, 'mapset': 'model_i0_rep1_a',
+                'node': '<replicate/>', 'seconds': 90,
+                'stats': [[['r.mapcalc', 0, 1, 2000, None, None], [1, 1.0, 0, 0]]]}
+        self.queue.complete('i0_r1', 'a', result)
+        # A second result for the same job, from a worker that was too slow
+        self.queue.complete('i0_r1', 'b', dict(result, mapset='model_i0_rep1_b'))
+        r.poll()
+        self.assertEqual(r.merge.call_count, 1)
+        args = r.merge.call_args[0][0]
+        self.assertEqual(args[:4], (0, 1, 'model_i0_rep1_a', '<replicate/>'))
+        self.assertEqual(args[4], datetime.timedelta(seconds=90))
+        self.assertEqual(args[5], {('r.mapcalc', 0, 1, 2000, None, None): [1, 1.0, 0, 0]})
+        m_g.return_value.remove_mapset.assert_called_once_with(
+                'model_i0_rep1_b', force=True)
+        self.queue.fail('i0_r2', 'a', 'traceback')
+        self.assertRaises(parallel.WorkerException, r.poll)
@@ -1,6 +1,7 @@
 import unittest
 from mock import *
 import logging
+import os
 
 import mdig
 from mdig import config
@@ -71,17 +72,19 @@ class ReplicateTest(unittest.TestCase):
     def test_delete_maps(self,get_g):
         i = self.m_variables_complete.get_instances()[0]
         i.replicates[0].delete_maps()
-        self.assertEqual(get_g.return_value.remove_map.call_count, 6)
+        # all maps are removed in one call
+        self.assertEqual(get_g.return_value.remove_maps.call_count, 1)
+        self.assertEqual(len(get_g.return_value.remove_maps.call_args[0][0]), 6)
 
-        get_g.return_value.remove_map.call_count = 0
+        get_g.return_value.remove_maps.call_count = 0
         i = self.m_lifestage.get_instances()[0]
         r = Replicate(node=None,instance=i)
         r.delete_maps()
-        self.assertEqual(get_g.return_value.remove_map.call_count, 0)
+        self.assertEqual(get_g.return_value.remove_maps.call_count, 0)
 
         r.get_saved_maps = mock_get_saved_maps
         r.delete_maps()
-        self.assertEqual(get_g.return_value.remove_map.call_count, 0)
+        self.assertEqual(get_g.return_value.remove_maps.call_count, 0)
         global get_save_count
         get_save_count = 0
 
@@ -132,12 +135,23 @@ class ReplicateTest(unittest.TestCase):
         r.record_maps()
         r.active = True
         r.temp_map_names['all'] = [ 'tmap1', 'tmap2' ]
+        # No analyses use previous maps
+        self.assertEqual(r.get_history_depth('all'), 0)
+        r.record_maps()
+        self.assertEqual(r.grass_i.copy_map.call_count, 0)
+        r.history_depths = {'all': 2}
         r.record_maps()
         self.assertEqual(r.grass_i.copy_map.call_count, 1)
         r.record_maps(remove_null=True)
         self.assertEqual(r.grass_i.copy_map.call_count, 2)
         self.assertEqual(r.grass_i.null_bitmask.call_count, 1)
         self.assertTrue('all' in r.get_previous_map('all'))
+        # The oldest map is reused once there are enough
+        oldest = r.get_previous_map('all', 2)
+        r.record_maps()
+        self.assertEqual(r.grass_i.copy_map.call_count, 3)
+        self.assertEqual(len(r.get_previous_maps('all')), 2)
+        self.assertEqual(r.get_previous_map('all'), oldest)
         
     def test_previous_maps(self):
         i = self.m_variables_complete.get_instances()[0]
@@ -158,13 +172,97 @@ class ReplicateTest(unittest.TestCase):
         a_map = r.get_previous_map('all')
         self.assertEqual(a_map, 'freaky')
 
+    def test_checkpoint_analysis_output(self):
+        import tempfile
+        i = self.m_variables_complete.get_instances()[0]
+        r = i.replicates[0]
+        r.grass_i = Mock()
+        r.grass_i.get_mapset.return_value = 'mock_mapset'
+        r.instance.experiment.save_model = Mock()
+        fd, fn = tempfile.mkstemp(prefix='mdig_analysis_test')
+        os.write(fd, '2000 1\n')
+        os.close(fd)
+        a = Mock()
+        a.get_append_file.return_value = fn
+        ls = r.instance.experiment.get_lifestage('all')
+        ls.analysis_list = [a]
+        r.save_checkpoint(2001)
+        # The replicate appended more output before it was interrupted
+        f = open(fn, 'a')
+        f.write('2001 2\n')
+        f.close()
+        r.restore_checkpoint(r.load_checkpoint())
+        self.assertEqual(open(fn).read(), '2000 1\n')
+        r.remove_checkpoint()
+        ls.analysis_list = []
+        os.remove(fn)
+
+    def test_checkpoint(self):
+        i = self.m_variables_complete.get_instances()[0]
+        r = i.replicates[0]
+        r.grass_i = Mock()
+        r.grass_i.get_mapset.return_value = 'mock_mapset'
+        r.instance.experiment.save_model = Mock()
+        self.assertEqual(r.load_checkpoint(), None)
+        r.temp_map_names['all'] = [ 'tmap1', 'tmap2' ]
+        r.push_previous_map('all','prev1')
+        r.metrics.metrics = {'all': {'events': {(0, 'r.dispersal'): {}}}}
+        r.save_checkpoint(2005)
+        self.assertTrue(r.instance.experiment.save_model.called)
+        # the population and previous map are copied
+        self.assertEqual(r.grass_i.copy_map.call_count, 2)
+        state = r.load_checkpoint()
+        self.assertEqual(state['time'], 2005)
+        expected = r.random.random()
+
+        # Resume in another mapset, e.g. after a parallel worker was killed
+        r.random.seed(1)
+        r.previous_maps = None
+        r.metrics.metrics = {}
+        r.grass_i.get_mapset.return_value = 'other_mapset'
+        map_names = [m.text for m in r.node.xpath('lifestage/maps/map')]
+        self.assertTrue(map_names)
+        r.add_completed_raster_map(2006, 'all', 'after_checkpoint')
+        self.assertEqual(r.restore_checkpoint(state), 2005)
+        self.assertEqual(r.random.random(), expected)
+        self.assertEqual(r.get_previous_maps('all'),
+                [r.grass_i.generate_map_name.return_value])
+        self.assertEqual(r.metrics.metrics.keys(), ['all'])
+        # the maps recorded before the checkpoint are restored in the node,
+        # and copied from the mapset they were made in
+        self.assertEqual([m.text for m in r.node.xpath('lifestage/maps/map')],
+                map_names)
+        self.assertEqual(r.node.getparent(), i.node.find('replicates'))
+        copied = [c[0][0] for c in r.grass_i.copy_map.call_args_list]
+        for m in map_names:
+            self.assertTrue(m + '@mock_mapset' in copied)
+        self.assertEqual(r.grass_i.copy_map.call_count, 4 + len(map_names))
+        # previous maps are restored from their checkpoint copies
+        self.assertTrue(r.grass_i.copy_map.call_args[0][0].endswith(
+            '_checkpoint_all_prev_0@mock_mapset'))
+
+        # Resume with no previous maps saved
+        r.previous_maps = None
+        r.restore_checkpoint(dict(state, previous_maps={}))
+        self.assertEqual(r.get_previous_maps('all'), [])
+
+        # Checkpoints are for a particular seed
+        r.seed_backup = r.get_seed()
+        r.node.find('seed').text = '1'
+        self.assertEqual(r.load_checkpoint(), None)
+        r.node.find('seed').text = repr(r.seed_backup)
+        fn = r.get_checkpoint_filename()
+        r.remove_checkpoint()
+        self.assertFalse(os.path.exists(fn))
+        self.assertEqual(len(r.grass_i.remove_maps.call_args[0][0]), 2)
+        os.rmdir(os.path.dirname(fn))
+
     def init_mock_grass(self,g):
         g.return_value.init_map.return_value = ('mockstring',Mock())
         g.return_value.get_mapset.return_value = 'mock_mapset'
         g.return_value.generate_map_name.return_value = 'tempmapname'
-        g.return_value.get_range.return_value = ['thisr=10']*10
+        g.return_value.get_region_info.return_value = {'rows': 10, 'cols': 10}
         g.return_value.raster_value_freq.return_value = [(1,1), (2,1), (3,1)]
-        g.return_value.raster_to_ascii.return_value = ('file1','file2')
 
     @patch('mdig.lifestage.Lifestage')
     @patch('mdig.grass.get_g')
@@ -0,0 +1,50 @@
+import unittest
+
+import numpy
+
+from mdig.sparse import SparseRaster, OccupancyCounter, occupied_cells
+
+class SparseRasterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.data = numpy.array([[0.0, 2.0, numpy.nan], [4.0, numpy.nan, 0.0]])
+
+    def test_from_array(self):
+        s = SparseRaster.from_array(self.data)
+        self.assertEqual(len(s), 4)
+        self.assertEqual(s.rows.tolist(), [0, 0, 1, 1])
+        self.assertEqual(s.cols.tolist(), [0, 1, 0, 2])
+        self.assertEqual(s.flat_index().tolist(), [0, 1, 3, 5])
+        s = SparseRaster.from_array(self.data, zero_is_null=True)
+        self.assertEqual(s.values.tolist(), [2.0, 4.0])
+        a = s.to_array(0.0)
+        self.assertEqual(a.tolist(), [[0.0, 2.0, 0.0], [4.0, 0.0, 0.0]])
+        self.assertTrue(numpy.isnan(s.to_array()[0, 0]))
+
+    def test_values_at(self):
+        s = SparseRaster.from_array(self.data, zero_is_null=True)
+        self.assertEqual(s.values_at([1, 0, 1], [2, 1, 0]).tolist(),
+                [0.0, 2.0, 4.0])
+        empty = SparseRaster.from_array(numpy.zeros((2, 3)), zero_is_null=True)
+        self.assertEqual(empty.values_at([0], [0], null=-1.0).tolist(), [-1.0])
+
+    def test_occupied_cells(self):
+        a = SparseRaster.from_array(self.data, zero_is_null=True)
+        b = SparseRaster((2, 3), [0, 1], [1, 2], [1.0, 1.0])
+        rows, cols = occupied_cells([a, b])
+        self.assertEqual(zip(rows, cols), [(0, 1), (1, 0), (1, 2)])
+
+    def test_envelope(self):
+        c = OccupancyCounter((2, 3))
+        c.add(SparseRaster.from_array(self.data, zero_is_null=True))
+        c.add(SparseRaster((2, 3), [0, 1], [1, 2], [1.0, 1.0]))
+        c.add(SparseRaster((2, 3), [], [], []))
+        e = c.envelope().to_array(0.0)
+        self.assertTrue(numpy.allclose(e, [[0, 2 / 3.0, 0], [1 / 3.0, 0, 1 / 3.0]]))
+        self.assertEqual(len(OccupancyCounter((2, 3)).envelope()), 0)
+
+    def test_univariate_stats(self):
+        from mdig import grass
+        s = SparseRaster.from_array(self.data)
+        self.assertEqual(s.univariate_stats(),
+                grass.univariate_stats(numpy.ma.masked_invalid(self.data)))
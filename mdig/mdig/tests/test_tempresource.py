@@ -23,3 +23,29 @@ class TempResourceTest(unittest.TestCase):
         self.trm.release(fn)
 
         self.assertEqual(len(self.trm.temp_files), 0)
+
+    def test_temp_map_name(self):
+        names = set([self.trm.temp_map_name('test') for i in range(100)])
+        self.assertEqual(len(names), 100)
+        self.assertTrue(all(['test' in n for n in names]))
+        # not registered without a mapset
+        self.assertEqual(len(self.trm.temp_files), 0)
+        self.trm.temp_map_name('test', 'a_mapset', register=False)
+        self.assertEqual(len(self.trm.temp_files), 0)
+
+    def test_cleanup_maps(self):
+        remover = self.trm.map_remover = Mock()
+        fn = self.trm.temp_filename('test')
+        m1 = self.trm.temp_map_name('test', 'a_mapset')
+        m2 = self.trm.temp_map_name('test', 'a_mapset')
+        m3 = self.trm.temp_map_name('test', 'a_mapset')
+        self.trm.discard(m3 + '@a_mapset', self.trm.MAP)
+        self.trm.cleanup(self.trm.MAP)
+        self.assertEqual(remover.call_count, 1)
+        self.assertEqual(sorted(remover.call_args[0][0]),
+                sorted([m1 + '@a_mapset', m2 + '@a_mapset']))
+        # only the temp file is left
+        self.assertEqual(self.trm.temp_files, set([(self.trm.FILE, fn)]))
+        self.trm.cleanup()
+        self.assertEqual(remover.call_count, 1)
+        self.assertEqual(len(self.trm.temp_files), 0)